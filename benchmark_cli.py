@@ -0,0 +1,544 @@
+import argparse
+import os
+import sys
+from time import time as ttime
+
+import numpy as np
+
+CWD = os.getcwd()
+if CWD not in sys.path:
+    sys.path.append(CWD)
+
+def load_benchmark_audio(audio_path,sr,duration):
+    from webui.audio import load_input_audio
+    audio,_ = load_input_audio(audio_path,sr,mono=True)
+    n_samples = int(sr*duration)
+    if len(audio)<n_samples: audio = np.tile(audio,int(np.ceil(n_samples/len(audio)))) # loop short clips
+    return audio[:n_samples]
+
+def measure_peak_rss(func,*args,interval=.01,**kwargs):
+    # samples this process' RSS in the background while func runs
+    import psutil, threading
+    process = psutil.Process()
+    baseline = process.memory_info().rss
+    peak = [baseline]
+    done = threading.Event()
+    def _sample():
+        while not done.is_set():
+            peak[0] = max(peak[0],process.memory_info().rss)
+            done.wait(interval)
+    sampler = threading.Thread(target=_sample,daemon=True)
+    sampler.start()
+    try:
+        start = ttime()
+        result = func(*args,**kwargs)
+        elapsed = ttime()-start
+    finally:
+        done.set()
+        sampler.join()
+    return result, elapsed, (peak[0]-baseline)/1024**2
+
+def benchmark_vc_batch(model_path,audio_path,duration=240,batch_sizes=[1,2,4],f0_method=["rmvpe"],**kwargs):
+    from vc_infer_pipeline import get_vc, vc_single
+    from webui import config
+
+    models = get_vc(model_path,config=config)
+    audio = load_benchmark_audio(audio_path,16000,duration)
+    print(f"benchmarking {models['model_name']} on {duration}s of audio ({audio.shape})")
+
+    results = {}
+    for batch_size in batch_sizes:
+        start = ttime()
+        output = vc_single(input_audio=(audio,16000),f0_method=f0_method,batch_size=batch_size,**models)
+        results[batch_size] = (ttime()-start, output[0].astype("float32"))
+        print(f"batch_size={batch_size}: {results[batch_size][0]:.2f}s")
+
+    baseline = results[batch_sizes[0]]
+    for batch_size, (elapsed, output) in results.items():
+        n = min(len(output),len(baseline[1]))
+        diff = output[:n]-baseline[1][:n]
+        snr = 10*np.log10(np.sum(baseline[1][:n]**2)/max(np.sum(diff**2),1e-9))
+        print(f"batch_size={batch_size}: {elapsed:.2f}s speedup={baseline[0]/elapsed:.2f}x len={len(output)} snr_vs_{batch_sizes[0]}={snr:.1f}dB")
+    return results
+
+def benchmark_stream(model_path,audio_path,output_path=None,block_time=.25,crossfade_time=.05,context_time=1.,latency=None,f0_method=["rmvpe"],**kwargs):
+    from vc_infer_pipeline import get_vc
+    from vc_stream_pipeline import StreamingVC
+    from webui import config
+    from webui.audio import load_input_audio, save_input_audio
+
+    models = get_vc(model_path,config=config)
+    audio,sr = load_input_audio(audio_path,mono=True)
+    engine = StreamingVC(**models,f0_method=f0_method,input_sr=sr,block_time=block_time,
+                         crossfade_time=crossfade_time,context_time=context_time,latency=latency)
+    print(f"streaming {len(audio)/sr:.1f}s of audio through {engine}")
+
+    start = ttime()
+    # feed the engine the same way an audio callback would
+    blocks = (audio[i:i+engine.input_block_size] for i in range(0,len(audio),engine.input_block_size))
+    output = np.concatenate(list(engine.stream(blocks)))
+    elapsed = ttime()-start
+
+    stats = engine.get_stats()
+    for k,v in stats.items(): print(f"{k}={v:.4f}" if type(v)!=int else f"{k}={v}")
+    print(f"throughput={len(audio)/sr/elapsed:.2f}x real-time, real-time capable={stats['p95_process_time']<stats['block_time']}")
+    if output_path: save_input_audio(output_path,(output,engine.tgt_sr))
+    return stats
+
+def benchmark_rmvpe_decode(model_path=None,n_frames=30000,repeats=5,device="cpu",**kwargs):
+    import torch
+    from lib.rmvpe import RMVPE
+    from webui.downloader import BASE_MODELS_DIR
+
+    model = RMVPE(model_path if model_path else os.path.join(BASE_MODELS_DIR,"rmvpe.pt"),is_half=False,device=device)
+    salience = np.random.rand(n_frames,360).astype("float32") # 30000 frames == 5 minutes at 100 frames/s
+    salience_torch = torch.from_numpy(salience).to(device)
+
+    results = {}
+    for name, func, x in [("numpy",model.to_local_average_cents,salience),("torch",model.to_local_average_cents_torch,salience_torch)]:
+        func(x) # warmup
+        start = ttime()
+        for _ in range(repeats): cents = func(x)
+        results[name] = (ttime()-start)/repeats
+        print(f"{name}: {results[name]*1000:.2f}ms for {n_frames} frames")
+    return results
+
+def benchmark_rmvpe_chunked(audio_path,model_path=None,chunk_size=3200,num_threads=1,device="cpu",**kwargs):
+    from lib.rmvpe import RMVPE
+    from webui.audio import load_input_audio
+    from webui.downloader import BASE_MODELS_DIR
+
+    model = RMVPE(model_path if model_path else os.path.join(BASE_MODELS_DIR,"rmvpe.pt"),is_half=False,device=device)
+    audio,_ = load_input_audio(audio_path,16000,mono=True)
+    print(f"running rmvpe on {len(audio)/16000:.1f}s of audio")
+
+    # chunked runs first so the one-shot peak doesn't hide it
+    f0_chunked, t_chunked, rss_chunked = measure_peak_rss(model.infer_from_audio_chunked,audio,chunk_size=chunk_size,num_threads=num_threads)
+    print(f"chunked (chunk_size={chunk_size}, num_threads={num_threads}): {t_chunked:.2f}s peak_rss=+{rss_chunked:.1f}MB")
+    f0, t_full, rss_full = measure_peak_rss(model.infer_from_audio,audio)
+    print(f"one-shot: {t_full:.2f}s peak_rss=+{rss_full:.1f}MB")
+
+    n = min(len(f0),len(f0_chunked))
+    cents = lambda x: 1200*np.log2(np.maximum(x,1)/10)
+    voiced = (f0[:n]>0)&(f0_chunked[:n]>0)
+    print(f"frames={len(f0)}/{len(f0_chunked)} voicing_mismatch={np.mean((f0[:n]>0)!=(f0_chunked[:n]>0))*100:.3f}% "
+          f"max_cents_diff={np.abs(cents(f0[:n])-cents(f0_chunked[:n]))[voiced].max(initial=0):.3f}")
+    return f0, f0_chunked
+
+def benchmark_f0_hybrid(audio_path,f0_method=["harvest","dio","rmvpe"],duration=60,backends=["thread","process"],**kwargs):
+    from pitch_extraction import FeatureExtractor
+    from webui import config
+
+    audio = load_benchmark_audio(audio_path,16000,duration)
+    extractor = FeatureExtractor(40000,config) # tgt_sr only matters for padding the synthesized audio
+    p_len = len(audio)//extractor.window
+    print(f"hybrid f0 {f0_method} on {duration}s of audio")
+
+    results = {}
+    for backend in backends:
+        start = ttime()
+        f0 = extractor.get_f0_hybrid_computation(f0_method,"median",audio,50,1100,p_len,3,160,extractor.window/extractor.sr*1000,backend=backend)
+        results[backend] = (ttime()-start, f0)
+        print(f"{backend}: {results[backend][0]:.2f}s ({', '.join(f'{k}={v:.2f}s' for k,v in extractor.f0_method_times.items())})")
+
+    baseline = results[backends[0]]
+    for backend, (elapsed, f0) in results.items():
+        n = min(len(f0),len(baseline[1]))
+        print(f"{backend}: speedup={baseline[0]/elapsed:.2f}x max_abs_diff={np.abs(f0[:n]-baseline[1][:n]).max():.4f}Hz")
+    return results
+
+def benchmark_world_segmented(audio_path,f0_method="harvest",duration=180,segment_time=30.,**kwargs):
+    from pitch_extraction import CPU_F0_METHODS, compute_world_segmented
+
+    audio = load_benchmark_audio(audio_path,16000,duration).astype(np.double)
+    print(f"{f0_method} on {duration}s of audio")
+
+    start = ttime()
+    f0 = CPU_F0_METHODS[f0_method](audio,16000)
+    t_full = ttime()-start
+    print(f"whole signal: {t_full:.2f}s")
+    start = ttime()
+    f0_segmented = compute_world_segmented(f0_method,audio,16000,segment_time=segment_time)
+    t_segmented = ttime()-start
+    print(f"segmented ({segment_time}s): {t_segmented:.2f}s speedup={t_full/t_segmented:.2f}x")
+
+    voiced = (f0>0)&(f0_segmented>0)
+    print(f"frames={len(f0)}/{len(f0_segmented)} voicing_mismatch={np.mean((f0>0)!=(f0_segmented>0))*100:.3f}% "
+          f"mean_abs_diff={np.abs(f0-f0_segmented)[voiced].mean() if voiced.any() else 0:.3f}Hz")
+    return f0, f0_segmented
+
+def benchmark_cut_points(audio_path=None,duration=600,window=160,x_center=38,x_query=6,**kwargs):
+    from webui.audio import find_cut_points
+
+    if audio_path: audio = load_benchmark_audio(audio_path,16000,duration).astype(np.float64)
+    else: audio = np.random.randn(int(16000*duration))*np.repeat(np.random.rand(int(duration*10))>.2,1600)*.3 # noise with gaps
+    t_center, t_query = 16000*x_center, 16000*x_query
+
+    def loop_cut_points(audio):
+        # the per-sample loop VC.pipeline used before
+        audio_pad = np.pad(audio,(window//2,window//2),mode="reflect")
+        audio_sum = np.zeros_like(audio)
+        for i in range(window): audio_sum += audio_pad[i:i-window]
+        opt_ts = []
+        for t in range(t_center,audio.shape[0],t_center):
+            abs_audio_sum = np.abs(audio_sum[t-t_query:t+t_query])
+            opt_ts.append(t-t_query+np.where(abs_audio_sum==abs_audio_sum.min())[0][0])
+        return opt_ts
+
+    start = ttime()
+    expected = loop_cut_points(audio)
+    t_loop = ttime()-start
+    start = ttime()
+    cut_points = find_cut_points(audio,window,t_center,t_query)
+    t_vectorized = ttime()-start
+    print(f"{duration}s of audio, {len(cut_points)} cuts: loop={t_loop:.3f}s vectorized={t_vectorized:.3f}s speedup={t_loop/t_vectorized:.1f}x")
+    print(f"max cut difference={max([abs(a-b) for a,b in zip(expected,cut_points)],default=0)} samples")
+    return cut_points
+
+def benchmark_resample(audio_path=None,duration=60,orig_sr=44100,target_srs=[16000,40000,48000],quality="high",repeats=3,**kwargs):
+    from lib.resampler import RESAMPLE_BACKENDS, get_resample_filter, resample, soxr
+
+    if audio_path: audio = np.stack([load_benchmark_audio(audio_path,orig_sr,duration)]*2).astype(np.float32)
+    else: audio = np.random.randn(2,int(orig_sr*duration)).astype(np.float32)*.1
+    print(f"resampling {audio.shape} float32 from {orig_sr}Hz")
+
+    results = {}
+    for backend in RESAMPLE_BACKENDS:
+        if backend=="soxr" and soxr is None:
+            print("soxr is not installed, skipping")
+            continue
+        for target_sr in target_srs:
+            resample(audio[:,:orig_sr],orig_sr,target_sr,quality=quality,backend=backend) # warmup (and filter design)
+            start = ttime()
+            for _ in range(repeats): output = resample(audio,orig_sr,target_sr,quality=quality,backend=backend)
+            elapsed = (ttime()-start)/repeats
+            results[(backend,target_sr)] = elapsed
+            print(f"{backend} {orig_sr}->{target_sr}: {elapsed*1000:.1f}ms {duration/elapsed:.0f}x real-time dtype={output.dtype} shape={output.shape}")
+    print(f"cached scipy filters: {get_resample_filter.cache_info()}")
+    return results
+
+def benchmark_cover_stream(model_path,audio_path,uvr5_models,output_path=None,chunk_time=30.,device="cuda",f0_method=["rmvpe"],**kwargs):
+    from cover_stream_pipeline import CoverStreamPipeline
+    from vc_infer_pipeline import get_vc
+    from webui import config
+
+    models = get_vc(model_path,config=config)
+    pipeline = CoverStreamPipeline(models,uvr5_models,device=device,chunk_time=chunk_time,vc_single_params={"f0_method": f0_method})
+    print(f"streaming cover of {audio_path} with {pipeline}")
+
+    chunks = []
+    for chunk, sr in pipeline.stream(audio_path): chunks.append(chunk)
+    stats = pipeline.stats
+    print(f"time_to_first_chunk={stats['time_to_first_chunk']:.2f}s total={stats['total_time']:.2f}s "
+          f"separate={stats.get('separate_time',0):.2f}s convert={stats.get('convert_time',0):.2f}s "
+          f"(stage overlap saved {stats.get('separate_time',0)+stats.get('convert_time',0)-stats['total_time']:.2f}s)")
+    if output_path:
+        from webui.audio import save_input_audio
+        save_input_audio(output_path,(np.concatenate(chunks),sr))
+    return stats
+
+def benchmark_mdx(model_path,audio_path,duration=60,batch_sizes=[1,2,4,8],chunks=[15],num_threads=None,device="cpu",denoise=False,**kwargs):
+    from lib.mdx import MDXModel
+    from lib.separators import prepare_mix
+
+    audio = load_benchmark_audio(audio_path,44100,duration)
+    audio = np.stack([audio,audio]) # prepare_mix expects channels-first stereo
+    results = {}
+    for chunk in chunks:
+        for batch_size in batch_sizes:
+            model = MDXModel(model_path,device=device,chunks=chunk,margin=44100,denoise=denoise,mdx_batch_size=batch_size,num_threads=num_threads)
+            mix, _, _ = prepare_mix(audio.T,model.chunks,model.margin)
+            model.demix_base({0: mix[0][:,:44100*5]}) # warmup
+            start = ttime()
+            sources = model.demix_base(mix)[0]
+            elapsed = ttime()-start
+            results[(chunk,batch_size)] = (elapsed,sources)
+            print(f"chunks={chunk}s batch_size={batch_size}: {elapsed:.2f}s {audio.shape[-1]/elapsed:.0f} samples/s")
+            del model
+
+    baseline = next(iter(results.values()))[1]
+    for (chunk,batch_size),(elapsed,sources) in results.items():
+        n = min(sources.shape[-1],baseline.shape[-1])
+        print(f"chunks={chunk}s batch_size={batch_size}: max_abs_diff={np.abs(sources[:,:n]-baseline[:,:n]).max():.2e}")
+    return results
+
+def benchmark_mdx_overlap(model_path,audio_path,duration=60,overlaps=[0,.25,.5],mdx_batch_size=4,device="cpu",**kwargs):
+    from lib.mdx import MDXModel
+    from lib.separators import prepare_mix
+
+    audio = load_benchmark_audio(audio_path,44100,duration)
+    audio = np.stack([audio,audio])
+    model = MDXModel(model_path,device=device,margin=44100,mdx_batch_size=mdx_batch_size)
+    mix, _, _ = prepare_mix(audio.T,model.chunks,model.margin)
+    model.demix_overlap_add(audio[:,:44100*5]) # warmup
+    start = ttime()
+    baseline = model.demix_base(mix)[0]
+    results = {"margin": (ttime()-start,baseline)}
+    for overlap in overlaps:
+        start = ttime()
+        sources = model.demix_overlap_add(audio,overlap=overlap)
+        results[overlap] = (ttime()-start,sources)
+
+    # seam roughness: mean |2nd difference| around the chunk borders relative to everywhere else
+    step = model.params.gen_size
+    seams = np.arange(step,audio.shape[-1]-1,step)
+    for name,(elapsed,sources) in results.items():
+        n = min(sources.shape[-1],baseline.shape[-1])
+        rough = np.abs(np.diff(sources[:,:n],2,axis=-1)).mean(axis=0)
+        seam_ratio = rough[seams[seams<len(rough)]].mean()/(rough.mean()+1e-12)
+        print(f"{name}: {elapsed:.2f}s {audio.shape[-1]/elapsed:.0f} samples/s, seam_ratio={seam_ratio:.2f}, "
+              f"max_abs_diff_vs_margin={np.abs(sources[:,:n]-baseline[:,:n]).max():.2e}")
+    return results
+
+def benchmark_vr(model_path,duration=60,batch_sizes=[1,2,4,8],tta=False,device="cpu",agg=10,**kwargs):
+    from uvr5_cli import Separator
+
+    separator = Separator(model_path=model_path,agg=agg,device=device,is_half="cuda" in str(device))
+    model = separator.model
+    model.data["tta"] = tta
+    # window throughput only depends on the spectrogram shape, so a synthetic one is enough
+    n_frame = int(duration*model.mp.param["sr"]/model.mp.param["band"][1]["hl"])
+    rng = np.random.default_rng(0)
+    X_spec = (rng.standard_normal((2,model.mp.param["bins"]+1,n_frame))+1j*rng.standard_normal((2,model.mp.param["bins"]+1,n_frame))).astype(np.complex64)
+    aggressiveness = {"value": agg/100, "split_bin": model.mp.param["band"][1]["crop_stop"]}
+
+    results = {}
+    for batch_size in batch_sizes:
+        model.data["batch_size"] = batch_size
+        model.inference(X_spec[:,:,:model.data["window_size"]*2],aggressiveness) # warmup
+        start = ttime()
+        pred = model.inference(X_spec,aggressiveness)[0]
+        elapsed = ttime()-start
+        results[batch_size] = (elapsed,pred)
+        print(f"batch_size={batch_size} tta={tta}: {elapsed:.2f}s {n_frame/elapsed:.0f} frames/s")
+
+    baseline = next(iter(results.values()))[1]
+    for batch_size,(elapsed,pred) in results.items():
+        print(f"batch_size={batch_size}: speedup={results[batch_sizes[0]][0]/elapsed:.2f}x max_abs_diff={np.abs(pred-baseline).max():.2e}")
+    return results
+
+def benchmark_ensemble(model_paths,audio_path,duration=60,workers=[1,0],device="cpu",agg=10,**kwargs):
+    from uvr5_cli import StemMerger, run_ensemble
+
+    audio = load_benchmark_audio(audio_path,44100,duration)
+    results = {}
+    for num_workers in workers:
+        merger = StemMerger(len(model_paths))
+        times = {}
+        start = ttime()
+        for model_path, vocals, instrumental in run_ensemble(model_paths,(audio,44100),agg=agg,device=device,num_workers=num_workers or len(model_paths)):
+            times[os.path.basename(model_path)] = ttime()-start
+            merger.add(vocals,instrumental)
+        elapsed = ttime()-start
+        results[num_workers] = (elapsed,merger.merge("vocals")[0])
+        print(f"workers={num_workers or len(model_paths)}: {elapsed:.2f}s finished at {times}")
+
+    baseline = next(iter(results.values()))
+    for num_workers,(elapsed,vocals) in results.items():
+        print(f"workers={num_workers or len(model_paths)}: speedup={baseline[0]/elapsed:.2f}x max_abs_diff={np.abs(vocals-baseline[1]).max():.2e}")
+    return results
+
+def benchmark_preprocess_chain(preprocess_models,audio_path,duration=60,device="cpu",agg=10,**kwargs):
+    import shutil, tempfile
+    from uvr5_cli import Separator, run_preprocess_chain
+    from webui.audio import load_input_audio, save_input_audio
+
+    audio = load_benchmark_audio(audio_path,44100,duration)
+    temp_dir = tempfile.mkdtemp()
+    input_file = os.path.join(temp_dir,"input.wav")
+    save_input_audio(input_file,(audio,44100))
+
+    # old chain: every stage is encoded to mp3 and decoded again by the next model
+    start = ttime()
+    codec_time = 0
+    stage_file = input_file
+    for i,model_path in enumerate(preprocess_models):
+        model = Separator(model_path=model_path,agg=agg,device=device,is_half="cuda" in str(device))
+        instrumental = model.model.run_inference(stage_file)["instrumentals"]
+        del model
+        codec_start = ttime()
+        stage_file = os.path.join(temp_dir,f"{i}.mp3")
+        save_input_audio(stage_file,instrumental,to_int16=True)
+        legacy = load_input_audio(stage_file,sr=44100,mono=True)
+        codec_time += ttime()-codec_start
+    legacy_time = ttime()-start
+
+    start = ttime()
+    fused = run_preprocess_chain(preprocess_models,input_file,agg=agg,device=device)
+    fused_time = ttime()-start
+    shutil.rmtree(temp_dir,ignore_errors=True)
+
+    legacy, fused = np.asarray(legacy[0],dtype=np.float32), np.asarray(fused[0],dtype=np.float32)
+    n = min(len(legacy),len(fused))
+    legacy = legacy[:n]/max(np.abs(legacy[:n]).max(),1e-8)
+    fused = fused[:n]/max(np.abs(fused[:n]).max(),1e-8)
+    print(f"mp3 chain: {legacy_time:.2f}s ({codec_time:.2f}s encoding/decoding)")
+    print(f"in-memory chain: {fused_time:.2f}s, saved {legacy_time-fused_time:.2f}s")
+    print(f"mp3 round trip error: {10*np.log10(np.sum(fused**2)/max(np.sum((legacy-fused)**2),1e-12)):.1f}dB SNR")
+    return legacy_time, fused_time, codec_time
+
+def benchmark_demucs(model_path,audio_path,duration=30,workers=[0],shifts=1,overlap=.25,**kwargs):
+    from pathlib import Path
+    import random
+    import torch
+    from lib.uvr5_pack.demucs.apply import DemucsProcessRunner, apply_model
+    from lib.uvr5_pack.demucs.pretrained import get_model
+
+    model = get_model(name=os.path.splitext(os.path.basename(model_path))[0],repo=Path(os.path.dirname(model_path)))
+    model.eval()
+    audio = load_benchmark_audio(audio_path,model.samplerate,duration)
+    mix = torch.from_numpy(np.stack([audio,audio]))[None]
+
+    random.seed(0) # same shift offsets for every run
+    start = ttime()
+    baseline = apply_model(model,mix,shifts=shifts,split=True,overlap=overlap,device="cpu")
+    serial_time = ttime()-start
+    print(f"serial: {serial_time:.2f}s {duration/serial_time:.2f}x realtime")
+
+    results = {"serial": (serial_time,baseline)}
+    for num_workers in workers:
+        with DemucsProcessRunner(model,num_workers or None) as runner:
+            random.seed(0)
+            start = ttime()
+            sources = runner(mix,shifts=shifts,split=True,overlap=overlap)
+            elapsed = ttime()-start
+        results[runner.num_workers] = (elapsed,sources)
+        print(f"workers={runner.num_workers}: {elapsed:.2f}s {duration/elapsed:.2f}x realtime, speedup={serial_time/elapsed:.2f}x "
+              f"max_abs_diff={(sources-baseline).abs().max().item():.2e}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmarks for the audio processing pipelines")
+    subparsers = parser.add_subparsers(dest="benchmark",required=True)
+
+    vc_batch = subparsers.add_parser("vc_batch", help="compare serial and batched VC.pipeline synthesis")
+    vc_batch.add_argument("model_path", type=str, help="path to RVC model")
+    vc_batch.add_argument("-i", "--audio_path", type=str, required=True, help="vocals to convert (looped to --duration)")
+    vc_batch.add_argument("-t", "--duration", type=float, default=240, help="length of benchmark input in seconds")
+    vc_batch.add_argument("-b", "--batch_sizes", type=int, nargs="+", default=[1,2,4], help="batch sizes to compare (first one is the baseline)")
+    vc_batch.add_argument("-f", "--f0_method", type=str, nargs="+", default=["rmvpe"], help="pitch extraction method(s)")
+
+    stream = subparsers.add_parser("stream", help="latency/throughput of the streaming converter fed from a wav file")
+    stream.add_argument("model_path", type=str, help="path to RVC model")
+    stream.add_argument("-i", "--audio_path", type=str, required=True, help="audio file used as the input stream")
+    stream.add_argument("-o", "--output_path", type=str, default=None, help="save the converted stream here")
+    stream.add_argument("-b", "--block_time", type=float, default=.25, help="block size in seconds")
+    stream.add_argument("-x", "--crossfade_time", type=float, default=.05, help="crossfade length in seconds")
+    stream.add_argument("-c", "--context_time", type=float, default=1., help="rolling context in seconds")
+    stream.add_argument("-l", "--latency", type=float, default=None, help="target latency in seconds (overrides block_time)")
+    stream.add_argument("-f", "--f0_method", type=str, nargs="+", default=["rmvpe"], help="pitch extraction method(s)")
+
+    rmvpe_decode = subparsers.add_parser("rmvpe_decode", help="time RMVPE salience decoding")
+    rmvpe_decode.add_argument("-m", "--model_path", type=str, default=None, help="path to rmvpe.pt")
+    rmvpe_decode.add_argument("-n", "--n_frames", type=int, default=30000, help="number of frames to decode")
+    rmvpe_decode.add_argument("-r", "--repeats", type=int, default=5, help="number of timed runs")
+    rmvpe_decode.add_argument("-d", "--device", type=str, default="cpu", help="device for the torch decoder")
+
+    rmvpe_chunked = subparsers.add_parser("rmvpe_chunked", help="compare one-shot and chunked RMVPE (time, peak memory, f0 difference)")
+    rmvpe_chunked.add_argument("-i", "--audio_path", type=str, required=True, help="audio file to extract pitch from")
+    rmvpe_chunked.add_argument("-m", "--model_path", type=str, default=None, help="path to rmvpe.pt")
+    rmvpe_chunked.add_argument("-c", "--chunk_size", type=int, default=3200, help="frames per chunk (100 frames/s)")
+    rmvpe_chunked.add_argument("-n", "--num_threads", type=int, default=1, help="chunks processed in parallel")
+    rmvpe_chunked.add_argument("-d", "--device", type=str, default="cpu", help="device to run rmvpe on")
+
+    f0_hybrid = subparsers.add_parser("f0_hybrid", help="compare thread and process backends for hybrid f0")
+    f0_hybrid.add_argument("-i", "--audio_path", type=str, required=True, help="audio file to extract pitch from")
+    f0_hybrid.add_argument("-f", "--f0_method", type=str, nargs="+", default=["harvest","dio","rmvpe"], help="pitch extraction methods to merge")
+    f0_hybrid.add_argument("-t", "--duration", type=float, default=60, help="length of benchmark input in seconds")
+    f0_hybrid.add_argument("-b", "--backends", type=str, nargs="+", default=["thread","process"], choices=["thread","process"], help="backends to compare (first one is the baseline)")
+
+    world_segmented = subparsers.add_parser("world_segmented", help="compare whole-signal and segment-parallel harvest/dio")
+    world_segmented.add_argument("-i", "--audio_path", type=str, required=True, help="audio file to extract pitch from")
+    world_segmented.add_argument("-f", "--f0_method", type=str, default="harvest", choices=["harvest","dio"], help="WORLD pitch extractor")
+    world_segmented.add_argument("-t", "--duration", type=float, default=180, help="length of benchmark input in seconds")
+    world_segmented.add_argument("-s", "--segment_time", type=float, default=30., help="target segment length in seconds")
+
+    cut_points = subparsers.add_parser("cut_points", help="time the silence cut-point search used to slice long audio")
+    cut_points.add_argument("-i", "--audio_path", type=str, default=None, help="audio file (random noise with gaps if omitted)")
+    cut_points.add_argument("-t", "--duration", type=float, default=600, help="length of benchmark input in seconds")
+
+    resample = subparsers.add_parser("resample", help="throughput of each resampling backend")
+    resample.add_argument("-i", "--audio_path", type=str, default=None, help="audio file (white noise if omitted)")
+    resample.add_argument("-t", "--duration", type=float, default=60, help="length of benchmark input in seconds")
+    resample.add_argument("--orig_sr", type=int, default=44100, help="input sample rate")
+    resample.add_argument("--target_srs", type=int, nargs="+", default=[16000,40000,48000], help="output sample rates")
+    resample.add_argument("-q", "--quality", type=str, default="high", choices=["low","medium","high"], help="resampling quality")
+    resample.add_argument("-r", "--repeats", type=int, default=3, help="number of timed runs")
+
+    cover_stream = subparsers.add_parser("cover_stream", help="time-to-first-audio and total time of the chunked separate/convert/mix pipeline")
+    cover_stream.add_argument("model_path", type=str, help="path to RVC model")
+    cover_stream.add_argument("-i", "--audio_path", type=str, required=True, help="song to cover")
+    cover_stream.add_argument("-u", "--uvr5_models", type=str, nargs="+", required=True, help="vocal separation models")
+    cover_stream.add_argument("-o", "--output_path", type=str, default=None, help="save the cover here")
+    cover_stream.add_argument("-c", "--chunk_time", type=float, default=30., help="chunk length in seconds")
+    cover_stream.add_argument("-d", "--device", type=str, default="cuda", help="device for the separation models")
+    cover_stream.add_argument("-f", "--f0_method", type=str, nargs="+", default=["rmvpe"], help="pitch extraction method(s)")
+
+    mdx = subparsers.add_parser("mdx", help="MDX-Net onnx throughput over chunk and batch sizes")
+    mdx.add_argument("model_path", type=str, help="path to MDX onnx model")
+    mdx.add_argument("-i", "--audio_path", type=str, required=True, help="song to separate (looped to --duration)")
+    mdx.add_argument("-t", "--duration", type=float, default=60, help="length of benchmark input in seconds")
+    mdx.add_argument("-b", "--batch_sizes", type=int, nargs="+", default=[1,2,4,8], help="mdx batch sizes to compare")
+    mdx.add_argument("-c", "--chunks", type=int, nargs="+", default=[15], help="chunk lengths in seconds")
+    mdx.add_argument("-n", "--num_threads", type=int, default=None, help="onnxruntime intra-op threads")
+    mdx.add_argument("-d", "--device", type=str, default="cpu", help="device to run on")
+    mdx.add_argument("--denoise", action="store_true", help="run the +/-spec denoise pair")
+
+    vr = subparsers.add_parser("vr", help="UVR5 (VR) window inference throughput over batch sizes")
+    vr.add_argument("model_path", type=str, help="path to UVR model")
+    vr.add_argument("-t", "--duration", type=float, default=60, help="length of the synthetic spectrogram in seconds")
+    vr.add_argument("-b", "--batch_sizes", type=int, nargs="+", default=[1,2,4,8], help="window batch sizes to compare (first one is the baseline)")
+    vr.add_argument("--tta", action="store_true", help="include the shifted tta pass")
+    vr.add_argument("-d", "--device", type=str, default="cpu", help="device to run on")
+
+    ensemble = subparsers.add_parser("ensemble", help="serial vs parallel multi-model separation")
+    ensemble.add_argument("model_paths", type=str, nargs="+", help="paths to the UVR/MDX models in the ensemble")
+    ensemble.add_argument("-i", "--audio_path", type=str, required=True, help="song to separate (looped to --duration)")
+    ensemble.add_argument("-t", "--duration", type=float, default=60, help="length of benchmark input in seconds")
+    ensemble.add_argument("-w", "--workers", type=int, nargs="+", default=[1,0], help="worker process counts to compare (0 = one per model)")
+    ensemble.add_argument("-d", "--device", type=str, default="cpu", help="device to run on")
+
+    preprocess_chain = subparsers.add_parser("preprocess_chain", help="mp3 round trips vs in-memory preprocess (dereverb/deecho) chain")
+    preprocess_chain.add_argument("preprocess_models", type=str, nargs="+", help="paths to the preprocess models, in order")
+    preprocess_chain.add_argument("-i", "--audio_path", type=str, required=True, help="song to process (looped to --duration)")
+    preprocess_chain.add_argument("-t", "--duration", type=float, default=60, help="length of benchmark input in seconds")
+    preprocess_chain.add_argument("-d", "--device", type=str, default="cpu", help="device to run on")
+
+    demucs = subparsers.add_parser("demucs", help="serial apply_model vs the process pool demucs runner (cpu)")
+    demucs.add_argument("model_path", type=str, help="path to a demucs v3/v4 model (.yaml bag or .th signature)")
+    demucs.add_argument("-i", "--audio_path", type=str, required=True, help="song to separate (looped to --duration)")
+    demucs.add_argument("-t", "--duration", type=float, default=30, help="length of benchmark input in seconds")
+    demucs.add_argument("-w", "--workers", type=int, nargs="+", default=[0], help="worker counts to compare (0 = one per core)")
+    demucs.add_argument("-s", "--shifts", type=int, default=1, help="random shifts per model")
+    demucs.add_argument("-o", "--overlap", type=float, default=.25, help="segment overlap")
+
+    mdx_overlap = subparsers.add_parser("mdx_overlap", help="margin chunking vs windowed overlap-add MDX demixing")
+    mdx_overlap.add_argument("model_path", type=str, help="path to MDX onnx model")
+    mdx_overlap.add_argument("-i", "--audio_path", type=str, required=True, help="song to separate (looped to --duration)")
+    mdx_overlap.add_argument("-t", "--duration", type=float, default=60, help="length of benchmark input in seconds")
+    mdx_overlap.add_argument("-o", "--overlaps", type=float, nargs="+", default=[0,.25,.5], help="overlap ratios to compare")
+    mdx_overlap.add_argument("-b", "--mdx_batch_size", type=int, default=4, help="mdx batch size")
+    mdx_overlap.add_argument("-d", "--device", type=str, default="cpu", help="device to run on")
+
+    args = parser.parse_args()
+    benchmarks = {
+        "vc_batch": benchmark_vc_batch,
+        "stream": benchmark_stream,
+        "rmvpe_decode": benchmark_rmvpe_decode,
+        "rmvpe_chunked": benchmark_rmvpe_chunked,
+        "f0_hybrid": benchmark_f0_hybrid,
+        "world_segmented": benchmark_world_segmented,
+        "cut_points": benchmark_cut_points,
+        "resample": benchmark_resample,
+        "cover_stream": benchmark_cover_stream,
+        "mdx": benchmark_mdx,
+        "mdx_overlap": benchmark_mdx_overlap,
+        "vr": benchmark_vr,
+        "ensemble": benchmark_ensemble,
+        "preprocess_chain": benchmark_preprocess_chain,
+        "demucs": benchmark_demucs,
+    }
+    return benchmarks[args.benchmark](**vars(args))
+
+if __name__ == "__main__":
+    main()
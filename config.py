@@ -34,6 +34,10 @@ class Config:
             self.noparallel,
             self.noautoopen,
             self.dml,
+            self.model_memory,
+            self.f0_backend,
+            self.f0_workers,
+            self.world_segment_time,
         ) = self.arg_parse()
         self.instead = ""
         self.x_pad, self.x_query, self.x_center, self.x_max = self.device_config()
@@ -58,6 +62,31 @@ class Config:
             action="store_true",
             help="torch_dml",
         )
+        parser.add_argument(
+            "--model_memory",
+            type=int,
+            default=4096,
+            help="Memory budget (MB) for voice models kept loaded between conversions (0 for unlimited)",
+        )
+        parser.add_argument(
+            "--f0_backend",
+            type=str,
+            default="thread",
+            choices=["thread", "process"],
+            help="How hybrid f0 runs cpu methods (harvest/dio/pm): threads or worker processes",
+        )
+        parser.add_argument(
+            "--f0_workers",
+            type=int,
+            default=0,
+            help="Worker processes for the process f0 backend and segmented harvest/dio (0 for one per cpu core)",
+        )
+        parser.add_argument(
+            "--world_segment_time",
+            type=float,
+            default=0,
+            help="Split harvest/dio on audio longer than twice this many seconds into segments run in worker processes (0 to disable)",
+        )
         cmd_opts, unknown = parser.parse_known_args() # allows import to jupyter notebook
         print(f"unknown args: {unknown}")
 
@@ -70,6 +99,10 @@ class Config:
             cmd_opts.noparallel,
             cmd_opts.noautoopen,
             cmd_opts.dml,
+            cmd_opts.model_memory,
+            cmd_opts.f0_backend,
+            cmd_opts.f0_workers,
+            cmd_opts.world_segment_time,
         )
 
     # has_mps is only available in nightly pytorch (for now) and MasOS 12.3+.
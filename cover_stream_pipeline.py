@@ -0,0 +1,242 @@
+import os, sys
+import queue
+import shutil
+import tempfile
+import threading
+from time import time as ttime
+
+import numpy as np
+import soundfile as sf
+
+CWD = os.getcwd()
+if CWD not in sys.path:
+    sys.path.append(CWD)
+
+from lib.audio import AudioWriter
+from lib.resampler import resample
+from uvr5_cli import Separator
+from vc_infer_pipeline import vc_single
+from webui.audio import MAX_INT16, get_peak, stream_input_audio
+from webui.utils import gc_collect, get_optimal_threads
+
+def match_gain(mix, *stems):
+    # the separators peak-normalize every call, so rescale the stems (least squares) until they add up to the mix again
+    stems = [np.asarray(stem, dtype=np.float32) for stem in stems]
+    n = min(len(mix), *(len(stem) for stem in stems))
+    gains = np.linalg.lstsq(np.stack([stem[:n] for stem in stems], axis=1), mix[:n], rcond=None)[0]
+    return [stem * np.float32(max(gain, 0.)) for stem, gain in zip(stems, gains)]
+
+def fix_length(audio, size):
+    return audio[:size] if len(audio) >= size else np.pad(audio, (0, size - len(audio)))
+
+class CoverStreamPipeline:
+    """
+    Separates, converts and mixes a song chunk by chunk instead of as whole arrays.
+
+    The separator, voice conversion and mixer run as threads joined by small queues, so while one
+    chunk is being converted the next one is already being separated and the first mixed chunk is
+    ready after one chunk's worth of work instead of the whole song. Every chunk starts with
+    2*crossfade_time seconds of the previous one, which the mixer crossfades away.
+    """
+
+    def __init__(
+        self,
+        rvc_models,
+        model_paths,
+        preprocess_models=[],
+        device="cuda",
+        agg=10,
+        merge_type="median",
+        chunk_time=30.,
+        crossfade_time=.5,
+        sr=44100,
+        vc_single_params={},
+        queue_size=2,
+        debug=False,
+        **kwargs
+    ):
+        print(f"CoverStreamPipeline unused args: {kwargs}")
+        self.rvc_models = rvc_models
+        self.model_paths = model_paths
+        self.preprocess_models = preprocess_models
+        self.device = device
+        self.agg = agg
+        self.merge_func = np.nanmedian if merge_type=="median" else np.nanmean
+        self.chunk_time = chunk_time
+        self.overlap_size = int(2 * crossfade_time * sr)
+        self.sr = sr
+        self.vc_single_params = vc_single_params
+        self.queue_size = queue_size
+        self.debug = debug # prints the stage timings after every song
+        self.separators = None
+        self.temp_dir = None
+        self.stop_event = threading.Event()
+        self.stats = {}
+
+    def __repr__(self):
+        return f"CoverStreamPipeline(models={len(self.model_paths)}, preprocess={len(self.preprocess_models)}, chunk={self.chunk_time}s, sr={self.sr})"
+
+    def load_separators(self):
+        # models stay loaded for the whole song instead of once per chunk
+        if self.separators is None:
+            num_threads = max(get_optimal_threads(-1),1)
+            load = lambda model_path: Separator(model_path=model_path, agg=self.agg, device=self.device,
+                                                is_half="cuda" in str(self.device), num_threads=num_threads)
+            self.separators = ([load(model_path) for model_path in self.preprocess_models],
+                               [load(model_path) for model_path in self.model_paths])
+        return self.separators
+
+    def read_chunks(self, audio_path):
+        # yields stereo chunks, each prefixed with the last overlap_size samples that came before it
+        history = np.zeros((2, 0), dtype=np.float32)
+        blocks = stream_input_audio(audio_path, sr=self.sr, chunk_time=self.chunk_time, mono=False)
+        try:
+            for block, _ in blocks:
+                block = np.broadcast_to(block, (2, block.shape[-1])) if block.ndim == 1 or len(block) == 1 else block[:2]
+                chunk = np.concatenate([history, block], axis=-1)
+                yield chunk, history.shape[-1]
+                history = chunk[:, -self.overlap_size:]
+        finally:
+            blocks.close() # stops the ffmpeg decoder when the reader gives up early
+
+    def separate(self, chunk):
+        # returns mono float32 (vocals, instrumental) at self.sr that add up to the chunk
+        preprocess_separators, separators = self.load_separators()
+        chunk_file = os.path.join(self.temp_dir, "chunk.wav")
+        sf.write(chunk_file, chunk.T, self.sr, subtype="FLOAT")
+        mix = chunk.mean(axis=0)
+
+        # dereverb/deecho models keep their "instrumental" output, same as split_audio
+        for separator in preprocess_separators:
+            _, cleaned = match_gain(mix, *self.run_separator(separator, chunk_file, mix))
+            sf.write(chunk_file, cleaned, self.sr, subtype="FLOAT")
+            mix = cleaned
+
+        wav_vocals, wav_instrument = [], []
+        for separator in separators:
+            vocals, instrumental = match_gain(mix, *self.run_separator(separator, chunk_file, mix))
+            wav_vocals.append(vocals)
+            wav_instrument.append(instrumental)
+        if len(separators) > 1:
+            return self.merge_func(np.stack(wav_vocals), axis=0), self.merge_func(np.stack(wav_instrument), axis=0)
+        return wav_vocals[0], wav_instrument[0]
+
+    def run_separator(self, separator, chunk_file, mix):
+        return_dict = separator.model.run_inference(chunk_file)
+        (vocals, vocals_sr), (instrumental, instrumental_sr) = return_dict["vocals"], return_dict["instrumentals"]
+        vocals = resample(vocals, vocals_sr, self.sr) if vocals_sr != self.sr else vocals
+        instrumental = resample(instrumental, instrumental_sr, self.sr) if instrumental_sr != self.sr else instrumental
+        return fix_length(np.asarray(vocals, np.float32), len(mix)), fix_length(np.asarray(instrumental, np.float32), len(mix))
+
+    def convert(self, vocals):
+        # vc_single normalizes its input and output, so bring the converted vocals back to the separated level
+        output = vc_single(input_audio=(vocals, self.sr), **self.vc_single_params, **self.rvc_models)
+        if output is None: raise RuntimeError("voice conversion failed")
+        converted, vc_sr = output
+        converted = resample(converted.astype(np.float32) / MAX_INT16, vc_sr, self.sr)
+        converted = fix_length(converted, len(vocals))
+        peak = get_peak(converted)
+        return converted * np.float32(get_peak(vocals) / peak) if peak > 0 else converted
+
+    def put(self, q, item):
+        # gives up once the pipeline is stopped, so a stage never blocks on a consumer that's gone
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q):
+        # None (the end marker) once the pipeline is stopped
+        while not self.stop_event.is_set():
+            try:
+                return q.get(timeout=.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def run_stage(self, name, func, in_queue, out_queue):
+        item = None
+        try:
+            while True:
+                item = self.get(in_queue)
+                if item is None or isinstance(item, Exception): break
+                start = ttime()
+                result = func(*item)
+                self.stats[f"{name}_time"] = self.stats.get(f"{name}_time", 0) + ttime() - start
+                if not self.put(out_queue, result): return
+        except Exception as e:
+            item = e
+        self.put(out_queue, item) # forwards the end marker or the error
+
+    def stream(self, audio_path):
+        # yields (mixed int16 chunk, sr) as soon as each chunk is mixed
+        self.stats = {"chunks": 0}
+        self.stop_event.clear()
+        self.temp_dir = tempfile.mkdtemp(prefix="cover_stream_")
+        start = ttime()
+        read_queue, separated_queue, converted_queue = (queue.Queue(self.queue_size) for _ in range(3))
+
+        def _separate(chunk, overlap):
+            vocals, instrumental = self.separate(chunk)
+            return vocals, instrumental, overlap
+        def _convert(vocals, instrumental, overlap):
+            return self.convert(vocals), instrumental, overlap
+        def _read():
+            chunks = self.read_chunks(audio_path)
+            try:
+                for item in chunks:
+                    if not self.put(read_queue, item): return
+                self.put(read_queue, None)
+            except Exception as e:
+                self.put(read_queue, e)
+            finally:
+                chunks.close() # also when stopped early, so the ffmpeg process doesn't outlive the stream
+
+        threads = [
+            threading.Thread(target=_read, name="cover_stream_read", daemon=True),
+            threading.Thread(target=self.run_stage, args=("separate", _separate, read_queue, separated_queue), name="cover_stream_separate", daemon=True),
+            threading.Thread(target=self.run_stage, args=("convert", _convert, separated_queue, converted_queue), name="cover_stream_convert", daemon=True),
+        ]
+        for thread in threads: thread.start()
+
+        tail = np.zeros(0, dtype=np.float32) # mixed samples held back for the next crossfade
+        try:
+            while True:
+                item = converted_queue.get()
+                if item is None: break
+                if isinstance(item, Exception): raise item
+                vocals, instrumental, overlap = item
+                mixed = vocals + instrumental # stems are gain matched, so this is back at the input level
+                if overlap:
+                    fade_in = np.sin(0.5 * np.pi * np.linspace(0., 1., overlap, dtype=np.float32)) ** 2
+                    mixed[:overlap] = mixed[:overlap] * fade_in + tail[-overlap:] * (1 - fade_in)
+                hold = min(self.overlap_size, len(mixed))
+                tail = mixed[-hold:]
+                output = mixed[:len(mixed) - hold]
+
+                self.stats["chunks"] += 1
+                if "time_to_first_chunk" not in self.stats: self.stats["time_to_first_chunk"] = ttime() - start
+                if len(output): yield self.to_int16(output), self.sr
+            if len(tail): yield self.to_int16(tail), self.sr
+        finally:
+            # the stages see the stop event within one queue timeout, a chunk that is being separated or converted
+            # finishes first, so the temp dir is only removed once nothing can write to it anymore
+            self.stop_event.set()
+            for thread in threads: thread.join()
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.stats["total_time"] = ttime() - start
+            if self.debug: print(f"{self}: {self.stats}")
+            gc_collect()
+
+    @staticmethod
+    def to_int16(audio):
+        return np.clip(audio * MAX_INT16, -MAX_INT16 + 1, MAX_INT16 - 1).astype("int16")
+
+    def save(self, audio_path, output_path):
+        # writes the cover incrementally, e.g. to a playlist cache file
+        with AudioWriter(output_path, self.sr, channels=1) as writer:
+            for chunk, _ in self.stream(audio_path): writer.write(chunk)
+        return output_path
@@ -1,5 +1,9 @@
+import os
 import ffmpeg
 import numpy as np
+import soundfile as sf
+
+SOUNDFILE_FORMATS = ["wav","flac","ogg","aiff","aif"] # written directly, everything else goes through ffmpeg
 
 
 def load_audio(file, sr):
@@ -19,3 +23,99 @@ def load_audio(file, sr):
         raise RuntimeError(f"Failed to load audio: {e}")
 
     return np.frombuffer(out, np.float32).flatten()
+
+
+def is_soundfile_readable(file):
+    # libsndfile can't decode everything (e.g. mp3 before 1.1, m4a)
+    try:
+        sf.info(file)
+        return True
+    except Exception:
+        return False
+
+def get_audio_info(file):
+    # (sample rate, channels, frames) without decoding the file
+    try:
+        info = sf.info(file)
+        return info.samplerate, info.channels, info.frames
+    except Exception:
+        probe = ffmpeg.probe(file)
+        stream = next(s for s in probe["streams"] if s["codec_type"] == "audio")
+        sr = int(stream["sample_rate"])
+        return sr, int(stream["channels"]), int(float(probe["format"].get("duration", 0)) * sr)
+
+def stream_audio(file, sr=None, mono=True, chunk_size=441000):
+    # yields float32 chunks of chunk_size frames ([n] if mono else [channels, n]) with O(chunk) memory:
+    # soundfile blocks when no resampling is needed, otherwise ffmpeg decodes/resamples into a pipe
+    file_sr, channels, _ = get_audio_info(file)
+    sr = sr or file_sr
+    if sr == file_sr and is_soundfile_readable(file):
+        for block in sf.blocks(file, blocksize=chunk_size, dtype="float32", always_2d=True):
+            yield block.mean(axis=1) if mono else block.T
+        return
+
+    out_channels = 1 if mono else channels
+    process = (
+        ffmpeg.input(file, threads=0)
+        .output("-", format="f32le", acodec="pcm_f32le", ac=out_channels, ar=sr)
+        .global_args("-loglevel", "error")
+        .run_async(cmd=["ffmpeg", "-nostdin"], pipe_stdout=True)
+    )
+    try:
+        while True:
+            data = process.stdout.read(chunk_size * out_channels * 4)
+            if not data: break
+            chunk = np.frombuffer(data, np.float32)
+            yield chunk if mono else chunk.reshape(-1, out_channels).T
+    finally:
+        process.stdout.close()
+        if process.poll() is None: process.kill() # generator closed before the end
+        process.wait()
+
+class AudioWriter:
+    # block-wise writer: soundfile for SOUNDFILE_FORMATS, an ffmpeg pipe for compressed formats
+    def __init__(self, file, sr, channels=1, subtype=None):
+        self.file = file
+        self.sr = sr
+        self.channels = channels
+        self.frames = 0
+        os.makedirs(os.path.dirname(file) or ".", exist_ok=True)
+        ext = os.path.splitext(file)[-1][1:].lower()
+        if ext in SOUNDFILE_FORMATS:
+            self.process = None
+            if subtype and not sf.check_format("AIFF" if ext == "aif" else ext.upper(), subtype): subtype = None # e.g. PCM_16 in ogg
+            self.sound_file = sf.SoundFile(file, "w", samplerate=sr, channels=channels, subtype=subtype)
+        else:
+            self.sound_file = None
+            self.process = (
+                ffmpeg.input("pipe:", format="f32le", ar=sr, ac=channels)
+                .output(file)
+                .global_args("-loglevel", "error")
+                .overwrite_output()
+                .run_async(cmd=["ffmpeg", "-nostdin"], pipe_stdin=True)
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, chunk):
+        # chunk is [n] or [channels, n], int16 or float
+        chunk = np.asarray(chunk)
+        chunk = chunk.astype(np.float32) / 32768 if chunk.dtype == np.int16 else chunk.astype(np.float32, copy=False)
+        chunk = chunk.reshape(1, -1) if chunk.ndim == 1 else chunk
+        if chunk.shape[0] != self.channels: chunk = np.broadcast_to(chunk.mean(axis=0), (self.channels, chunk.shape[-1]))
+        if self.sound_file is not None: self.sound_file.write(chunk.T)
+        else: self.process.stdin.write(np.ascontiguousarray(chunk.T).tobytes())
+        self.frames += chunk.shape[-1]
+
+    def close(self):
+        if self.sound_file is not None:
+            self.sound_file.close()
+        elif self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            if self.process.returncode: raise RuntimeError(f"ffmpeg failed to write {self.file}")
+            self.process = None
@@ -3,6 +3,8 @@ import librosa
 import numpy as np
 import soundfile
 
+from lib.resampler import resample
+
 
 class ContentVec:
     def __init__(self, vec_path="pretrained/vec-768-layer-12.onnx", device=None):
@@ -115,7 +117,7 @@ class OnnxRVC:
         if org_length / sr > 50.0:
             raise RuntimeError("Reached Max Length")
 
-        wav16k = librosa.resample(wav, orig_sr=self.sampling_rate, target_sr=16000)
+        wav16k = resample(wav, self.sampling_rate, 16000)
         wav16k = wav16k
 
         hubert = self.vec_model(wav16k)
@@ -1,9 +1,11 @@
 import hashlib
 import json
 import os
+from time import time
 import warnings
 
 import numpy as np
+from scipy import signal
 import torch
 from tqdm import tqdm
 from lib.model_utils import get_hash
@@ -15,6 +17,16 @@ warnings.filterwarnings("ignore")
 stem_naming = {'Vocals': 'Instrumental', 'Other': 'Instruments', 'Instrumental': 'Vocals', 'Drums': 'Drumless', 'Bass': 'Bassless'}
 
 
+def get_session_options(num_threads=None):
+    # intra op threads parallelize the convolutions, inter op threads only help parallel branches
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    if num_threads:
+        options.intra_op_num_threads = int(num_threads)
+        options.inter_op_num_threads = 1
+    return options
+
 class MDXParams:
     def __init__(self, device, dim_f, dim_t, n_fft, hop=1024, stem_name=None, compensation=1.000):
         self.dim_f = dim_f
@@ -61,12 +73,12 @@ class MDXModel:
     DEFAULT_PROCESSOR = 0
 
     # def __init__(self, model_path: str, params: MDXModel, processor=DEFAULT_PROCESSOR,margin=DEFAULT_MARGIN_SIZE,chunks=15):
-    def __init__(self, model_path: str, device="cpu",margin=DEFAULT_MARGIN_SIZE,chunks=15,denoise=False):
+    def __init__(self, model_path: str, device="cpu",margin=DEFAULT_MARGIN_SIZE,chunks=15,denoise=False,mdx_batch_size=4,num_threads=None):
 
         # Set the device and the provider (CPU or CUDA)
         self.device = device #torch.device(f'cuda:{processor}') if processor >= 0 else torch.device('cpu')
         # self.provider = ['CUDAExecutionProvider'] if processor >= 0 else ['CPUExecutionProvider']
-        self.providers = ['CUDAExecutionProvider','CPUExecutionProvider']
+        self.providers = ['CUDAExecutionProvider','CPUExecutionProvider'] if "cuda" in str(device) else ['CPUExecutionProvider']
 
         mp = self.get_params(model_path)
         self.params = MDXParams(
@@ -79,47 +91,78 @@ class MDXModel:
         )
 
         # Load the ONNX model using ONNX Runtime
-        self.ort = ort.InferenceSession(model_path, providers=self.providers)
+        self.ort = ort.InferenceSession(model_path, sess_options=get_session_options(num_threads), providers=self.providers)
         print(f"onnx load done: {model_path} ({self.params})")
 
-        self.run = lambda spec: self.ort.run(None, {'input': spec.cpu().numpy()})[0]
+        input_meta, output_meta = self.ort.get_inputs()[0], self.ort.get_outputs()[0]
+        self.input_name, self.output_name = input_meta.name, output_meta.name
+        # some exports have a fixed batch dimension
+        self.max_batch_size = input_meta.shape[0] if isinstance(input_meta.shape[0], int) else None
+        self.use_cuda_binding = "cuda" in str(device) and "CUDAExecutionProvider" in self.ort.get_providers()
         self.margin=margin
         self.chunks=chunks
         self.denoise=denoise
-        self.mdx_batch_size=1
+        self.mdx_batch_size=mdx_batch_size if self.max_batch_size is None else min(mdx_batch_size, self.max_batch_size)
+
+    def run(self, spec):
+        # returns a float32 tensor on self.device
+        if self.max_batch_size is not None and len(spec) > self.max_batch_size:
+            return torch.cat([self.run(s) for s in spec.split(self.max_batch_size)])
+        spec = spec.float().contiguous()
+        io_binding = self.ort.io_binding()
+        if self.use_cuda_binding:
+            # input and output stay in cuda memory, no host round trip between stft and istft
+            spec = spec.to(self.device)
+            output = torch.empty(spec.shape, dtype=torch.float32, device=spec.device)
+            device_id = spec.device.index or 0
+            io_binding.bind_input(self.input_name, "cuda", device_id, np.float32, list(spec.shape), spec.data_ptr())
+            io_binding.bind_output(self.output_name, "cuda", device_id, np.float32, list(output.shape), output.data_ptr())
+            # onnxruntime runs on its own cuda stream, so torch has to finish writing spec first
+            # (the run itself syncs its stream before returning, so output is ready for torch afterwards)
+            torch.cuda.synchronize(spec.device)
+            self.ort.run_with_iobinding(io_binding)
+            return output
+        # on cpu the tensor's memory is handed to onnxruntime as is
+        spec = spec.cpu()
+        io_binding.bind_cpu_input(self.input_name, spec.numpy())
+        io_binding.bind_output(self.output_name)
+        self.ort.run_with_iobinding(io_binding)
+        return torch.from_numpy(io_binding.copy_outputs_to_cpu()[0]).to(self.device)
 
     def initialize_mix(self, mix, is_ckpt=False):
+        # returns a [n_chunks, 2, chunk_size] strided view into one padded float32 copy of mix, batches are copied as they run
+        trim, gen_size = self.params.trim, self.params.gen_size
+        n_sample = mix.shape[-1]
         if is_ckpt:
-            pad = self.params.gen_size + self.params.trim - ((mix.shape[-1]) % self.params.gen_size)
-            mixture = np.concatenate((np.zeros((2, self.params.trim), dtype='float32'),mix, np.zeros((2, pad), dtype='float32')), 1)
-            num_chunks = mixture.shape[-1] // self.params.gen_size
-            mix_waves = [mixture[:, i * self.params.gen_size: i * self.params.gen_size + self.params.chunk_size] for i in range(num_chunks)]
+            pad = gen_size + trim - (n_sample % gen_size)
+            mixture = np.zeros((2, trim + n_sample + pad), dtype=np.float32)
+            mixture[:, trim:trim + n_sample] = mix
         else:
-            mix_waves = []
-            n_sample = mix.shape[1]
-            pad = self.params.gen_size - n_sample % self.params.gen_size
-            mix_p = np.concatenate((np.zeros((2,self.params.trim)), mix, np.zeros((2,pad)), np.zeros((2,self.params.trim))), 1)
-            i = 0
-            while i < n_sample + pad:
-                waves = np.array(mix_p[:, i:i+self.params.chunk_size])
-                mix_waves.append(waves)
-                i += self.params.gen_size
-                
-        mix_waves = torch.tensor(mix_waves, dtype=torch.float32).to(self.device)
+            pad = gen_size - n_sample % gen_size
+            mixture = np.zeros((2, trim + n_sample + pad + trim), dtype=np.float32)
+            mixture[:, trim:trim + n_sample] = mix
+        mix_waves = np.lib.stride_tricks.sliding_window_view(mixture, self.params.chunk_size, axis=-1)[:, ::gen_size].transpose(1, 0, 2)
 
         return mix_waves, pad
     
-    def demix_base(self, mix, is_ckpt=False, is_match_mix=False):
+    def demix_base(self, mix, is_ckpt=False, is_match_mix=False, checkpoint=None):
+        # checkpoint (a ChunkCheckpoint) keeps every finished slice on disk so a rerun resumes after it
         chunked_sources = []
-        for slice in tqdm(mix,"Processing audio:"):
+        for n, slice in enumerate(tqdm(mix,"Processing audio:")):
+            if checkpoint is not None:
+                sources = checkpoint.get(n)
+                if sources is not None:
+                    chunked_sources.append(sources)
+                    checkpoint.update(n + 1, len(mix))
+                    continue
             sources = []
             tar_waves_ = []
             mix_p = mix[slice]
             mix_waves, pad = self.initialize_mix(mix_p, is_ckpt=is_ckpt)
-            mix_waves = mix_waves.split(self.mdx_batch_size)
             pad = mix_p.shape[-1] if is_ckpt else -pad
             with torch.no_grad():
-                for mix_wave in mix_waves:
+                for i in range(0, len(mix_waves), self.mdx_batch_size):
+                    mix_wave = torch.from_numpy(np.ascontiguousarray(mix_waves[i:i + self.mdx_batch_size]))
                     tar_waves = self.run_model(mix_wave, is_ckpt=is_ckpt, is_match_mix=is_match_mix)
                     tar_waves_.append(tar_waves)
                 tar_waves_ = np.vstack(tar_waves_)[:, :, self.params.trim:-self.params.trim] if is_ckpt else tar_waves_
@@ -128,24 +171,74 @@ class MDXModel:
                 end = None if slice == list(mix.keys())[::-1][0] or self.margin == 0 else -self.margin
                 sources.append(tar_waves[:,start:end]/self.params.compensation)
             chunked_sources.append(sources)
+            if checkpoint is not None:
+                checkpoint.put(n, np.asarray(sources, dtype=np.float32))
+                checkpoint.update(n + 1, len(mix))
         sources = np.concatenate(chunked_sources, axis=-1)
         
         return sources
 
-    def run_model(self, mix, is_ckpt=False, is_match_mix=False):
-        
-        spek = self.params.stft(mix.to(self.device))*self.params.compensation
+    def demix_overlap_add(self, mix, overlap=.25, window="hann", is_match_mix=False, checkpoint=None):
+        # windowed overlap-add over the whole [2, n] mix: every network output sample is used
+        # (no margins computed then thrown away), overlap trades speed (0) for smoother chunk seams (.5-.75)
+        # checkpoint (a ChunkCheckpoint) keeps every finished batch on disk so a rerun resumes after it
+        start_time = time()
+        trim, gen_size, chunk_size = self.params.trim, self.params.gen_size, self.params.chunk_size
+        step = max(int(gen_size * (1 - overlap)), 1)
+        n_sample = mix.shape[-1]
+        n_chunks = int(np.ceil(max(n_sample - gen_size, 0) / step)) + 1
+        total = (n_chunks - 1) * step + gen_size
+
+        mix_p = np.zeros((2, total + 2 * trim), dtype=np.float32)
+        mix_p[:, trim:trim + n_sample] = mix
+        # [n_chunks, 2, chunk_size] view into mix_p, only the current batch gets copied
+        mix_waves = np.lib.stride_tricks.sliding_window_view(mix_p, chunk_size, axis=-1)[:, ::step].transpose(1, 0, 2)
+        # drop the zero end points so every sample has some weight
+        weight = signal.get_window(window, gen_size + 2, fftbins=False)[1:-1].astype(np.float32) if overlap > 0 else np.ones(gen_size, dtype=np.float32)
+
+        sources = np.zeros((2, total), dtype=np.float32)
+        weights = np.zeros(total, dtype=np.float32)
+        with torch.no_grad():
+            for i in tqdm(range(0, n_chunks, self.mdx_batch_size), "Processing audio:"):
+                batch = torch.from_numpy(np.ascontiguousarray(mix_waves[i:i + self.mdx_batch_size]))
+                predict = lambda: self.predict(batch, is_match_mix=is_match_mix)[:, :, trim:-trim].cpu().numpy()
+                if checkpoint is None: tar_waves = predict()
+                else:
+                    tar_waves = checkpoint.load_or_run(i // self.mdx_batch_size, predict)
+                    checkpoint.update(min(i + self.mdx_batch_size, n_chunks), n_chunks)
+                for j, tar_wave in enumerate(tar_waves):
+                    start = (i + j) * step
+                    sources[:, start:start + gen_size] += tar_wave * weight
+                    weights[start:start + gen_size] += weight
+        sources = sources[:, :n_sample] / weights[:n_sample] / self.params.compensation
+
+        elapsed = time() - start_time
+        print(f"demixed {n_sample} samples in {n_chunks} chunks (overlap={overlap}): {elapsed:.2f}s, {n_sample / elapsed:.0f} samples/s")
+        return sources
+
+    def predict(self, mix_waves, is_match_mix=False):
+        # [batch, 2, chunk_size] waves in, separated [batch, 2, chunk_size] waves out (tensor)
+        spek = self.params.stft(mix_waves.to(self.device))*self.params.compensation
         spek[:, :, :3, :] *= 0 
 
         if is_match_mix:
-            spec_pred = spek.cpu().numpy()
+            spec_pred = spek
+        elif self.denoise:
+            # +spec and -spec go through the network as one batch
+            pred = self.run(torch.cat([spek, -spek]))
+            spec_pred = pred[:len(spek)]*0.5-pred[len(spek):]*0.5
         else:
-            spec_pred = self.run(spek)*0.5-self.run(-spek)*0.5 if self.denoise else self.run(spek)
+            spec_pred = self.run(spek)
+
+        return self.params.istft(spec_pred.to(self.device))
+
+    def run_model(self, mix, is_ckpt=False, is_match_mix=False):
+        tar_waves = self.predict(mix, is_match_mix=is_match_mix)
 
         if is_ckpt:
-            return self.params.istft(spec_pred).cpu().detach().numpy()
+            return tar_waves.cpu().detach().numpy()
         else: 
-            return self.params.istft(torch.tensor(spec_pred).to(self.device)).cpu()[:,:,self.params.trim:-self.params.trim].transpose(0,1).reshape(2, -1).numpy()
+            return tar_waves.cpu()[:,:,self.params.trim:-self.params.trim].transpose(0,1).reshape(2, -1).numpy()
 
     def __del__(self):
         del self.ort
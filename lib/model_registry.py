@@ -0,0 +1,87 @@
+from collections import OrderedDict
+import os
+import threading
+
+import torch
+
+from webui.utils import gc_collect
+
+def get_model_size(obj):
+    # rough memory usage (bytes) of the tensors held by a model or a dict of models
+    if isinstance(obj, torch.nn.Module):
+        return sum(t.numel()*t.element_size() for t in list(obj.parameters())+list(obj.buffers()))
+    elif isinstance(obj, torch.Tensor):
+        return obj.numel()*obj.element_size()
+    elif isinstance(obj, dict):
+        return sum(get_model_size(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(get_model_size(v) for v in obj)
+    return 0
+
+def get_model_key(model_path, device, is_half):
+    # reloads the model when the file on disk changes
+    return (os.path.abspath(model_path), os.path.getmtime(model_path), str(device), "float16" if is_half else "float32")
+
+class ModelRegistry:
+    def __init__(self, max_memory=None):
+        self.max_memory = max_memory # bytes, None means unbounded
+        self.models = OrderedDict()
+        self.sizes = {}
+        self.pinned = set()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"ModelRegistry(models={len(self.models)}, memory={self.memory_usage/1024**2:.1f}MB/{self.max_memory/1024**2 if self.max_memory else 'inf'}MB, hits={self.hits}, misses={self.misses})"
+
+    def __contains__(self, key):
+        return key in self.models
+
+    @property
+    def memory_usage(self):
+        return sum(self.sizes.values())
+
+    def get(self, key, loader, pinned=False):
+        # returns the cached model or loads it with loader()
+        with self.lock:
+            if key in self.models:
+                self.hits += 1
+                self.models.move_to_end(key)
+                return self.models[key]
+
+            self.misses += 1
+            model = loader()
+            self.models[key] = model
+            self.sizes[key] = get_model_size(model)
+            if pinned: self.pinned.add(key)
+            self.evict()
+            return model
+
+    def evict(self, max_memory=None):
+        # drops least recently used models until the registry fits in memory
+        max_memory = self.max_memory if max_memory is None else max_memory
+        if max_memory is None: return
+
+        with self.lock:
+            evicted = False
+            for key in list(self.models.keys()):
+                if self.memory_usage <= max_memory or len(self.models) <= 1: break
+                if key in self.pinned or key == next(reversed(self.models)): continue # never evict the model that was just requested
+                print(f"evicting {key} from model registry")
+                self.remove(key)
+                evicted = True
+            if evicted: gc_collect()
+
+    def remove(self, key):
+        with self.lock:
+            self.pinned.discard(key)
+            self.sizes.pop(key, None)
+            return self.models.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.sizes.clear()
+            self.pinned.clear()
+        gc_collect()
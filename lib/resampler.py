@@ -0,0 +1,57 @@
+from functools import lru_cache
+from math import gcd
+
+import numpy as np
+from scipy import signal
+
+try:
+    import soxr
+except ImportError:
+    soxr = None
+
+RESAMPLE_BACKENDS = ["soxr", "scipy", "librosa"]
+RESAMPLE_QUALITY = { # (filter half length in zero crossings, kaiser beta) for the scipy backend
+    "low": (10, 5.0),
+    "medium": (16, 7.0),
+    "high": (32, 8.6),
+}
+SOXR_QUALITY = {"low": "LQ", "medium": "MQ", "high": "HQ"}
+RES_TYPE_QUALITY = { # librosa/resampy res_type names used by the uvr5 model params
+    "kaiser_fast": "low", "sinc_fastest": "low", "linear": "low", "zero_order_hold": "low", "polyphase": "low",
+    "sinc_medium": "medium", "soxr_mq": "medium", "fft": "medium", "scipy": "medium",
+    "kaiser_best": "high", "sinc_best": "high", "soxr_hq": "high", "soxr_vhq": "high",
+}
+
+def get_default_backend():
+    return "soxr" if soxr is not None else "scipy"
+
+@lru_cache(maxsize=32)
+def get_resample_filter(orig_sr, target_sr, quality="high"):
+    # designing the polyphase filter is the expensive part for ratios like 44100->48000, so keep it around
+    g = gcd(int(orig_sr), int(target_sr))
+    up, down = int(target_sr) // g, int(orig_sr) // g
+    zero_crossings, beta = RESAMPLE_QUALITY[quality]
+    max_rate = max(up, down)
+    h = signal.firwin(2 * zero_crossings * max_rate + 1, 1. / max_rate, window=("kaiser", beta)).astype(np.float32)
+    h.setflags(write=False)
+    return up, down, h
+
+def resample(audio, orig_sr, target_sr, axis=-1, quality="high", backend=None, res_type=None):
+    # float32 in, float32 out (no float64 round trip)
+    if res_type is not None: quality = RES_TYPE_QUALITY.get(res_type, quality)
+    if res_type == "polyphase": backend = backend or "scipy" # same filter librosa designs for polyphase
+    audio = np.asarray(audio, dtype=np.float32)
+    if int(orig_sr) == int(target_sr): return audio
+    backend = backend or get_default_backend()
+
+    if backend == "soxr" and soxr is not None and audio.ndim <= 2:
+        # soxr wants (frames, channels)
+        x = np.moveaxis(audio, axis, 0) if audio.ndim > 1 else audio
+        y = soxr.resample(np.ascontiguousarray(x), orig_sr, target_sr, quality=SOXR_QUALITY[quality])
+        return np.moveaxis(y, 0, axis) if audio.ndim > 1 else y
+    elif backend == "librosa":
+        import librosa
+        return librosa.resample(audio, orig_sr=orig_sr, target_sr=target_sr, res_type=res_type or "kaiser_best", axis=axis).astype(np.float32)
+
+    up, down, h = get_resample_filter(orig_sr, target_sr, quality)
+    return signal.resample_poly(audio, up, down, axis=axis, window=h)
@@ -1,3 +1,4 @@
+from multiprocessing.pool import ThreadPool
 import torch, numpy as np, pdb
 import torch.nn as nn
 import torch.nn.functional as F
@@ -557,11 +558,15 @@ class MelSpectrogram(torch.nn.Module):
 
 
 class RMVPE:
-    def __init__(self, model_path, is_half, onnx=False, device=None):
+    def __init__(self, model_path, is_half, onnx=False, device=None, decode_on_device=False, chunk_size=None, chunk_overlap=128, num_threads=1):
         self.resample_kernel = {}
         self.resample_kernel = {}
         self.is_half = is_half
         self.onnx = onnx
+        self.decode_on_device = decode_on_device # skips the host copy of hidden before decoding
+        self.chunk_size = chunk_size # frames per window (100 frames/s), None runs the whole audio at once
+        self.chunk_overlap = chunk_overlap
+        self.num_threads = num_threads
         if device is None:
             device = "cuda" if torch.cuda.is_available() else "cpu"
         self.device = device
@@ -606,17 +611,25 @@ class RMVPE:
             return hidden[:, :n_frames]
 
     def decode(self, hidden, thred=0.03):
-        cents_pred = self.to_local_average_cents(hidden, thred=thred)
+        if isinstance(hidden, torch.Tensor):
+            cents_pred = self.to_local_average_cents_torch(hidden, thred=thred).cpu().numpy()
+        else:
+            cents_pred = self.to_local_average_cents(hidden, thred=thred)
         f0 = 10 * (2 ** (cents_pred / 1200))
         f0[f0 == 10] = 0
         # f0 = np.array([10 * (2 ** (cent_pred / 1200)) if cent_pred else 0 for cent_pred in cents_pred])
         return f0
 
     def infer_from_audio(self, audio, thred=0.03):
+        # short clips take the one-shot path, chunking would only add the overlap recompute
+        if self.chunk_size and audio.shape[0] // self.mel_extractor.hop_length + 1 > self.chunk_size + 2 * self.chunk_overlap:
+            return self.infer_from_audio_chunked(audio, thred=thred)
         if self.onnx == False:
             audio = torch.from_numpy(audio).float().to(self.device).unsqueeze(0)
             mel = self.mel_extractor(audio, center=True)
             hidden = self.mel2hidden(mel)
+            if self.decode_on_device:
+                return self.decode(hidden.squeeze(0), thred=thred)
             hidden = hidden.squeeze(0).cpu().numpy()
             if self.is_half == True:
                 hidden = hidden.astype("float32")
@@ -648,38 +661,71 @@ class RMVPE:
             return f0
     
     def infer_from_audio_with_pitch(self, audio, thred=0.03, f0_min=50, f0_max=1100):
-        audio = torch.from_numpy(audio).float().to(self.device).unsqueeze(0)
-        mel = self.mel_extractor(audio, center=True)
-        hidden = self.mel2hidden(mel)
-        hidden = hidden.squeeze(0).cpu().numpy()
-        if self.is_half == True:
-            hidden = hidden.astype("float32")
-        f0 = self.decode(hidden, thred=thred)
+        f0 = self.infer_from_audio(audio, thred=thred)
         f0[(f0 < f0_min) | (f0 > f0_max)] = 0  
         return f0
 
+    def infer_from_audio_chunked(self, audio, thred=0.03, chunk_size=None, chunk_overlap=None, num_threads=None):
+        # runs the network on overlapping windows of chunk_size frames so memory doesn't grow with the audio length,
+        # each window sees chunk_overlap extra frames on both sides for the convs/BiGRU which are then thrown away
+        chunk_size = chunk_size if chunk_size else self.chunk_size
+        chunk_overlap = self.chunk_overlap if chunk_overlap is None else chunk_overlap
+        num_threads = num_threads if num_threads else self.num_threads
+        hop = self.mel_extractor.hop_length
+        n_frames = audio.shape[0] // hop + 1 # same as mel with center=True
+
+        def _get_f0(start):
+            end = min(start + chunk_size, n_frames)
+            ctx_start, ctx_end = max(start - chunk_overlap, 0), min(end + chunk_overlap, n_frames)
+            # frame i of this slice is centered on the same sample as frame ctx_start+i of the full audio
+            x = torch.from_numpy(audio[ctx_start * hop : (ctx_end - 1) * hop + 1]).float().to(self.device).unsqueeze(0)
+            with torch.no_grad():
+                mel = self.mel_extractor(x, center=True)
+                hidden = self.mel2hidden(mel)[0, start - ctx_start : end - ctx_start]
+            if isinstance(hidden, torch.Tensor):
+                if self.decode_on_device: return self.decode(hidden, thred=thred)
+                hidden = hidden.cpu().numpy()
+            return self.decode(hidden.astype("float32"), thred=thred)
+
+        # builds the lazily created stft before the threads share it
+        self.mel_extractor(torch.zeros(1, hop * 8, device=self.device), center=True)
+        starts = range(0, n_frames, chunk_size)
+        if num_threads > 1:
+            with ThreadPool(num_threads) as pool:
+                f0 = pool.map(_get_f0, starts)
+        else:
+            f0 = [_get_f0(start) for start in starts]
+        return np.concatenate(f0)
+
     def to_local_average_cents(self, salience, thred=0.05):
-        # t0 = ttime()
         center = np.argmax(salience, axis=1)  # 帧长#index
         salience = np.pad(salience, ((0, 0), (4, 4)))  # 帧长,368
-        # t1 = ttime()
         center += 4
-        todo_salience = []
-        todo_cents_mapping = []
-        starts = center - 4
-        ends = center + 5
-        for idx in range(salience.shape[0]):
-            todo_salience.append(salience[:, starts[idx] : ends[idx]][idx])
-            todo_cents_mapping.append(self.cents_mapping[starts[idx] : ends[idx]])
-        # t2 = ttime()
-        todo_salience = np.array(todo_salience)  # 帧长，9
-        todo_cents_mapping = np.array(todo_cents_mapping)  # 帧长，9
+        # gather the 9 bins around each peak for every frame at once
+        idx = center[:, None] + np.arange(-4, 5)  # 帧长，9
+        todo_salience = np.take_along_axis(salience, idx, axis=1)  # 帧长，9
+        todo_cents_mapping = self.cents_mapping[idx]  # 帧长，9
         product_sum = np.sum(todo_salience * todo_cents_mapping, 1)
         weight_sum = np.sum(todo_salience, 1)  # 帧长
         devided = product_sum / weight_sum  # 帧长
-        # t3 = ttime()
         maxx = np.max(salience, axis=1)  # 帧长
         devided[maxx <= thred] = 0
-        # t4 = ttime()
-        # print("decode:%s\t%s\t%s\t%s" % (t1 - t0, t2 - t1, t3 - t2, t4 - t3))
-        return devided
\ No newline at end of file
+        return devided
+
+    def to_local_average_cents_torch(self, salience, thred=0.05):
+        # same as to_local_average_cents but stays on salience.device
+        salience = salience.float()
+        if not hasattr(self, "cents_mapping_torch") or self.cents_mapping_torch.device != salience.device:
+            self.cents_mapping_torch = torch.from_numpy(self.cents_mapping).float().to(salience.device)
+        center = torch.argmax(salience, dim=1)
+        salience = F.pad(salience, (4, 4))
+        center += 4
+        idx = center[:, None] + torch.arange(-4, 5, device=salience.device)
+        todo_salience = torch.gather(salience, 1, idx)
+        todo_cents_mapping = self.cents_mapping_torch[idx]
+        product_sum = torch.sum(todo_salience * todo_cents_mapping, 1)
+        weight_sum = torch.sum(todo_salience, 1)
+        devided = product_sum / weight_sum
+        maxx = torch.max(salience, dim=1).values
+        devided[maxx <= thred] = 0
+        return devided
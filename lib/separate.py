@@ -1,6 +1,6 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
-from lib.uvr5_pack.demucs.apply import apply_model, demucs_segments
+from lib.uvr5_pack.demucs.apply import DemucsProcessRunner, apply_model, demucs_segments
 from lib.uvr5_pack.demucs.hdemucs import HDemucs
 from lib.uvr5_pack.demucs.model_v2 import auto_load_demucs_model_v2
 from lib.uvr5_pack.demucs.pretrained import get_model as _gm
@@ -594,48 +594,59 @@ class SeperateDemucs(SeperateAttributes):
         processed = {}
 
         set_progress_bar = None if self.is_chunk_demucs else self.set_progress_bar
+        # without a gpu the segments/shifts of v3+ models are spread over all cores, the workers live for the whole demix
+        runner = DemucsProcessRunner(self.demucs) if self.demucs_version not in [DEMUCS_V1, DEMUCS_V2] and self.device.type == 'cpu' and (os.cpu_count() or 1) > 1 else None
 
-        for nmix in mix:
-            self.progress_value += 1
-            self.set_progress_bar(0.1, (0.8/len(mix)*self.progress_value)) if self.is_chunk_demucs else None
-            cmix = mix[nmix]
-            cmix = torch.tensor(cmix, dtype=torch.float32)
-            ref = cmix.mean(0)        
-            cmix = (cmix - ref.mean()) / ref.std()
-            mix_infer = cmix 
+        try:
+            for nmix in mix:
+                self.progress_value += 1
+                self.set_progress_bar(0.1, (0.8/len(mix)*self.progress_value)) if self.is_chunk_demucs else None
+                cmix = mix[nmix]
+                cmix = torch.tensor(cmix, dtype=torch.float32)
+                ref = cmix.mean(0)        
+                cmix = (cmix - ref.mean()) / ref.std()
+                mix_infer = cmix 
             
-            with torch.no_grad():
-                if self.demucs_version == DEMUCS_V1:
-                    sources = apply_model_v1(self.demucs, 
-                                                mix_infer.to(self.device), 
-                                                self.shifts, 
-                                                self.is_split_mode,
-                                                set_progress_bar=set_progress_bar)
-                elif self.demucs_version == DEMUCS_V2:
-                    sources = apply_model_v2(self.demucs, 
-                                                mix_infer.to(self.device), 
+                with torch.no_grad():
+                    if self.demucs_version == DEMUCS_V1:
+                        sources = apply_model_v1(self.demucs, 
+                                                    mix_infer.to(self.device), 
+                                                    self.shifts, 
+                                                    self.is_split_mode,
+                                                    set_progress_bar=set_progress_bar)
+                    elif self.demucs_version == DEMUCS_V2:
+                        sources = apply_model_v2(self.demucs, 
+                                                    mix_infer.to(self.device), 
+                                                    self.shifts,
+                                                    self.is_split_mode,
+                                                    self.overlap,
+                                                    set_progress_bar=set_progress_bar)
+                    elif runner is not None:
+                        sources = runner(mix_infer[None], 
+                                         self.shifts,
+                                         self.is_split_mode,
+                                         self.overlap,
+                                         set_progress_bar=set_progress_bar)[0]
+                    else:
+                        sources = apply_model(self.demucs, 
+                                                mix_infer[None], 
                                                 self.shifts,
                                                 self.is_split_mode,
                                                 self.overlap,
-                                                set_progress_bar=set_progress_bar)
-                else:
-                    sources = apply_model(self.demucs, 
-                                            mix_infer[None], 
-                                            self.shifts,
-                                            self.is_split_mode,
-                                            self.overlap,
-                                            static_shifts=1 if self.shifts == 0 else self.shifts,
-                                            set_progress_bar=set_progress_bar,
-                                            device=self.device)[0]
+                                                static_shifts=1 if self.shifts == 0 else self.shifts,
+                                                set_progress_bar=set_progress_bar,
+                                                device=self.device)[0]
             
-            sources = (sources * ref.std() + ref.mean()).cpu().numpy()
-            sources[[0,1]] = sources[[1,0]]
-            start = 0 if nmix == 0 else self.margin_demucs
-            end = None if nmix == list(mix.keys())[::-1][0] else -self.margin_demucs
-            if self.margin_demucs == 0:
-                end = None
-            processed[nmix] = sources[:,:,start:end].copy()
-            sources = list(processed.values())
+                sources = (sources * ref.std() + ref.mean()).cpu().numpy()
+                sources[[0,1]] = sources[[1,0]]
+                start = 0 if nmix == 0 else self.margin_demucs
+                end = None if nmix == list(mix.keys())[::-1][0] else -self.margin_demucs
+                if self.margin_demucs == 0:
+                    end = None
+                processed[nmix] = sources[:,:,start:end].copy()
+                sources = list(processed.values())
+        finally: # the workers and their shared memory go away even if a segment fails
+            if runner is not None: runner.close()
         sources = np.concatenate(sources, axis=-1)
                         
         return sources
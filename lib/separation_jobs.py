@@ -0,0 +1,263 @@
+import hashlib
+import importlib
+import json
+import os
+import queue
+import shutil
+import threading
+import traceback
+from time import time
+
+import numpy as np
+
+from lib.stem_cache import get_audio_hash
+from webui.downloader import BASE_CACHE_DIR
+from webui.utils import save_npy
+
+JOBS_DIR = os.path.join(BASE_CACHE_DIR,"jobs")
+PROGRESS_INTERVAL = .5 # seconds between progress file writes
+JOB_QUEUE = None
+JOB_QUEUE_LOCK = threading.Lock()
+
+def get_stage_names(model_paths, preprocess_models=[]):
+    # one work dir per model, in the order split_audio runs them
+    return [f"{i:02d}_{os.path.splitext(os.path.basename(model_path))[0]}" for i, model_path in enumerate(list(preprocess_models)+list(model_paths))]
+
+def read_json(path):
+    try:
+        with open(path) as f: return json.load(f)
+    except (FileNotFoundError, OSError, ValueError):
+        return None
+
+def write_json(path, data):
+    # same temp file + rename as save_npy so pollers never read a partial file
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file,"w") as f: json.dump(data,f,default=str)
+    os.replace(tmp_file,path)
+
+class ChunkCheckpoint:
+    """
+    Per-chunk results of one model pass: <stage_dir>/<name>/<index>.npy and a progress.json next to them.
+
+    name should encode the chunking (batch size, overlap) so a rerun with other settings doesn't pick up chunks of a different size.
+    Progress is a file rather than shared state since the models may run in ensemble worker processes.
+    """
+
+    def __init__(self, stage_dir, name):
+        self.dir = os.path.join(stage_dir, name)
+        self.last_update = 0
+
+    def __repr__(self):
+        return f"ChunkCheckpoint(dir={self.dir})"
+
+    def get_path(self, index):
+        return os.path.join(self.dir, f"{index:06d}.npy")
+
+    def get(self, index):
+        try:
+            return np.load(self.get_path(index), allow_pickle=False)
+        except (FileNotFoundError, OSError, ValueError): # missing or left over from a crash mid write
+            return None
+
+    def put(self, index, data):
+        save_npy(self.get_path(index), np.asarray(data))
+
+    def load_or_run(self, index, func):
+        # finished chunks are loaded, the rest computed and saved before moving on
+        data = self.get(index)
+        if data is None:
+            data = func()
+            self.put(index, data)
+        return data
+
+    def update(self, done, total):
+        if done < total and time() - self.last_update < PROGRESS_INTERVAL: return
+        write_json(os.path.join(self.dir, "progress.json"), {"done": done, "total": total})
+        self.last_update = time()
+
+def get_checkpoint(stage_dir, name):
+    # models call this with their checkpoint_dir, None disables checkpointing
+    return None if stage_dir is None else ChunkCheckpoint(stage_dir, name)
+
+def finish_stage(stage_dir):
+    if stage_dir is not None: write_json(os.path.join(stage_dir, "done.json"), {"time": time()})
+
+def get_stage_progress(stage_dir):
+    # fraction of chunks done over every pass the model has started so far
+    if read_json(os.path.join(stage_dir, "done.json")) is not None: return 1.
+    done = total = 0
+    if os.path.isdir(stage_dir):
+        for entry in os.scandir(stage_dir):
+            progress = read_json(os.path.join(entry.path, "progress.json")) if entry.is_dir() else None
+            if progress is None: continue
+            done += progress["done"]
+            total += progress["total"]
+    return done / total if total else 0.
+
+def get_job_id(task, kwargs):
+    settings = dict(task=task, **kwargs)
+    if "audio_path" in kwargs: settings["audio"] = get_audio_hash(kwargs["audio_path"]) # a changed file is a new job
+    return hashlib.md5(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+def get_task(task):
+    # "module:function", stored as a string so crashed jobs can be restarted from their job.json
+    module, func = task.split(":")
+    return getattr(importlib.import_module(module), func)
+
+class SeparationJob:
+    def __init__(self, job_id, task, kwargs, jobs_dir=JOBS_DIR):
+        self.id = job_id
+        self.task = task
+        self.kwargs = kwargs
+        self.work_dir = os.path.join(jobs_dir, job_id)
+        self.stages = get_stage_names(kwargs.get("model_paths",[]), kwargs.get("preprocess_models",[]))
+        self.state = "queued"
+        self.error = None
+        self.result = None
+        self.start_time = None
+        self.start_progress = 0.
+        self.end_time = None
+        self.finished = threading.Event()
+
+    def __repr__(self):
+        return f"SeparationJob(id={self.id}, state={self.state}, progress={self.progress:.1%}, eta={self.eta})"
+
+    def save(self):
+        write_json(os.path.join(self.work_dir, "job.json"), {"task": self.task, "kwargs": self.kwargs, "state": self.state, "error": self.error})
+
+    @property
+    def progress(self):
+        if self.state == "done": return 1.
+        if len(self.stages) == 0: return 0.
+        return sum(get_stage_progress(os.path.join(self.work_dir, stage)) for stage in self.stages) / len(self.stages)
+
+    @property
+    def eta(self):
+        # seconds left at the rate of this run, chunks resumed from a previous run don't count towards the rate
+        if self.state == "done": return 0.
+        if self.state != "running": return None
+        progress = self.progress
+        if progress <= self.start_progress: return None
+        elapsed = time() - self.start_time
+        return elapsed / (progress - self.start_progress) * (1 - progress)
+
+    def run(self):
+        self.state = "running"
+        self.start_time = time()
+        self.start_progress = self.progress
+        self.save()
+        try:
+            self.result = get_task(self.task)(work_dir=self.work_dir, **self.kwargs)
+            self.state = "done"
+            shutil.rmtree(self.work_dir, ignore_errors=True) # chunks are only kept for resuming
+        except Exception as e:
+            traceback.print_exc()
+            self.state = "failed"
+            self.error = str(e)
+            self.save() # finished chunks stay, resubmitting resumes after them
+        finally:
+            self.end_time = time()
+            self.finished.set()
+        print(f"{self} finished in {self.end_time-self.start_time:.1f}s")
+        return self.result
+
+    def wait(self, timeout=None):
+        self.finished.wait(timeout)
+        if self.state == "failed": raise RuntimeError(self.error)
+        return self.result
+
+class JobQueue:
+    """
+    Runs separation jobs one at a time in a background thread so callers (e.g. streamlit pages) can poll job.progress and job.eta.
+
+    Every job works in <jobs_dir>/<job id>, where the models checkpoint their chunks. A job that failed, or was running when the
+    process died, starts again from its last finished chunk when it is resubmitted (or passed to resume()).
+    Finished jobs are kept until their result is collected.
+    """
+
+    def __init__(self, jobs_dir=JOBS_DIR):
+        self.jobs_dir = jobs_dir
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def __repr__(self):
+        return f"JobQueue(dir={self.jobs_dir}, jobs={len(self.jobs)}, queued={self.queue.qsize()})"
+
+    def submit(self, task="uvr5_cli:split_audio", **kwargs):
+        # kwargs must be json serializable, the same task and arguments always map to the same job
+        job_id = get_job_id(task, kwargs)
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.state in ["queued","running","done"]: return job
+            job = self.jobs[job_id] = SeparationJob(job_id, task, kwargs, self.jobs_dir)
+            job.save()
+            self.queue.put(job)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.worker, name="separation_jobs", daemon=True)
+                self.thread.start()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def worker(self):
+        while True:
+            try:
+                job = self.queue.get(timeout=1)
+            except queue.Empty:
+                with self.lock:
+                    if self.queue.empty():
+                        self.thread = None
+                        return
+                continue
+            job.run()
+
+    def collect(self, job_id):
+        # hands a finished (done or failed) job to the caller and forgets it, failed jobs keep their chunks for resume()
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.state not in ["done","failed"]: return None
+            return self.jobs.pop(job_id)
+
+    def get_interrupted(self):
+        # [(job id, job.json)] of jobs that failed or were cut short by a restart, nothing runs until resume() is called
+        jobs = []
+        if not os.path.isdir(self.jobs_dir): return jobs
+        for entry in os.scandir(self.jobs_dir):
+            if entry.name in self.jobs: continue
+            data = read_json(os.path.join(entry.path, "job.json"))
+            if data is not None and data["state"] in ["queued","running","failed"]: jobs.append((entry.name, data))
+        return jobs
+
+    def resume(self, job_id):
+        # resubmits an interrupted job, it starts again after its last finished chunk
+        data = read_json(os.path.join(self.jobs_dir, job_id, "job.json"))
+        if data is None: return None
+        try:
+            job = self.submit(data["task"], **data["kwargs"])
+        except (FileNotFoundError, OSError) as e: # the song is gone
+            print(f"failed to resume job {job_id}: {e}")
+            self.remove(job_id)
+            return None
+        if job.id != job_id: self.remove(job_id) # the song changed since, its chunks are useless
+        print(f"resumed {job}")
+        return job
+
+    def remove(self, job_id):
+        # drops a job and its checkpoints, e.g. a failed job that shouldn't be resumed
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job.state in ["queued","running"]: return False
+            self.jobs.pop(job_id, None)
+        shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors=True)
+        return True
+
+def get_job_queue():
+    # one queue per process, separations compete for the same cpu/gpu
+    global JOB_QUEUE
+    with JOB_QUEUE_LOCK:
+        if JOB_QUEUE is None: JOB_QUEUE = JobQueue()
+    return JOB_QUEUE
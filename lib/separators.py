@@ -2,11 +2,14 @@ import hashlib
 import json
 from multiprocessing.pool import ThreadPool
 import os
+from time import time
 from types import SimpleNamespace
 import numpy as np
 import torch
 from tqdm import tqdm
 from lib.mdx import MDXModel
+from lib.resampler import resample
+from lib.separation_jobs import get_checkpoint
 from lib.uvr5_pack.constants import MDX_NET_FREQ_CUT
 from lib.uvr5_pack.vr_network.model_param_init import ModelParameters
 from lib.uvr5_pack.vr_network.nets_new import CascadedNet
@@ -15,20 +18,24 @@ from webui.audio import remix_audio
 import librosa
 from lib.uvr5_pack import spec_utils
 class UVR5Base:
+    model_params = "lib/uvr5_pack/vr_network/modelparams/4band_v2.json"
+    output_int16 = True # float32 stems when False (e.g. between preprocess stages)
     
-    def __init__(self, agg, model_path, device, is_half,**kwargs):
+    def __init__(self, agg, model_path, device, is_half, vr_batch_size=4, checkpoint_dir=None, **kwargs):
         self.model_path = model_path
         self.device = device
+        self.checkpoint_dir = checkpoint_dir # finished windows are kept here (see lib.separation_jobs)
         self.data = {
             # Processing Options
             "postprocess": False,
             "tta": False,
             # Constants
             "window_size": 512,
+            "batch_size": vr_batch_size, # windows per model call
             "agg": agg,
             "high_end_process": "mirroring",
         }
-        mp = ModelParameters("lib/uvr5_pack/vr_network/modelparams/4band_v2.json")
+        mp = ModelParameters(self.model_params)
         model = CascadedASPPNet(mp.param["bins"] * 2)
         cpk = torch.load(model_path, map_location=self.device)
         model.load_state_dict(cpk)
@@ -74,29 +81,40 @@ class UVR5Base:
         model = self.model
 
         def _execute(
-            X_mag_pad, roi_size, n_window, device, model, aggressiveness, is_half=True
+            X_mag_pads, roi_size, n_windows, device, model, aggressiveness, is_half=True
         ):
-            model.eval()
-            with torch.no_grad():
-                preds = []
-
-                for i in tqdm(range(n_window)):
+            # windows of every pass (normal + tta) share one preallocated batch buffer
+            window_size = data["window_size"]
+            windows = [(p, i) for p, n_window in enumerate(n_windows) for i in range(n_window)]
+            batch_size = max(min(int(data["batch_size"]), len(windows)), 1)
+            pin_memory = "cuda" in str(device) and torch.cuda.is_available()
+            X_batch = torch.empty(
+                (batch_size, *X_mag_pads[0].shape[:2], window_size),
+                dtype=torch.float16 if is_half else torch.float32, pin_memory=pin_memory)
+            preds = [None] * len(X_mag_pads)
+            checkpoint = get_checkpoint(self.checkpoint_dir, f"windows_{batch_size}_{len(X_mag_pads)}")
+
+            def predict(batch):
+                for j, (p, i) in enumerate(batch):
                     start = i * roi_size
-                    X_mag_window = X_mag_pad[
-                        None, :, :, start : start + data["window_size"]
-                    ]
-                    X_mag_window = torch.from_numpy(X_mag_window)
-                    if is_half:
-                        X_mag_window = X_mag_window.half()
-                    X_mag_window = X_mag_window.to(device)
-
-                    pred = model.predict(X_mag_window, aggressiveness)
+                    X_batch[j].copy_(torch.from_numpy(X_mag_pads[p][:, :, start : start + window_size]))
 
-                    pred = pred.detach().cpu().numpy()
-                    preds.append(pred[0])
+                pred = model.predict(X_batch[:len(batch)].to(device, non_blocking=pin_memory), aggressiveness)
+                return pred.detach().float().cpu().numpy()
 
-                pred = np.concatenate(preds, axis=2)
-            return pred
+            model.eval()
+            with torch.no_grad():
+                for b in tqdm(range(0, len(windows), batch_size)):
+                    batch = windows[b : b + batch_size]
+                    if checkpoint is None: pred = predict(batch)
+                    else:
+                        pred = checkpoint.load_or_run(b // batch_size, lambda: predict(batch))
+                        checkpoint.update(min(b + batch_size, len(windows)), len(windows))
+
+                    for j, (p, i) in enumerate(batch):
+                        if preds[p] is None: preds[p] = np.empty((*pred.shape[1:3], n_windows[p] * roi_size), dtype=np.float32)
+                        preds[p][:, :, i * roi_size : (i + 1) * roi_size] = pred[j]
+            return preds
 
         def preprocess(X_spec):
             X_mag = np.abs(X_spec)
@@ -113,28 +131,25 @@ class UVR5Base:
         pad_l, pad_r, roi_size = spec_utils.make_padding(n_frame, data["window_size"], model.offset)
         n_window = int(np.ceil(n_frame / roi_size))
 
-        X_mag_pad = np.pad(X_mag_pre, ((0, 0), (0, 0), (pad_l, pad_r)), mode="constant")
+        X_mag_pads = [np.pad(X_mag_pre, ((0, 0), (0, 0), (pad_l, pad_r)), mode="constant")]
+        n_windows = [n_window]
+
+        if data["tta"]:
+            # same windows shifted by half a roi, run in the same batches as the normal pass
+            X_mag_pads.append(np.pad(X_mag_pre, ((0, 0), (0, 0), (pad_l + roi_size // 2, pad_r + roi_size // 2)), mode="constant"))
+            n_windows.append(n_window + 1)
 
         if list(model.state_dict().values())[0].dtype == torch.float16:
             is_half = True
         else:
             is_half = False
-        pred = _execute(
-            X_mag_pad, roi_size, n_window, device, model, aggressiveness, is_half
+        preds = _execute(
+            X_mag_pads, roi_size, n_windows, device, model, aggressiveness, is_half
         )
-        pred = pred[:, :, :n_frame]
+        pred = preds[0][:, :, :n_frame]
 
         if data["tta"]:
-            pad_l += roi_size // 2
-            pad_r += roi_size // 2
-            n_window += 1
-
-            X_mag_pad = np.pad(X_mag_pre, ((0, 0), (0, 0), (pad_l, pad_r)), mode="constant")
-
-            pred_tta = _execute(
-                X_mag_pad, roi_size, n_window, device, model, aggressiveness, is_half
-            )
-            pred_tta = pred_tta[:, :, roi_size // 2 :]
+            pred_tta = preds[1][:, :, roi_size // 2 :]
             pred_tta = pred_tta[:, :, :n_frame]
 
             return (pred + pred_tta) * 0.5 * coef, X_mag, np.exp(1.0j * X_phase)
@@ -152,7 +167,7 @@ class UVR5Base:
         else:
             wav_vocals = spec_utils.cmb_spectrogram_to_wave(v_spec_m, self.mp)
         print(f"vocals done: {wav_vocals.shape}")
-        return_dict["vocals"] = remix_audio((wav_vocals,return_dict["sr"]),norm=True,to_int16=True,to_mono=True,axis=0)
+        return_dict["vocals"] = remix_audio((wav_vocals,return_dict["sr"]),norm=True,to_int16=self.output_int16,to_mono=True,axis=0)
         return return_dict["vocals"]
     
     def process_instrumental(self,y_spec_m,input_high_end,input_high_end_h,return_dict={}):
@@ -166,7 +181,7 @@ class UVR5Base:
         else:
             wav_instrument = spec_utils.cmb_spectrogram_to_wave(y_spec_m, self.mp)
         print(f"instruments done: {wav_instrument.shape}")
-        return_dict["instrumentals"] = remix_audio((wav_instrument,return_dict["sr"]),norm=True,to_int16=True,to_mono=True,axis=0)
+        return_dict["instrumentals"] = remix_audio((wav_instrument,return_dict["sr"]),norm=True,to_int16=self.output_int16,to_mono=True,axis=0)
         return return_dict["instrumentals"] 
     
     def process_audio(self,y_spec_m,v_spec_m,input_high_end,input_high_end_h):
@@ -180,43 +195,12 @@ class UVR5Base:
  
         return return_dict
 
-    def run_inference(self, music_file):
-        X_wave,  X_spec_s = {}, {}
-        bands_n = len(self.mp.param["band"])
-        # print(bands_n)
-        for d in range(bands_n, 0, -1):
-            bp = self.mp.param["band"][d]
-            if d == bands_n:  # high-end band
-                input_audio = librosa.core.load(music_file,sr=bp["sr"],res_type=bp["res_type"])
-                X_wave[d] = input_audio[0]
-                if X_wave[d].ndim == 1:
-                    X_wave[d] = np.asfortranarray([X_wave[d], X_wave[d]])
-            else:  # lower bands
-                X_wave[d] = librosa.core.resample(
-                    X_wave[d + 1],
-                    self.mp.param["band"][d + 1]["sr"],
-                    bp["sr"],
-                    res_type=bp["res_type"],
-                )
-            # Stft of wave source
-            X_spec_s[d] = spec_utils.wave_to_spectrogram_mt(
-                X_wave[d],
-                bp["hl"],
-                bp["n_fft"],
-                self.mp.param["mid_side"],
-                self.mp.param["mid_side_b2"],
-                self.mp.param["reverse"],
-            )
-            # pdb.set_trace()
-            if d == bands_n and self.data["high_end_process"] != "none":
-                input_high_end_h = (bp["n_fft"] // 2 - bp["crop_stop"]) + (
-                    self.mp.param["pre_filter_stop"] - self.mp.param["pre_filter_start"]
-                )
-                input_high_end = X_spec_s[d][
-                    :, bp["n_fft"] // 2 - input_high_end_h : bp["n_fft"] // 2, :
-                ]
+    def get_spectrogram(self, music_file):
+        return get_vr_spectrogram(self.mp, music_file, self.data["high_end_process"])
 
-        X_spec_m = spec_utils.combine_spectrograms(X_spec_s, self.mp)
+    def run_inference(self, music_file, spectrogram=None):
+        # spectrogram lets models that share the same band params reuse one decode + stft
+        X_spec_m, input_high_end, input_high_end_h, input_audio = self.get_spectrogram(music_file) if spectrogram is None else spectrogram
         aggresive_set = float(self.data["agg"] / 100)
         aggressiveness = {
             "value": aggresive_set,
@@ -244,19 +228,23 @@ class UVR5Base:
         return return_dict
 
 class UVR5New(UVR5Base):
-    def __init__(self, agg, model_path, device, is_half, dereverb, **kwargs):
+    model_params = "lib/uvr5_pack/vr_network/modelparams/4band_v3.json"
+
+    def __init__(self, agg, model_path, device, is_half, dereverb, vr_batch_size=4, checkpoint_dir=None, **kwargs):
         self.model_path = model_path
         self.device = device
+        self.checkpoint_dir = checkpoint_dir # finished windows are kept here (see lib.separation_jobs)
         self.data = {
             # Processing Options
             "postprocess": False,
             "tta": False,
             # Constants
             "window_size": 512,
+            "batch_size": vr_batch_size, # windows per model call
             "agg": agg,
             "high_end_process": "mirroring",
         }
-        mp = ModelParameters("lib/uvr5_pack/vr_network/modelparams/4band_v3.json")
+        mp = ModelParameters(self.model_params)
         nout = 64 if dereverb else 48
         model = CascadedNet(mp.param["bins"] * 2, nout)
         cpk = torch.load(model_path, map_location=self.device)
@@ -271,21 +259,27 @@ class UVR5New(UVR5Base):
         self.model = model
     
 class MDXNet:
-    def __init__(self, model_path, chunks=15,denoise=False,num_threads=1,device="cpu",**kwargs):
+    output_int16 = True
+
+    def __init__(self, model_path, chunks=15,denoise=False,num_threads=None,device="cpu",mdx_batch_size=4,mdx_overlap=None,mdx_denoise=False,checkpoint_dir=None,**kwargs):
 
         self.chunks = chunks
+        self.overlap = mdx_overlap # None keeps the margin based chunking, a ratio (e.g. .25) uses the windowed overlap-add demixer
+        self.checkpoint_dir = checkpoint_dir # finished chunks are kept here (see lib.separation_jobs)
         self.sr = 44100
         
         self.args = SimpleNamespace(**kwargs)
         self.denoise = denoise
-        self.num_threads = num_threads
+        self.mdx_denoise = mdx_denoise # runs every chunk as spec and -spec (one batch) and keeps half their difference, twice the compute
+        self.num_threads = num_threads # onnx intra op threads on cpu, None lets onnxruntime use every core
 
         self.device = device
 
         # self.mp = SimpleNamespace(param={"sr": self.margin})
         self.is_mdx_ckpt = "ckpt" in model_path
 
-        self.model = MDXModel(model_path, device=self.device,chunks=self.chunks,margin=self.sr)
+        self.model = MDXModel(model_path, device=self.device,chunks=self.chunks,margin=self.sr,denoise=self.mdx_denoise,
+                              mdx_batch_size=mdx_batch_size,num_threads=None if "cuda" in str(device) else self.num_threads)
 
     def __del__(self):
         del self.model
@@ -296,8 +290,8 @@ class MDXNet:
         vocals,instrumental = (secondary,primary) if "instrument" in self.model.params.stem_name.lower() else (primary,secondary)
         with ThreadPool(2) as pool:
             results = pool.starmap(remix_audio, [
-                ((instrumental,self.sr),target_sr,False,True,self.sr!=target_sr,True),
-                ((vocals,self.sr),target_sr,False,True,self.sr!=target_sr,True)
+                ((instrumental,self.sr),target_sr,False,self.output_int16,self.sr!=target_sr,True),
+                ((vocals,self.sr),target_sr,False,self.output_int16,self.sr!=target_sr,True)
             ])
 
         return_dict = {
@@ -310,11 +304,21 @@ class MDXNet:
     def run_inference(self, audio_path):
         
         mdx_net_cut = True if self.model.params.stem_name in MDX_NET_FREQ_CUT else False
-        mix, raw_mix, samplerate = prepare_mix(audio_path, self.model.chunks, self.model.margin, mdx_net_cut=mdx_net_cut)
-        wave_processed = self.model.demix_base(mix, is_ckpt=self.is_mdx_ckpt)[0]
+        if self.overlap is not None and not self.is_mdx_ckpt:
+            raw_mix, samplerate = load_mix(audio_path)
+            name = f"overlap_{self.overlap}_{self.model.mdx_batch_size}"
+            wave_processed = self.model.demix_overlap_add(raw_mix, overlap=self.overlap,
+                                                          checkpoint=get_checkpoint(self.checkpoint_dir, name))
+            raw_mix = self.model.demix_overlap_add(raw_mix, overlap=self.overlap, is_match_mix=True,
+                                                   checkpoint=get_checkpoint(self.checkpoint_dir, f"{name}_match_mix")) if mdx_net_cut else raw_mix
+        else:
+            mix, raw_mix, samplerate = prepare_mix(audio_path, self.model.chunks, self.model.margin, mdx_net_cut=mdx_net_cut)
+            name = f"slices_{self.model.chunks}"
+            wave_processed = self.model.demix_base(mix, is_ckpt=self.is_mdx_ckpt, checkpoint=get_checkpoint(self.checkpoint_dir, name))[0]
         
     
-        raw_mix = self.model.demix_base(raw_mix, is_match_mix=True)[0] if mdx_net_cut else raw_mix
+            raw_mix = self.model.demix_base(raw_mix, is_match_mix=True,
+                                            checkpoint=get_checkpoint(self.checkpoint_dir, f"{name}_match_mix"))[0] if mdx_net_cut else raw_mix
 
         return_dict = self.process_audio(primary=wave_processed,secondary=(raw_mix-wave_processed),target_sr=samplerate)
         return_dict["input_audio"] = (raw_mix, samplerate)
@@ -322,17 +326,62 @@ class MDXNet:
         return return_dict
 
     
-def prepare_mix(mix, chunk_set, margin_set, mdx_net_cut=False):
+def get_vr_spectrogram(mp, music_file, high_end_process="mirroring"):
+    # music_file is a path or an already decoded (audio, sr) tuple with [n] or [n, channels] audio
+    X_wave = {}
+    input_high_end_h = None
+    bands_n = len(mp.param["band"])
+    start = time()
+    for d in range(bands_n, 0, -1):
+        bp = mp.param["band"][d]
+        if d == bands_n:  # high-end band
+            if isinstance(music_file, tuple):
+                audio, sr = music_file
+                audio = np.asarray(audio, dtype=np.float32)
+                if audio.ndim > 1: audio = audio.mean(axis=-1) # same mono mix librosa.load would give
+                input_audio = (resample(audio, sr, bp["sr"], res_type=bp["res_type"]), bp["sr"])
+            else:
+                input_audio = librosa.core.load(music_file,sr=bp["sr"],res_type=bp["res_type"])
+            X_wave[d] = input_audio[0]
+            if X_wave[d].ndim == 1:
+                X_wave[d] = np.asfortranarray([X_wave[d], X_wave[d]])
+            if high_end_process != "none":
+                input_high_end_h = (bp["n_fft"] // 2 - bp["crop_stop"]) + (
+                    mp.param["pre_filter_stop"] - mp.param["pre_filter_start"]
+                )
+        else:  # lower bands
+            X_wave[d] = resample(
+                X_wave[d + 1],
+                mp.param["band"][d + 1]["sr"],
+                bp["sr"],
+                res_type=bp["res_type"],
+            )
+    resample_time = time() - start
+
+    # all bands and channels at once, straight into the combined spectrogram
+    X_spec_m, input_high_end, times = spec_utils.wave_to_spectrogram_mb(X_wave, mp, input_high_end_h)
+    print(f"spectrogram: resample {resample_time:.2f}s, stft per band: {', '.join(f'{d}: {t:.2f}s' for d, t in sorted(times.items()))}")
+    return X_spec_m, input_high_end, input_high_end_h, input_audio
 
+def load_mix(mix):
+    # [2, n] float32 at 44.1k from a path, a [n, channels] array or an ([n] or [n, channels], sr) tuple
     samplerate = 44100
 
-    if not isinstance(mix, np.ndarray):
+    if isinstance(mix, tuple):
+        mix, sr = mix
+        mix = resample(np.asarray(mix, dtype=np.float32).T, sr, samplerate)
+    elif not isinstance(mix, np.ndarray):
         mix, samplerate = librosa.load(mix, mono=False, sr=44100)
     else:
         mix = mix.T
 
     if mix.ndim == 1:
         mix = np.asfortranarray([mix,mix])
+    return mix, samplerate
+
+def prepare_mix(mix, chunk_set, margin_set, mdx_net_cut=False):
+
+    mix, samplerate = load_mix(mix)
 
     def get_segmented_mix(chunk_set=chunk_set):
         segmented_mix = {}
@@ -0,0 +1,161 @@
+from functools import lru_cache
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import soundfile as sf
+
+from lib.model_utils import get_hash
+from webui.downloader import BASE_CACHE_DIR
+
+CACHED_STEMS_DIR = os.path.join(BASE_CACHE_DIR,"stems")
+STEM_CACHE_MAX_SIZE = 4*1024**3 # bytes, oldest entries are evicted past this
+UNKEYED_ARGS = ["num_threads","mdx_batch_size","vr_batch_size","device","checkpoint_dir"] # only change speed, not the stems
+
+@lru_cache(maxsize=256)
+def hash_file(path, mtime, size):
+    # hash of the encoded bytes, so renamed or re-downloaded copies of a song share stems
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(path,"rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def get_audio_hash(audio):
+    # audio is a file path, an array or an (array, sr) tuple
+    if isinstance(audio,str):
+        stat = os.stat(audio)
+        return hash_file(os.path.abspath(audio), stat.st_mtime, stat.st_size)
+    audio_hash = hashlib.blake2b(digest_size=16)
+    if isinstance(audio,tuple):
+        audio, sr = audio
+        audio_hash.update(str(sr).encode())
+    audio_hash.update(np.ascontiguousarray(audio).view(np.uint8))
+    return audio_hash.hexdigest()
+
+@lru_cache(maxsize=64)
+def get_model_hash(model_path, mtime):
+    return get_hash(model_path)
+
+def get_stem_key(audio_hash, model_path, preprocess_models=[], **kwargs):
+    # stems depend on the input, the model weights, the preprocess chain before it and the separation settings
+    settings = {
+        "audio": audio_hash,
+        "model": get_model_hash(model_path, os.path.getmtime(model_path)),
+        "preprocess": [get_model_hash(path, os.path.getmtime(path)) for path in preprocess_models],
+        **{k: v for k, v in kwargs.items() if k not in UNKEYED_ARGS}
+    }
+    return hashlib.md5(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+class StemCache:
+    """
+    Content addressed store for separated stems: <cache_dir>/<key[:2]>/<key>/<stem>.flac
+
+    int16 stems are stored as 16 bit FLAC (lossless, about half the size of wav), anything else as npy.
+    Entries are written to a temp dir and renamed into place, and the least recently used entries are
+    removed once the store grows past max_size.
+    """
+
+    def __init__(self, cache_dir=CACHED_STEMS_DIR, max_size=STEM_CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size # bytes, None means unbounded
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"StemCache(dir={self.cache_dir}, max_size={self.max_size/1024**3 if self.max_size else 'inf'}GB, hits={self.hits}, misses={self.misses})"
+
+    def get_entry(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get_path(self, key, name):
+        # path of a cached stem file (e.g. to feed it to the next model), None if it isn't cached
+        entry = self.get_entry(key)
+        for ext in ["flac","npy"]:
+            path = os.path.join(entry, f"{name}.{ext}")
+            if os.path.isfile(path): return path
+        return None
+
+    def get(self, key, names=["vocals","instrumentals"]):
+        # returns {name: (audio, sr)} or None
+        entry = self.get_entry(key)
+        try:
+            stems = {}
+            for name in names:
+                path = self.get_path(key, name)
+                if path is None: raise FileNotFoundError(name)
+                if path.endswith(".npy"):
+                    with open(os.path.join(entry, f"{name}.json")) as f: sr = json.load(f)["sr"]
+                    stems[name] = (np.load(path, mmap_mode="r"), sr)
+                else:
+                    audio, sr = sf.read(path, dtype="int16")
+                    stems[name] = (audio, sr)
+            os.utime(entry) # marks the entry as recently used
+            self.hits += 1
+            return stems
+        except (FileNotFoundError, OSError, ValueError, RuntimeError):
+            self.misses += 1
+            return None
+
+    def put(self, key, stems):
+        # stems is {name: (audio, sr)}, audio is mono or [frames, channels]
+        entry = self.get_entry(key)
+        temp_entry = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(temp_entry, exist_ok=True)
+        try:
+            for name, (audio, sr) in stems.items():
+                audio = np.asarray(audio)
+                if audio.dtype == np.int16:
+                    sf.write(os.path.join(temp_entry, f"{name}.flac"), audio, sr, format="FLAC", subtype="PCM_16")
+                else:
+                    np.save(os.path.join(temp_entry, f"{name}.npy"), audio, allow_pickle=False)
+                    with open(os.path.join(temp_entry, f"{name}.json"), "w") as f: json.dump({"sr": sr}, f)
+            try:
+                os.rename(temp_entry, entry)
+            except OSError: # another process wrote the same stems first
+                pass
+        finally:
+            shutil.rmtree(temp_entry, ignore_errors=True)
+        self.evict()
+        return entry
+
+    def get_entries(self):
+        return get_cache_entries(self.cache_dir)
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.get_entries())
+
+    def evict(self):
+        if self.max_size is None: return
+        with self.lock:
+            evict_cache(self.cache_dir, self.max_size)
+
+def get_cache_entries(cache_dir):
+    # [(last used, size, entry)] oldest first, entries are <cache_dir>/<key[:2]>/<key>/
+    entries = []
+    if not os.path.isdir(cache_dir): return entries
+    for prefix in os.scandir(cache_dir):
+        if not prefix.is_dir(): continue
+        for entry in os.scandir(prefix.path):
+            if not entry.is_dir() or entry.name.endswith(".tmp"): continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except FileNotFoundError: # evicted by someone else
+                continue
+    return sorted(entries)
+
+def evict_cache(cache_dir, max_size):
+    # removes the least recently used entries (by mtime, touch an entry on every hit) until the cache fits in max_size bytes
+    entries = get_cache_entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total <= max_size: break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        print(f"evicted {entry} ({size/1024**2:.1f}MB)")
@@ -7,12 +7,14 @@
 Code to apply a model to a mix. It will handle chunking with overlaps and
 inteprolation between chunks, as well as the "shift trick".
 """
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
 import random
 import typing as tp
 from multiprocessing import Process,Queue,Pipe
 
 import torch as th
+import torch.multiprocessing as th_mp
 from torch import nn
 from torch.nn import functional as F
 import tqdm
@@ -260,6 +262,109 @@ def apply_model(model, mix, shifts=1, split=True, overlap=0.25, transition_power
             out = model(padded_mix)
         return center_trim(out, length)
     
+def get_transition_weight(segment, transition_power=1., device='cpu'):
+    # same triangle shaped weight apply_model uses to blend overlapping segments
+    weight = th.cat([th.arange(1, segment // 2 + 1, device=device),
+                     th.arange(segment - segment // 2, 0, -1, device=device)])
+    return (weight / weight.max())**transition_power
+
+_worker_models = None
+
+def _init_demucs_worker(models, num_threads):
+    global _worker_models
+    th.set_num_threads(num_threads)
+    _worker_models = models
+
+def _run_demucs_chunk(model_index, mix, offset, length, segment_offset, segment):
+    # runs in a worker: mix is a shared memory tensor, so only the offsets are pickled per task
+    chunk = TensorChunk(mix, offset, length)
+    if segment is not None:
+        chunk = TensorChunk(chunk, segment_offset, segment)
+    return apply_model(_worker_models[model_index], chunk, shifts=0, split=False, device='cpu')
+
+class DemucsProcessRunner:
+    """
+    CPU version of apply_model that spreads every (model, shift, segment) chunk over a process pool.
+
+    The models are sent to each worker once (in shared memory), the mix is shared per call and the
+    chunks are blended back with the same transition weights, shift averaging and bag weights as
+    apply_model, so a GPU-less box uses all of its cores instead of one chunk at a time.
+    """
+
+    def __init__(self, model, num_workers=None):
+        self.model = model
+        self.models = list(model.models) if isinstance(model, BagOfModels) else [model]
+        self.weights = model.weights if isinstance(model, BagOfModels) else [[1. for _ in model.sources]]
+        self.num_workers = num_workers or os.cpu_count() or 1
+        for sub_model in self.models:
+            sub_model.cpu().eval().share_memory()
+        self.pool = ProcessPoolExecutor(
+            self.num_workers, mp_context=th_mp.get_context('spawn'), initializer=_init_demucs_worker,
+            initargs=(self.models, max((os.cpu_count() or 1) // self.num_workers, 1)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+    def __call__(self, mix, shifts=1, split=True, overlap=0.25, transition_power=1., set_progress_bar=None):
+        assert transition_power >= 1, "transition_power < 1 leads to weird behavior."
+        batch, channels, length = mix.shape
+        max_shift = int(0.5 * self.model.samplerate)
+        # shifts read from one padded copy of the mix, same as apply_model
+        shared_mix = (tensor_chunk(mix).padded(length + 2 * max_shift) if shifts else mix.contiguous()).cpu().share_memory_()
+
+        # every chunk is queued up front, results are consumed per (model, shift) so only one of those buffers is alive
+        passes = []
+        for model_index, sub_model in enumerate(self.models):
+            segment = int(sub_model.samplerate * sub_model.segment) if split else None
+            for _ in range(max(shifts, 1)):
+                offset = random.randint(0, max_shift) if shifts else 0
+                pass_length = length + max_shift - offset if shifts else length
+                segment_offsets = range(0, pass_length, int((1 - overlap) * segment)) if split else [0]
+                futures = [(segment_offset, self.pool.submit(_run_demucs_chunk, model_index, shared_mix, offset, pass_length, segment_offset, segment))
+                           for segment_offset in segment_offsets]
+                passes.append((model_index, offset, pass_length, segment, futures))
+
+        n_chunks, done = sum(len(futures) for *_, futures in passes), 0
+        estimates = th.zeros(batch, len(self.model.sources), channels, length)
+        model_out = None
+        for i, (model_index, offset, pass_length, segment, futures) in enumerate(passes):
+            if split:
+                out = th.zeros(batch, len(self.model.sources), channels, pass_length)
+                sum_weight = th.zeros(pass_length)
+                weight = get_transition_weight(segment, transition_power)
+                for segment_offset, future in futures:
+                    chunk_out = future.result()
+                    chunk_length = chunk_out.shape[-1]
+                    out[..., segment_offset:segment_offset + segment] += weight[:chunk_length] * chunk_out
+                    sum_weight[segment_offset:segment_offset + segment] += weight[:chunk_length]
+                    done += 1
+                    if set_progress_bar: set_progress_bar(0.1, 0.8 * done / n_chunks)
+                assert sum_weight.min() > 0
+                out /= sum_weight
+            else:
+                out = futures[0][1].result()
+                done += 1
+                if set_progress_bar: set_progress_bar(0.1, 0.8 * done / n_chunks)
+            if shifts:
+                out = out[..., max_shift - offset:]
+
+            model_out = out if model_out is None else model_out + out
+            if i + 1 == len(passes) or passes[i + 1][0] != model_index: # last shift of this model
+                model_out /= max(shifts, 1)
+                for k, inst_weight in enumerate(self.weights[model_index]):
+                    estimates[:, k] += model_out[:, k] * inst_weight
+                model_out = None
+
+        for k in range(estimates.shape[1]):
+            estimates[:, k] /= sum(weight[k] for weight in self.weights)
+        return estimates
+
 def demucs_segments(demucs_segment, demucs_model):
     
     if demucs_segment == 'Default':
@@ -1,6 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import json
 import os
+from time import time as ttime
 import librosa
 import numpy as np
 import soundfile as sf
@@ -10,6 +12,7 @@ import math
 import platform
 import traceback
 from . import pyrb
+from lib.resampler import resample
 #cur
 OPERATING_SYSTEM = platform.system()
 SYSTEM_ARCH = platform.platform()
@@ -26,6 +29,8 @@ if OPERATING_SYSTEM == 'Darwin':
 else:
     wav_resolution = "sinc_fastest"
 
+BAND_POOL = None
+
 MAX_SPEC = 'Max Spec'
 MIN_SPEC = 'Min Spec'
 AVERAGE = 'Average'
@@ -60,7 +65,14 @@ def make_padding(width, cropsize, offset):
 
     return left, right, roi_size
 
-def wave_to_spectrogram(wave, hop_length, n_fft, mid_side=False, mid_side_b2=False, reverse=False):
+def get_band_pool():
+    # persistent workers for the per band/channel stft and istft calls instead of a new thread per call
+    global BAND_POOL
+    if BAND_POOL is None:
+        BAND_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="spec_utils")
+    return BAND_POOL
+
+def get_channel_waves(wave, mid_side=False, mid_side_b2=False, reverse=False):
     if reverse:
         wave_left = np.flip(np.asfortranarray(wave[0]))
         wave_right = np.flip(np.asfortranarray(wave[1]))
@@ -74,41 +86,69 @@ def wave_to_spectrogram(wave, hop_length, n_fft, mid_side=False, mid_side_b2=Fal
         wave_left = np.asfortranarray(wave[0])
         wave_right = np.asfortranarray(wave[1])
 
-    spec_left = librosa.stft(wave_left, n_fft, hop_length=hop_length)
-    spec_right = librosa.stft(wave_right, n_fft, hop_length=hop_length)
+    return wave_left, wave_right
+
+def wave_to_spectrogram(wave, hop_length, n_fft, mid_side=False, mid_side_b2=False, reverse=False):
+    wave_left, wave_right = get_channel_waves(wave, mid_side, mid_side_b2, reverse)
+
+    spec_left = librosa.stft(wave_left, n_fft=n_fft, hop_length=hop_length)
+    spec_right = librosa.stft(wave_right, n_fft=n_fft, hop_length=hop_length)
     
     spec = np.asfortranarray([spec_left, spec_right])
 
     return spec
    
 def wave_to_spectrogram_mt(wave, hop_length, n_fft, mid_side=False, mid_side_b2=False, reverse=False):
-    import threading
+    wave_left, wave_right = get_channel_waves(wave, mid_side, mid_side_b2, reverse)
 
-    if reverse:
-        wave_left = np.flip(np.asfortranarray(wave[0]))
-        wave_right = np.flip(np.asfortranarray(wave[1]))
-    elif mid_side:
-        wave_left = np.asfortranarray(np.add(wave[0], wave[1]) / 2)
-        wave_right = np.asfortranarray(np.subtract(wave[0], wave[1]))
-    elif mid_side_b2:
-        wave_left = np.asfortranarray(np.add(wave[1], wave[0] * .5))
-        wave_right = np.asfortranarray(np.subtract(wave[0], wave[1] * .5))
-    else:
-        wave_left = np.asfortranarray(wave[0])
-        wave_right = np.asfortranarray(wave[1])
-   
-    def run_thread(**kwargs):
-        global spec_left
-        spec_left = librosa.stft(**kwargs)
-
-    thread = threading.Thread(target=run_thread, kwargs={'y': wave_left, 'n_fft': n_fft, 'hop_length': hop_length})
-    thread.start()
-    spec_right = librosa.stft(wave_right, n_fft, hop_length=hop_length)
-    thread.join()   
+    spec_left = get_band_pool().submit(librosa.stft, wave_left, n_fft=n_fft, hop_length=hop_length)
+    spec_right = librosa.stft(wave_right, n_fft=n_fft, hop_length=hop_length)
     
-    spec = np.asfortranarray([spec_left, spec_right])
+    spec = np.asfortranarray([spec_left.result(), spec_right])
 
     return spec
+
+def wave_to_spectrogram_mb(waves, mp, high_end_h=None):
+    """
+    Multi-band analysis: waves is {band: [2, n] wave at that band's sr}.
+
+    Every band and channel is transformed on the band pool and cropped straight into one preallocated
+    complex64 [2, bins+1, frames] spectrogram (what combine_spectrograms builds from the per band spectrograms).
+    Returns the combined spectrogram, the top band's [2, high_end_h, frames] high end (None without high_end_h)
+    and the stft time spent per band.
+    """
+    bands_n = len(mp.param['band'])
+    top = mp.param['band'][bands_n]
+    frames = min(1 + waves[d].shape[-1] // mp.param['band'][d]['hl'] for d in waves)
+    spec_m = np.zeros((2, mp.param['bins'] + 1, frames), dtype=np.complex64)
+    high_end = np.zeros((2, high_end_h, 1 + waves[bands_n].shape[-1] // top['hl']), dtype=np.complex64) if high_end_h else None
+
+    offsets, offset = {}, 0
+    for d in range(1, bands_n + 1):
+        offsets[d] = offset
+        offset += mp.param['band'][d]['crop_stop'] - mp.param['band'][d]['crop_start']
+    if offset > mp.param['bins']:
+        raise ValueError('Too much bins')
+
+    def run_stft(d, c, wave):
+        start = ttime()
+        bp = mp.param['band'][d]
+        spec = librosa.stft(wave, n_fft=bp['n_fft'], hop_length=bp['hl'])
+        h = bp['crop_stop'] - bp['crop_start']
+        spec_m[c, offsets[d]:offsets[d]+h] = spec[bp['crop_start']:bp['crop_stop'], :frames]
+        if high_end is not None and d == bands_n:
+            high_end[c] = spec[bp['n_fft'] // 2 - high_end_h:bp['n_fft'] // 2]
+        return ttime() - start
+
+    pool = get_band_pool()
+    futures = [(d, pool.submit(run_stft, d, c, wave))
+               for d in range(1, bands_n + 1)
+               for c, wave in enumerate(get_channel_waves(waves[d], mp.param['mid_side'], mp.param['mid_side_b2'], mp.param['reverse']))]
+    times = {}
+    for d, future in futures:
+        times[d] = times.get(d, 0) + future.result()
+
+    return apply_pre_filter(spec_m, mp), high_end, times
     
 def normalize(wave, is_normalize=False):
     """Save output music files"""
@@ -163,6 +203,10 @@ def combine_spectrograms(specs, mp):
     if offset > mp.param['bins']:
         raise ValueError('Too much bins')
         
+    return np.asfortranarray(apply_pre_filter(spec_c, mp))
+
+def apply_pre_filter(spec_c, mp):
+    bands_n = len(mp.param['band'])
     # lowpass fiter
     if mp.param['pre_filter_start'] > 0: # and mp.param['band'][bands_n]['res_type'] in ['scipy', 'polyphase']:   
         if bands_n == 1:
@@ -174,7 +218,7 @@ def combine_spectrograms(specs, mp):
                 gp = g
                 spec_c[:, b, :] *= g
                 
-    return np.asfortranarray(spec_c)
+    return spec_c
     
 def spectrogram_to_image(spec, mode='magnitude'):
     if mode == 'magnitude':
@@ -262,13 +306,7 @@ def align_wave_head_and_tail(a, b):
     
     return a[:l,:l], b[:l,:l]
     
-def spectrogram_to_wave(spec, hop_length, mid_side, mid_side_b2, reverse, clamp=False):
-    spec_left = np.asfortranarray(spec[0])
-    spec_right = np.asfortranarray(spec[1])
-
-    wave_left = librosa.istft(spec_left, hop_length=hop_length)
-    wave_right = librosa.istft(spec_right, hop_length=hop_length)
-
+def combine_channel_waves(wave_left, wave_right, mid_side=False, mid_side_b2=False, reverse=False):
     if reverse:
         return np.asfortranarray([np.flip(wave_left), np.flip(wave_right)])
     elif mid_side:
@@ -277,38 +315,40 @@ def spectrogram_to_wave(spec, hop_length, mid_side, mid_side_b2, reverse, clamp=
         return np.asfortranarray([np.add(wave_right / 1.25, .4 * wave_left), np.subtract(wave_left / 1.25, .4 * wave_right)])
     else:
         return np.asfortranarray([wave_left, wave_right])
+
+def spectrogram_to_wave(spec, hop_length, mid_side, mid_side_b2, reverse, clamp=False):
+    spec_left = np.asfortranarray(spec[0])
+    spec_right = np.asfortranarray(spec[1])
+
+    wave_left = librosa.istft(spec_left, hop_length=hop_length)
+    wave_right = librosa.istft(spec_right, hop_length=hop_length)
+
+    return combine_channel_waves(wave_left, wave_right, mid_side, mid_side_b2, reverse)
     
 def spectrogram_to_wave_mt(spec, hop_length, mid_side, reverse, mid_side_b2):
-    import threading
-
     spec_left = np.asfortranarray(spec[0])
     spec_right = np.asfortranarray(spec[1])
     
-    def run_thread(**kwargs):
-        global wave_left
-        wave_left = librosa.istft(**kwargs)
-        
-    thread = threading.Thread(target=run_thread, kwargs={'stft_matrix': spec_left, 'hop_length': hop_length})
-    thread.start()
+    wave_left = get_band_pool().submit(librosa.istft, spec_left, hop_length=hop_length)
     wave_right = librosa.istft(spec_right, hop_length=hop_length)
-    thread.join()   
     
-    if reverse:
-        return np.asfortranarray([np.flip(wave_left), np.flip(wave_right)])
-    elif mid_side:
-        return np.asfortranarray([np.add(wave_left, wave_right / 2), np.subtract(wave_left, wave_right / 2)])
-    elif mid_side_b2:
-        return np.asfortranarray([np.add(wave_right / 1.25, .4 * wave_left), np.subtract(wave_left / 1.25, .4 * wave_right)])
-    else:
-        return np.asfortranarray([wave_left, wave_right])
+    return combine_channel_waves(wave_left.result(), wave_right, mid_side, mid_side_b2, reverse)
     
 def cmb_spectrogram_to_wave(spec_m, mp, extra_bins_h=None, extra_bins=None):
+    # every band/channel istft runs on the band pool while the next band is being filtered,
+    # only the resample + add chain that joins the bands runs serially at the end
     bands_n = len(mp.param['band'])    
     offset = 0
+    pool = get_band_pool()
+    futures = {}
+
+    def run_istft(spec, hop_length):
+        start = ttime()
+        return librosa.istft(spec, hop_length=hop_length), ttime() - start
 
     for d in range(1, bands_n + 1):
         bp = mp.param['band'][d]
-        spec_s = np.ndarray(shape=(2, bp['n_fft'] // 2 + 1, spec_m.shape[2]), dtype=complex)
+        spec_s = np.zeros(shape=(2, bp['n_fft'] // 2 + 1, spec_m.shape[2]), dtype=np.complex64)
         h = bp['crop_stop'] - bp['crop_start']
         spec_s[:, bp['crop_start']:bp['crop_stop'], :] = spec_m[:, offset:offset+h, :]
         
@@ -319,20 +359,24 @@ def cmb_spectrogram_to_wave(spec_m, mp, extra_bins_h=None, extra_bins=None):
                 spec_s[:, max_bin-extra_bins_h:max_bin, :] = extra_bins[:, :extra_bins_h, :]
             if bp['hpf_start'] > 0:
                 spec_s = fft_hp_filter(spec_s, bp['hpf_start'], bp['hpf_stop'] - 1)
-            if bands_n == 1:
-                wave = spectrogram_to_wave(spec_s, bp['hl'], mp.param['mid_side'], mp.param['mid_side_b2'], mp.param['reverse'])
-            else:
-                wave = np.add(wave, spectrogram_to_wave(spec_s, bp['hl'], mp.param['mid_side'], mp.param['mid_side_b2'], mp.param['reverse']))
-        else:
-            sr = mp.param['band'][d+1]['sr']
-            if d == 1: # lower
-                spec_s = fft_lp_filter(spec_s, bp['lpf_start'], bp['lpf_stop'])
-                wave = librosa.resample(spectrogram_to_wave(spec_s, bp['hl'], mp.param['mid_side'], mp.param['mid_side_b2'], mp.param['reverse']), bp['sr'], sr, res_type=wav_resolution)
-            else: # mid
-                spec_s = fft_hp_filter(spec_s, bp['hpf_start'], bp['hpf_stop'] - 1)
-                spec_s = fft_lp_filter(spec_s, bp['lpf_start'], bp['lpf_stop'])
-                wave2 = np.add(wave, spectrogram_to_wave(spec_s, bp['hl'], mp.param['mid_side'], mp.param['mid_side_b2'], mp.param['reverse']))
-                wave = librosa.resample(wave2, bp['sr'], sr, res_type=wav_resolution)
+        elif d == 1: # lower
+            spec_s = fft_lp_filter(spec_s, bp['lpf_start'], bp['lpf_stop'])
+        else: # mid
+            spec_s = fft_hp_filter(spec_s, bp['hpf_start'], bp['hpf_stop'] - 1)
+            spec_s = fft_lp_filter(spec_s, bp['lpf_start'], bp['lpf_stop'])
+        futures[d] = [pool.submit(run_istft, spec, bp['hl']) for spec in spec_s]
+
+    wave = None
+    times = {}
+    for d in range(1, bands_n + 1):
+        bp = mp.param['band'][d]
+        (wave_left, left_time), (wave_right, right_time) = (future.result() for future in futures[d])
+        times[d] = left_time + right_time
+        band_wave = combine_channel_waves(wave_left, wave_right, mp.param['mid_side'], mp.param['mid_side_b2'], mp.param['reverse'])
+        if wave is not None:
+            band_wave = np.add(librosa.util.fix_length(wave, size=band_wave.shape[-1], axis=-1), band_wave)
+        wave = resample(band_wave, bp['sr'], mp.param['band'][d+1]['sr'], res_type=wav_resolution) if d < bands_n else band_wave
+    print(f"istft per band: {', '.join(f'{d}: {t:.2f}s' for d, t in times.items())}")
         
     return wave
 
@@ -394,8 +438,8 @@ def adjust_aggr(mask, is_non_accom_stem, aggressiveness):
 def stft(wave, nfft, hl):
     wave_left = np.asfortranarray(wave[0])
     wave_right = np.asfortranarray(wave[1])
-    spec_left = librosa.stft(wave_left, nfft, hop_length=hl)
-    spec_right = librosa.stft(wave_right, nfft, hop_length=hl)
+    spec_left = librosa.stft(wave_left, n_fft=nfft, hop_length=hl)
+    spec_right = librosa.stft(wave_right, n_fft=nfft, hop_length=hl)
     spec = np.asfortranarray([spec_left, spec_right])
 
     return spec
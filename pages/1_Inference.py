@@ -1,5 +1,6 @@
 import os
 import sys
+from time import sleep
 import streamlit as st
 
 from webui import DEVICE_OPTIONS, MENU_ITEMS, config, i18n
@@ -9,26 +10,56 @@ from webui.components import file_uploader_form, initial_vocal_separation_params
 from webui.downloader import OUTPUT_DIR, SONG_DIR
 
 from types import SimpleNamespace
-from vc_infer_pipeline import get_vc, vc_single
+from vc_infer_pipeline import MODEL_REGISTRY, get_vc, vc_single
 from webui.contexts import SessionStateContext
 from webui.audio import SUPPORTED_AUDIO, bytes_to_audio, merge_audio, remix_audio, save_input_audio
 
 from webui.utils import gc_collect, get_filenames, get_index, get_optimal_torch_device
-from uvr5_cli import split_audio
+from lib.separation_jobs import get_job_queue
 
 CWD = os.getcwd()
 if CWD not in sys.path:
     sys.path.append(CWD)
     
-def split_vocals(model_paths,**args):
-    with st.status("splitting vocals... ") as status:
-        try:
-            vocals,instrumental,input_audio=split_audio(model_paths,**args)
-            return vocals, instrumental, input_audio
-        except Exception as e:
-            status.error(e)
-            status.update(state="error")
-            return None, None, None
+def split_vocals(model_paths,uvr5_models=[],uvr5_preprocess_models=[],**args):
+    # runs split_audio in the background job queue and returns the job id, the page polls it until the stems are ready
+    job = get_job_queue().submit(model_paths=model_paths,**args)
+    return job.id
+
+def render_split_job(state):
+    # returns True while the job is still running so the page reruns to poll it again
+    job = get_job_queue().get(state.split_job_id) if state.split_job_id else None
+    if job is None: return False
+    if job.state=="failed":
+        get_job_queue().collect(job.id) # its chunks stay on disk, see render_interrupted_jobs
+        st.error(f"splitting vocals failed: {job.error}")
+        state.split_job_id = None
+        state.convert_after_split = False
+    elif job.state=="done":
+        state.input_vocals, state.input_instrumental, state.input_audio = get_job_queue().collect(job.id).result # the stems live in the session state now
+        state.split_job_id = None
+        if state.convert_after_split:
+            state.convert_after_split = False
+            convert_and_mix(state)
+    else:
+        eta = job.eta
+        st.progress(job.progress,text=f"splitting vocals... {job.progress:.0%}"+("" if eta is None else f" (about {eta:.0f}s left)"))
+        return True
+    return False
+
+def render_interrupted_jobs(state):
+    # separations that failed or were cut short by a restart only continue when asked to
+    if state.split_job_id: return
+    for job_id, data in get_job_queue().get_interrupted():
+        col1, col2, col3 = st.columns([4,1,1])
+        col1.write(f"unfinished separation ({data['state']}): {os.path.basename(data['kwargs'].get('audio_path',''))}")
+        if col2.button("resume",key=f"resume_{job_id}",use_container_width=True):
+            job = get_job_queue().resume(job_id)
+            if job is not None: state.split_job_id = job.id
+            st.experimental_rerun()
+        if col3.button("discard",key=f"discard_{job_id}",use_container_width=True):
+            get_job_queue().remove(job_id)
+            st.experimental_rerun()
 
 def load_model(_state):
     if _state.rvc_models is None: _state.rvc_models = get_vc(_state.model_name,config=config,device=_state.device)        
@@ -62,6 +93,8 @@ def init_inference_state():
         input_audio=None,
         input_vocals=None,
         input_instrumental=None,
+        split_job_id=None,
+        convert_after_split=False,
         output_audio=None,
         output_audio_name=None,
         output_vocals=None,
@@ -82,6 +115,7 @@ def refresh_data(state):
 def clear_data(state):
     del state.rvc_models
     state.rvc_models = None
+    MODEL_REGISTRY.clear()
     gc_collect()
     return state
 
@@ -91,12 +125,16 @@ def get_filename(audio_name,model_name):
     return f"{singer}.{song}"
 
 def one_click_convert(state):
-    state.input_vocals, state.input_instrumental, state.input_audio = split_vocals(
+    # vocals are converted once the split job is done (see render_split_job)
+    state.split_job_id = split_vocals(
         audio_path=state.input_audio_name,
         device=state.device,
         **vars(state.uvr5_params),
         )
-    
+    state.convert_after_split = True
+    return state
+
+def convert_and_mix(state):
     changed_vocals = convert_vocals(
         state,
         state.input_vocals,
@@ -160,8 +198,7 @@ if __name__=="__main__":
 
             if col2.button(i18n("inference.one_click.button"), type="primary",use_container_width=True,
                         disabled=not (state.uvr5_params.model_paths and state.input_audio_name and state.model_name)):
-                with st.spinner(i18n("inference.one_click.button")):
-                    state = one_click_convert(state)
+                state = one_click_convert(state)
             
             state.model_name = right.selectbox(
                 i18n("inference.voice.selectbox"),
@@ -189,11 +226,13 @@ if __name__=="__main__":
             state = render_vocal_separation_form(state)
 
         if st.button(i18n("inference.split_vocals"),disabled=not (state.input_audio_name and len(state.uvr5_params.model_paths))):
-            state.input_vocals, state.input_instrumental, state.input_audio = split_vocals(
+            state.split_job_id = split_vocals(
                 audio_path=state.input_audio_name,
                 device=state.device,
                 **vars(state.uvr5_params),
                 )
+        polling = render_split_job(state)
+        render_interrupted_jobs(state)
                 
         with st.container():
             if state.input_audio is not None:
@@ -266,4 +305,8 @@ if __name__=="__main__":
                 col2.write("Converted Song")
                 col2.audio(state.output_audio[0],sample_rate=state.output_audio[1])
                 if col2.button(i18n("inference.download.button")):
-                    st.toast(download_song(state.output_audio,state.output_audio_name,ext="flac"))
\ No newline at end of file
+                    st.toast(download_song(state.output_audio,state.output_audio_name,ext="flac"))
+
+        if polling: # the rest of the page stays usable while the split job runs
+            sleep(1)
+            st.experimental_rerun()
\ No newline at end of file
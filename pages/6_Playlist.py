@@ -36,6 +36,7 @@ def init_inference_state():
         vocal_change_config=initial_voice_conversion_params(),
         shuffle=False,
         loop=False,
+        stream=False,
         volume=1.0,
         device=get_optimal_torch_device()
     )
@@ -71,6 +72,8 @@ def set_volume(state):
     if state.player and state.volume!=state.player.volume: state.player.set_volume(state.volume)
 def set_loop(state):
     if state.player and state.loop!=state.player.loop: state.player.set_loop(state.loop)
+def set_stream(state):
+    if state.player and state.stream!=state.player.stream_songs: state.player.stream_songs = state.stream
 def set_shuffle(state):
     if state.player:
         if state.shuffle:
@@ -104,6 +107,8 @@ if __name__=="__main__":
             col1, col2, col3 = st.columns(3)
             state.loop = col1.checkbox("Loop",value=state.loop)
             state.shuffle = col2.checkbox("Shuffle",value=state.shuffle)
+            state.stream = col1.checkbox("Stream",value=state.stream,
+                                         help="start playing while the song is still being separated and converted")
             state.device = col3.radio(
                 i18n("inference.device"),
                 disabled=not config.has_gpu,
@@ -113,6 +118,7 @@ if __name__=="__main__":
             if st.form_submit_button("Update"):
                 set_volume(state)
                 set_loop(state)
+                set_stream(state)
                 set_shuffle(state)
 
         col1, col2, col3, col4 = st.columns(4)
@@ -127,6 +133,7 @@ if __name__=="__main__":
                 state.player = PlaylistPlayer(state.playlist,
                                               shuffle=state.shuffle,
                                               loop=state.loop,
+                                              stream=state.stream,
                                               volume=state.volume,
                                                 model_name=state.model_name,
                                                 config=config,
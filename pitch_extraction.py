@@ -1,17 +1,128 @@
 from functools import partial
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
 from multiprocessing.pool import ThreadPool
 import os
 import random
+from time import time as ttime
 import numpy as np
 from scipy import signal
 import torch, torchcrepe, pyworld
 
 from lib.rmvpe import RMVPE
-from webui.audio import autotune_f0, pad_audio
-from webui.downloader import BASE_MODELS_DIR
-from webui.utils import get_optimal_threads, get_optimal_torch_device
+from lib.stem_cache import evict_cache
+from webui.audio import autotune_f0, find_cut_points, pad_audio
+from webui.downloader import BASE_CACHE_DIR, BASE_MODELS_DIR
+from webui.utils import get_optimal_threads, get_optimal_torch_device, save_npy
+
+CACHED_F0_DIR = os.path.join(BASE_CACHE_DIR,"f0")
+F0_CACHE_MAX_SIZE = 256*1024**2 # bytes, least recently used songs are evicted past this
+RMVPE_CHUNK_SIZE = 3200 # frames, audio longer than 32s (+ overlap) runs in windows so rmvpe memory stays flat on long songs
+
+def get_f0_cache_file(x, f0_method, merge_type, f0_min, f0_max, hop_length, **kwargs):
+    # raw f0 only depends on the audio and the extraction settings (not the voice, key or autotune)
+    methods = f0_method if type(f0_method) == list else [f0_method]
+    settings = "_".join(methods + [str(merge_type if len(methods) > 1 else ""), str(f0_min), str(f0_max), str(hop_length)]
+                        + [f"{k}={v}" for k, v in sorted(kwargs.items())])
+    audio_hash = hashlib.md5(np.ascontiguousarray(x).view(np.uint8)).hexdigest()
+    settings_hash = hashlib.md5(settings.encode()).hexdigest()[:16]
+    return os.path.join(CACHED_F0_DIR, audio_hash[:2], audio_hash, f"{settings_hash}.npy")
+
+# cpu-only f0 methods, kept at module level so they can run in worker processes
+def compute_pm(x, sr, p_len, f0_min=50, f0_max=1100, **kwargs):
+    import parselmouth
+    f0 = parselmouth.Sound(x, sr).to_pitch_ac(
+        time_step=160 / 16000,
+        voicing_threshold=0.6,
+        pitch_floor=f0_min,
+        pitch_ceiling=f0_max,
+    ).selected_array["frequency"]
+
+    return np.pad(
+        f0,
+        [[max(0, (p_len - len(f0) + 1) // 2), max(0, p_len - len(f0) - (p_len - len(f0) + 1) // 2)]],
+        mode="constant"
+    )
+
+def compute_harvest(x, sr, f0_min=50, f0_max=1100, hop_length=160, **kwargs):
+    x = x.astype(np.double)
+    f0_spectral = pyworld.harvest(
+        x,
+        fs=sr,
+        f0_ceil=f0_max,
+        f0_floor=f0_min,
+        frame_period=1000 * hop_length / sr,
+    )
+    return pyworld.stonemask(x, *f0_spectral, sr)
+
+def compute_dio(x, sr, f0_min=50, f0_max=1100, hop_length=160, **kwargs):
+    x = x.astype(np.double)
+    f0_spectral = pyworld.dio(
+        x,
+        fs=sr,
+        f0_ceil=f0_max,
+        f0_floor=f0_min,
+        frame_period=1000 * hop_length / sr,
+    )
+    return pyworld.stonemask(x, *f0_spectral, sr)
+
+CPU_F0_METHODS = {"pm": compute_pm, "harvest": compute_harvest, "dio": compute_dio}
+F0_PROCESS_POOL = None
+
+def get_f0_process_pool(max_workers=0):
+    # reused between calls so the workers only pay the import cost once, sized by the first caller (0 = one worker per core)
+    global F0_PROCESS_POOL
+    if F0_PROCESS_POOL is None:
+        # spawn since this process already runs torch (maybe cuda) and streamlit threads, which aren't safe to fork
+        F0_PROCESS_POOL = ProcessPoolExecutor(max_workers=max(max_workers or os.cpu_count() or 1, 1),
+                                              mp_context=multiprocessing.get_context("spawn"))
+    return F0_PROCESS_POOL
+
+def get_world_segments(x, sr, hop_length=160, segment_time=30., search_time=2., margin_time=.5):
+    # (start_frame, end_frame, start, end) per segment, split at the quietest points with margin samples of context on each side
+    n_frames = len(x) // hop_length + 1 # same as pyworld with frame_period=1000*hop_length/sr
+    segment_size = int(segment_time * sr)
+    # same quietest point search as the vc slicing, the last segment is at least half a segment long
+    cut_points = [t for t in find_cut_points(x, hop_length, segment_size, int(search_time * sr)) if t < len(x) - segment_size // 2]
+    cut_frames = np.unique(np.array(cut_points, dtype=np.int64) // hop_length)
+    bounds = np.concatenate([[0], cut_frames, [n_frames]])
+    margin = int(margin_time * sr / hop_length) * hop_length # whole frames so the segment grids line up
+    return [(start_frame, end_frame, max(start_frame * hop_length - margin, 0), min(end_frame * hop_length + margin, len(x)))
+            for start_frame, end_frame in zip(bounds[:-1], bounds[1:])]
+
+def stitch_world_segments(segments, segment_f0s, hop_length=160):
+    # drops the margin frames of every segment and lays the rest out on the full signal's frame grid
+    f0 = np.zeros(segments[-1][1], dtype=np.double)
+    for (start_frame, end_frame, start, _), segment_f0 in zip(segments, segment_f0s):
+        offset = start_frame - start // hop_length
+        segment_f0 = segment_f0[offset : offset + end_frame - start_frame]
+        f0[start_frame : start_frame + len(segment_f0)] = segment_f0
+    return f0
+
+def compute_world_segmented(method, x, sr, hop_length=160, segment_time=30., search_time=2., margin_time=.5, max_workers=0, **kwargs):
+    # runs harvest/dio on silence separated segments across processes and stitches the f0 frame by frame
+    segments = get_world_segments(x, sr, hop_length, segment_time, search_time, margin_time)
+    pool = get_f0_process_pool(max_workers)
+    futures = [pool.submit(CPU_F0_METHODS[method], x[start:end], sr, hop_length=hop_length, **kwargs) for _, _, start, end in segments]
+    return stitch_world_segments(segments, [future.result() for future in futures], hop_length)
+
+def compute_f0_shared(shm_name, shape, dtype, method, sr, params, start=0, end=None):
+    # runs in a worker process: reads the audio (or one segment of it) from shared memory instead of unpickling a copy
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        x = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        start_time = ttime()
+        f0 = CPU_F0_METHODS[method](x[start:end], sr, **params)
+        del x # must release the buffer before closing
+        return f0, ttime() - start_time
+    finally:
+        shm.close()
 
 class FeatureExtractor:
+    use_f0_cache = False # content-addressed cache of raw f0 under .cache/f0
+
     def __init__(self, tgt_sr, config, onnx=False):
         self.x_pad, self.x_query, self.x_center, self.x_max, self.is_half = (
             config.x_pad,
@@ -31,6 +142,10 @@ class FeatureExtractor:
         self.t_max = self.sr * self.x_max  # 免查询时长阈值
         self.device = config.device
         self.onnx = onnx
+        self.f0_backend = getattr(config, "f0_backend", "thread") # "process" runs pm/harvest/dio in worker processes
+        self.f0_workers = getattr(config, "f0_workers", 0) # size of the f0 process pool, 0 = one per core
+        self.world_segment_time = getattr(config, "world_segment_time", 0) # e.g. 30 splits harvest/dio on audio over 2x that into ~30s segments across processes (changes the f0 at the cuts)
+        self.f0_method_times = {} # seconds spent per f0 method in the last get_f0 call
         self.f0_method_dict = {
             "pm": self.get_pm,
             "harvest": self.get_harvest,
@@ -123,44 +238,31 @@ class FeatureExtractor:
         return f0
 
     def get_pm(self, x, p_len, *args, **kwargs):
-        import parselmouth
-        f0 = parselmouth.Sound(x, self.sr).to_pitch_ac(
-            time_step=160 / 16000,
-            voicing_threshold=0.6,
-            pitch_floor=kwargs.get('f0_min'),
-            pitch_ceiling=kwargs.get('f0_max'),
-        ).selected_array["frequency"]
-        
-        return np.pad(
-            f0,
-            [[max(0, (p_len - len(f0) + 1) // 2), max(0, p_len - len(f0) - (p_len - len(f0) + 1) // 2)]],
-            mode="constant"
-        )
+        return compute_pm(x, self.sr, p_len, **kwargs)
+
+    def is_world_segmented(self, method, x):
+        return method in ["harvest", "dio"] and self.world_segment_time and len(x) > 2 * self.world_segment_time * self.sr
 
     def get_harvest(self, x, *args, **kwargs):
-        f0_spectral = pyworld.harvest(
-            x.astype(np.double),
-            fs=self.sr,
-            f0_ceil=kwargs.get('f0_max'),
-            f0_floor=kwargs.get('f0_min'),
-            frame_period=1000 * kwargs.get('hop_length', 160) / self.sr,
-        )
-        return pyworld.stonemask(x.astype(np.double), *f0_spectral, self.sr)
+        if self.is_world_segmented("harvest", x):
+            return compute_world_segmented("harvest", x, self.sr, hop_length=self.window, segment_time=self.world_segment_time, max_workers=self.f0_workers, **kwargs)
+        return compute_harvest(x, self.sr, **kwargs)
 
     def get_dio(self, x, *args, **kwargs):
-        f0_spectral = pyworld.dio(
-            x.astype(np.double),
-            fs=self.sr,
-            f0_ceil=kwargs.get('f0_max'),
-            f0_floor=kwargs.get('f0_min'),
-            frame_period=1000 * kwargs.get('hop_length', 160) / self.sr,
-        )
-        return pyworld.stonemask(x.astype(np.double), *f0_spectral, self.sr)
+        if self.is_world_segmented("dio", x):
+            return compute_world_segmented("dio", x, self.sr, hop_length=self.window, segment_time=self.world_segment_time, max_workers=self.f0_workers, **kwargs)
+        return compute_dio(x, self.sr, **kwargs)
 
 
-    def get_rmvpe(self, x, *args, **kwargs):
+    def load_rmvpe(self):
         if not hasattr(self,"model_rmvpe"):
-            self.model_rmvpe = RMVPE(os.path.join(BASE_MODELS_DIR,f"rmvpe.{'onnx' if self.onnx else 'pt'}"), is_half=self.is_half, device=self.device, onnx=self.onnx)
+            # only audio longer than the window is chunked, the onnx export always runs in one shot
+            self.model_rmvpe = RMVPE(os.path.join(BASE_MODELS_DIR,f"rmvpe.{'onnx' if self.onnx else 'pt'}"), is_half=self.is_half, device=self.device, onnx=self.onnx,
+                                     chunk_size=None if self.onnx else RMVPE_CHUNK_SIZE)
+        return self.model_rmvpe
+
+    def get_rmvpe(self, x, *args, **kwargs):
+        self.load_rmvpe()
 
         # if self.onnx == False: 
         return self.model_rmvpe.infer_from_audio(x, thred=0.03)
@@ -173,8 +275,7 @@ class FeatureExtractor:
         #     return f0
 
     def get_pitch_dependant_rmvpe(self, x, f0_min=1, f0_max=40000, *args, **kwargs):
-        if not hasattr(self,"model_rmvpe"):
-            self.model_rmvpe = RMVPE(os.path.join(BASE_MODELS_DIR,f"rmvpe.{'onnx' if self.onnx else 'pt'}"), is_half=self.is_half, device=self.device, onnx=self.onnx)
+        self.load_rmvpe()
 
         return self.model_rmvpe.infer_from_audio_with_pitch(x, thred=0.03, f0_min=f0_min, f0_max=f0_max)
 
@@ -191,34 +292,71 @@ class FeatureExtractor:
         filter_radius,
         crepe_hop_length,
         time_step,
+        backend=None,
         **kwargs
     ):
         # Get various f0 methods from input to use in the computation stack
-        params = {'x': x, 'p_len': p_len, 'f0_min': f0_min, 
+        params = {'p_len': p_len, 'f0_min': f0_min, 
           'f0_max': f0_max, 'time_step': time_step, 'filter_radius': filter_radius, 
           'crepe_hop_length': crepe_hop_length, 'model': "full"
         }
-        
-        f0_computation_stack = []
+        backend = backend or self.f0_backend
 
-        print(f"Calculating f0 pitch estimations for methods: {methods_list}")
+        print(f"Calculating f0 pitch estimations for methods: {methods_list} ({backend} backend)")
         x = x.astype(np.float32)
         x /= np.quantile(np.abs(x), 0.999)
-        # Get f0 calculations for all methods specified
-
-        def _get_f0(method,params):
+        for method in methods_list:
             if method not in self.f0_method_dict:
                 raise Exception(f"Method {method} not found.")
-            f0 = self.f0_method_dict[method](**params)
+
+        def _postprocess(method, f0):
             if method == 'harvest' and filter_radius > 2:
                 f0 = signal.medfilt(f0, filter_radius)
                 f0 = f0[1:]  # Get rid of first frame.
             return f0
 
-        with ThreadPool(get_optimal_threads()) as pool:
-            f0_computation_stack = pool.starmap(_get_f0,[(method,params) for method in methods_list])
+        def _get_f0(method):
+            start = ttime()
+            f0 = self.f0_method_dict[method](x=x, **params)
+            return f0, ttime() - start
+
+        # pyworld and parselmouth hold the GIL, so with the process backend they get their own workers
+        # while the model based methods (rmvpe, crepe) stay in this process next to their loaded models
+        process_methods = [method for method in methods_list if method in CPU_F0_METHODS] if backend == "process" else []
+        thread_methods = [method for method in methods_list if method not in process_methods]
+        results = {}
+        shm = None
+        try:
+            if len(process_methods):
+                x_double = x.astype(np.double) # pyworld needs float64 anyway
+                shm = shared_memory.SharedMemory(create=True, size=x_double.nbytes)
+                np.ndarray(x_double.shape, dtype=x_double.dtype, buffer=shm.buf)[:] = x_double
+                pool = get_f0_process_pool(self.f0_workers)
+                futures = {}
+                for method in process_methods:
+                    # long harvest/dio runs are split the same way as get_harvest/get_dio, one task per segment
+                    segments = get_world_segments(x, self.sr, self.window, self.world_segment_time) if self.is_world_segmented(method, x) else None
+                    futures[method] = segments, [pool.submit(compute_f0_shared, shm.name, x_double.shape, x_double.dtype, method, self.sr, params, start, end)
+                                                 for _, _, start, end in (segments or [(0, 0, 0, None)])]
+                del x_double
 
-        f0_computation_stack = pad_audio(*f0_computation_stack) # prevents uneven f0
+            if len(thread_methods):
+                with ThreadPool(int(min(len(thread_methods), get_optimal_threads()))) as pool:
+                    results.update(zip(thread_methods, pool.map(_get_f0, thread_methods)))
+
+            if len(process_methods):
+                for method, (segments, method_futures) in futures.items():
+                    f0s, times = zip(*[future.result() for future in method_futures])
+                    f0 = f0s[0] if segments is None else stitch_world_segments(segments, f0s, self.window)
+                    results[method] = f0, sum(times) # cpu time across the segments
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+        self.f0_method_times = {method: results[method][1] for method in methods_list}
+        print(f"f0 method times: {', '.join(f'{k}={v:.2f}s' for k, v in self.f0_method_times.items())}")
+        f0_computation_stack = pad_audio(*[_postprocess(method, results[method][0]) for method in methods_list]) # prevents uneven f0
 
         print(f"Calculating hybrid median f0 from the stack of: {methods_list} using {merge_type} merge")
         merge_func = np.nanmedian if merge_type=="median" else np.nanmean
@@ -240,6 +378,7 @@ class FeatureExtractor:
         inp_f0=None,
         f0_min=50,
         f0_max=1100,
+        use_cache=None,
     ):
         time_step = self.window / self.sr * 1000
         f0_mel_min = 1127 * np.log(1 + f0_min / 700)
@@ -249,15 +388,34 @@ class FeatureExtractor:
           'crepe_hop_length': crepe_hop_length, 'model': "full", 'onnx': rmvpe_onnx
         }
 
-        if type(f0_method) == list:
-            # Perform hybrid median pitch estimation
-            f0 = self.get_f0_hybrid_computation(f0_method,merge_type,**params)
+        cache_file = None
+        if self.use_f0_cache if use_cache is None else use_cache:
+            cache_file = get_f0_cache_file(x, f0_method, merge_type, f0_min, f0_max, self.window,
+                                           filter_radius=filter_radius, crepe_hop_length=crepe_hop_length, onnx=rmvpe_onnx,
+                                           world_segment_time=self.world_segment_time)
+        if cache_file and os.path.isfile(cache_file):
+            print(f"loading cached f0 from {cache_file}")
+            f0 = np.load(cache_file).astype(np.float32)
+            os.utime(os.path.dirname(cache_file)) # marks the song as recently used
         else:
-            print(f"f0_method={f0_method}")
-            f0 = self.f0_method_dict[f0_method](**params)
+            if type(f0_method) == list:
+                # Perform hybrid median pitch estimation
+                f0 = self.get_f0_hybrid_computation(f0_method,merge_type,**params)
+            else:
+                print(f"f0_method={f0_method}")
+                start = ttime()
+                f0 = self.f0_method_dict[f0_method](**params)
+                self.f0_method_times = {f0_method: ttime() - start}
+
+            if cache_file:
+                f0 = np.asarray(f0).astype(np.float16)
+                save_npy(cache_file, f0)
+                evict_cache(CACHED_F0_DIR, F0_CACHE_MAX_SIZE)
+                f0 = f0.astype(np.float32) # same precision as a cache hit
 
         if f0_autotune:
-            f0 = autotune_f0(f0)
+            # f0_autotune can also be a dict of autotune_f0 options (key, scale, retune_speed, threshold)
+            f0 = autotune_f0(f0, **f0_autotune) if isinstance(f0_autotune, dict) else autotune_f0(f0)
 
         f0 *= pow(2, f0_up_key / 12)
         # with open("test.txt","w")as f:f.write("\n".join([str(i)for i in f0.tolist()]))
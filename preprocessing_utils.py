@@ -1,6 +1,7 @@
 import sys, os, multiprocessing
 from scipy import signal
 import numpy as np, os, traceback
+from lib.resampler import resample
 from lib.slicer2 import Slicer
 import librosa, traceback
 from scipy.io import wavfile
@@ -58,8 +59,8 @@ class Preprocess:
             self.sr,
             tmp_audio.astype(np.float32),
         )
-        tmp_audio = librosa.resample(
-            tmp_audio, orig_sr=self.sr, target_sr=16000
+        tmp_audio = resample(
+            tmp_audio, self.sr, 16000
         )  # , res_type="soxr_vhq"
         wavfile.write(
             "%s/%s_%s.wav" % (self.wavs16k_dir, idx0, idx1),
@@ -0,0 +1,6 @@
+import os, sys
+
+# the modules import each other from the repo root, same as the streamlit pages and clis
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,56 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch") # webui/__init__ loads the torch config
+from webui.audio import MAX_INT16, merge_audio, remix_audio
+
+def noise(n, scale=8000, seed=0):
+    return (np.random.default_rng(seed).standard_normal(n) * scale).astype("int16")
+
+def test_remix_peak_and_length():
+    audio, sr = remix_audio((noise(44100 * 2), 44100), target_sr=40000, norm=True)
+    assert sr == 40000
+    assert abs(len(audio) - 80000) <= 1
+    assert audio.dtype == np.float32
+    np.testing.assert_allclose(np.abs(audio).max(), .95, rtol=1e-4)
+
+def test_remix_to_int16_leaves_input_alone():
+    source = noise(44100)
+    copy = source.copy()
+    audio, _ = remix_audio((source, 44100), norm=True, to_int16=True)
+    assert audio.dtype == np.int16
+    assert abs(int(np.abs(audio.astype(np.int32)).max()) - int(.95 * MAX_INT16)) <= 1
+    np.testing.assert_array_equal(source, copy)
+
+def test_remix_resample_same_rate_leaves_input_alone():
+    # resampling to the same rate returns the float32 input itself, which must not be scaled in place
+    source = noise(44100).astype("float32") / MAX_INT16
+    copy = source.copy()
+    audio, sr = remix_audio((source, 44100), target_sr=44100, norm=True, resample=True)
+    assert sr == 44100
+    np.testing.assert_allclose(np.abs(audio).max(), .95, rtol=1e-4)
+    np.testing.assert_array_equal(source, copy)
+
+def test_remix_to_mono():
+    stereo = np.stack([noise(1000, seed=1), noise(1000, seed=2)]).astype("float32") / MAX_INT16
+    audio, _ = remix_audio((stereo, 16000), to_mono=True)
+    np.testing.assert_allclose(audio, stereo.mean(0), atol=1e-6)
+
+def test_merge_audio_dtype_and_length():
+    vocals, instrumental = (noise(40000 * 3, seed=1), 40000), (noise(44100 * 2, seed=2), 44100)
+    audio, sr = merge_audio(vocals, instrumental, sr=44100)
+    assert sr == 44100
+    assert audio.dtype == np.int16
+    assert len(audio) == 44100 * 3
+
+def test_merge_audio_memory():
+    # at most ~2 full-length float32 copies at the output rate (the mix buffer + one remixed input)
+    duration, sr = 60, 44100
+    vocals, instrumental = (noise(40000 * duration, seed=1), 40000), (noise(sr * duration, seed=2), sr)
+    tracemalloc.start()
+    merge_audio(vocals, instrumental, sr=sr)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak / (sr * duration * 4) <= 2.2
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch") # webui/__init__ loads the torch config
+from webui.audio import AUTOTUNE_NOTES, autotune_f0, get_scale_notes
+
+def test_autotune_snaps_to_scale():
+    notes = get_scale_notes("C", "major")
+    assert len(notes) == len(AUTOTUNE_NOTES) * 7 // 12
+    f0 = np.array([0., 262., 270., 440., 452.], dtype=np.float32) # unvoiced, ~C4, between C4 and C#4, A4, ~A4
+    tuned = autotune_f0(f0, key="C", scale="major")
+    assert tuned[0] == 0
+    for value in tuned[1:]:
+        assert np.min(np.abs(notes - value)) < 1e-2
+    np.testing.assert_allclose(tuned[1:], [261.63, 261.63, 440., 440.], rtol=1e-4)
+
+def test_autotune_threshold_keeps_close_frames():
+    f0 = np.array([262., 300.], dtype=np.float32)
+    tuned = autotune_f0(f0, threshold=1.)
+    assert tuned[0] == f0[0] # within 1Hz of C4
+    assert tuned[1] != f0[1]
@@ -0,0 +1,29 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("soundfile")
+pytest.importorskip("torch") # via webui.utils
+from lib.stem_cache import evict_cache, get_cache_entries
+
+def make_entry(cache_dir, key, size, mtime):
+    entry = os.path.join(cache_dir, key[:2], key)
+    os.makedirs(entry)
+    np.zeros(size, dtype=np.uint8).tofile(os.path.join(entry, "data.npy"))
+    os.utime(entry, (mtime, mtime))
+    return entry
+
+def test_evicts_least_recently_used(tmp_path):
+    old = make_entry(str(tmp_path), "aa00", 1000, 1)
+    recent = make_entry(str(tmp_path), "bb00", 1000, 3)
+    used = make_entry(str(tmp_path), "cc00", 1000, 2)
+    os.utime(used) # a cache hit
+    evict_cache(str(tmp_path), 2500)
+    assert not os.path.exists(old)
+    assert os.path.exists(recent) and os.path.exists(used)
+    assert sum(size for _, size, _ in get_cache_entries(str(tmp_path))) <= 2500
+
+def test_skips_temp_entries(tmp_path):
+    make_entry(str(tmp_path), "aa00.123.tmp", 1000, 1)
+    assert get_cache_entries(str(tmp_path)) == []
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("torch") # webui/__init__ loads the torch config
+from webui.audio import find_cut_points
+
+def loop_cut_points(audio, window, t_center, t_query):
+    # the per-sample loop VC.pipeline used before find_cut_points
+    audio_pad = np.pad(audio, (window // 2, window // 2), mode="reflect")
+    audio_sum = np.zeros_like(audio)
+    for i in range(window): audio_sum += audio_pad[i:i - window]
+    opt_ts = []
+    for t in range(t_center, audio.shape[0], t_center):
+        abs_audio_sum = np.abs(audio_sum[t - t_query:t + t_query])
+        opt_ts.append(t - t_query + np.where(abs_audio_sum == abs_audio_sum.min())[0][0])
+    return opt_ts
+
+@pytest.mark.parametrize("seconds", [30, 125, 200])
+def test_find_cut_points_matches_loop(seconds):
+    rng = np.random.default_rng(seconds)
+    audio = rng.standard_normal(16000 * seconds) * np.repeat(rng.random(seconds * 10) > .2, 1600) * .3 # noise with gaps
+    t_center, t_query = 16000 * 38, 16000 * 6
+    assert find_cut_points(audio, 160, t_center, t_query) == loop_cut_points(audio, 160, t_center, t_query)
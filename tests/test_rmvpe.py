@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+from lib.rmvpe import RMVPE
+
+@pytest.fixture
+def rmvpe():
+    # decoding only needs the cents mapping, not the network
+    model = RMVPE.__new__(RMVPE)
+    model.cents_mapping = np.pad(20 * np.arange(360) + 1997.3794084376191, (4, 4))
+    return model
+
+def loop_cents(model, salience, thred):
+    # the per-frame loop the vectorized decoder replaced
+    center = np.argmax(salience, axis=1)
+    salience = np.pad(salience, ((0, 0), (4, 4)))
+    center += 4
+    todo_salience = np.array([salience[i, c - 4 : c + 5] for i, c in enumerate(center)])
+    todo_cents_mapping = np.array([model.cents_mapping[c - 4 : c + 5] for c in center])
+    devided = np.sum(todo_salience * todo_cents_mapping, 1) / np.sum(todo_salience, 1)
+    devided[np.max(salience, axis=1) <= thred] = 0
+    return devided
+
+def test_decoders_match_loop(rmvpe):
+    salience = np.random.default_rng(0).random((500, 360)).astype(np.float32) ** 8
+    salience[:100] *= .01 # unvoiced frames, below the threshold
+    expected = loop_cents(rmvpe, salience, .03)
+    np.testing.assert_allclose(rmvpe.to_local_average_cents(salience, thred=.03), expected, rtol=1e-5)
+    np.testing.assert_allclose(rmvpe.to_local_average_cents_torch(torch.from_numpy(salience), thred=.03).numpy(), expected, rtol=1e-4)
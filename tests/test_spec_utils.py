@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("librosa")
+from lib.resampler import resample
+from lib.uvr5_pack import spec_utils
+from lib.uvr5_pack.vr_network.model_param_init import ModelParameters
+
+@pytest.fixture(params=["4band_v2", "4band_v3"])
+def mp(request):
+    return ModelParameters(f"lib/uvr5_pack/vr_network/modelparams/{request.param}.json")
+
+def get_band_waves(mp, seconds=3):
+    bands_n = len(mp.param["band"])
+    rng = np.random.default_rng(0)
+    X_wave = {bands_n: np.asfortranarray(rng.standard_normal((2, mp.param["band"][bands_n]["sr"] * seconds)).astype(np.float32) * .1)}
+    for d in range(bands_n - 1, 0, -1):
+        X_wave[d] = resample(X_wave[d + 1], mp.param["band"][d + 1]["sr"], mp.param["band"][d]["sr"], res_type=mp.param["band"][d]["res_type"])
+    return X_wave
+
+def test_band_pool_matches_serial(mp):
+    X_wave = get_band_waves(mp)
+    specs = {d: spec_utils.wave_to_spectrogram(X_wave[d], mp.param["band"][d]["hl"], mp.param["band"][d]["n_fft"],
+                                               mp.param["mid_side"], mp.param["mid_side_b2"], mp.param["reverse"]) for d in X_wave}
+    expected = spec_utils.combine_spectrograms(specs, mp)
+    spec_m = spec_utils.wave_to_spectrogram_mb(X_wave, mp)[0]
+    assert spec_m.shape == expected.shape
+    np.testing.assert_allclose(spec_m, expected, atol=1e-5)
+
+def test_round_trip_length(mp):
+    X_wave = get_band_waves(mp)
+    spec_m = spec_utils.wave_to_spectrogram_mb(X_wave, mp)[0]
+    wave = spec_utils.cmb_spectrogram_to_wave(spec_m, mp)
+    bands_n = len(mp.param["band"])
+    assert wave.shape[0] == 2
+    assert abs(wave.shape[1] - X_wave[bands_n].shape[1]) <= mp.param["band"][bands_n]["hl"]
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("faiss")
+vc_infer_pipeline = pytest.importorskip("vc_infer_pipeline")
+
+class FakeHubert(torch.nn.Module):
+    # normalizes over the whole input like the first GroupNorm of hubert's conv extractor,
+    # so zero padding changes the features of a padded slice
+    def extract_features(self, source, padding_mask, output_layer):
+        x = (source - source.mean(-1, keepdim=True)) / (source.std(-1, keepdim=True) + 1e-5)
+        frames = x.shape[-1] // 320
+        feats = x[:, :frames * 320].reshape(len(x), frames, 320)[..., :8]
+        return feats, None
+
+    def final_proj(self, x):
+        return x
+
+class FakeNetG:
+    # frame-wise synthesis, 4 samples per frame
+    def infer(self, feats, p_len, sid):
+        return (feats.mean(-1).repeat_interleave(4, dim=-1)[:, None],)
+
+@pytest.fixture
+def vc(tmp_path, monkeypatch):
+    monkeypatch.setattr(vc_infer_pipeline, "CACHED_FEATURES_DIR", str(tmp_path))
+    config = SimpleNamespace(x_pad=1, x_query=6, x_center=38, x_max=41, is_half=False, device="cpu")
+    return vc_infer_pipeline.VC(16000, config)
+
+def run(vc, audios, batched, use_cache):
+    vc.use_feature_cache = use_cache
+    times = [0, 0, 0]
+    sid = torch.tensor([0]).long()
+    args = (None, None, 0, "v2", .5)
+    if batched: return vc.vc_batch(FakeHubert(), FakeNetG(), sid, audios, None, None, times, *args)
+    return [vc.vc(FakeHubert(), FakeNetG(), sid, audio, None, None, times, *args) for audio in audios]
+
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_batched_matches_serial(vc, use_cache):
+    rng = np.random.default_rng(0)
+    audios = [rng.standard_normal(n).astype(np.float32) for n in (16000, 24000, 40000)]
+    batched = run(vc, audios, batched=True, use_cache=use_cache)
+    serial = run(vc, audios, batched=False, use_cache=use_cache) # reads the features the batch cached
+    for b, s in zip(batched, serial):
+        assert b.shape == s.shape
+        np.testing.assert_allclose(b, s, atol=1e-5)
@@ -1,19 +1,65 @@
 import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+from multiprocessing import shared_memory
 import os, sys, torch, warnings
+from time import time as ttime
 
-from lib.separators import MDXNet, UVR5Base, UVR5New
-from webui.audio import load_input_audio, pad_audio, remix_audio, save_input_audio
-from webui.downloader import BASE_CACHE_DIR
+from lib.separation_jobs import finish_stage, get_stage_names
+from lib.separators import MDXNet, UVR5Base, UVR5New, get_vr_spectrogram
+from lib.stem_cache import CACHED_STEMS_DIR, StemCache, get_audio_hash, get_stem_key
+from lib.uvr5_pack.vr_network.model_param_init import ModelParameters
+from webui.audio import MAX_INT16, load_input_audio, remix_audio
 from webui.utils import gc_collect, get_optimal_threads
 
 CWD = os.getcwd()
 if CWD not in sys.path:
     sys.path.append(CWD)
-CACHED_SONGS_DIR = os.path.join(BASE_CACHE_DIR,"songs")
 
 warnings.filterwarnings("ignore")
 import numpy as np
 
+def get_separator_class(model_path):
+    # same rules Separator uses to pick the model
+    if "MDX" in model_path: return MDXNet
+    elif "UVR" in model_path:
+        return UVR5New if "reverb" in model_path.lower() or "echo" in model_path.lower() else UVR5Base
+    return None
+
+class StemMerger:
+    # merges stems as they come in: running nan-aware sum/count for mean, a preallocated stack for median
+    def __init__(self, n_models, merge_type="mean"):
+        self.n_models = n_models
+        self.merge_type = merge_type
+        self.size = None
+        self.n = 0
+        self.stems = {}
+        self.sr = {}
+
+    def add(self, vocals, instrumental):
+        if self.size is None: self.size = len(vocals[0])
+        for name, (audio, sr) in (("vocals", vocals), ("instrumentals", instrumental)):
+            audio = np.asarray(audio, dtype=np.float32)
+            audio = audio[:self.size] if len(audio) >= self.size else np.pad(audio, (0, self.size - len(audio)), constant_values=np.nan)
+            if name not in self.stems:
+                self.sr[name] = sr
+                self.stems[name] = np.full((self.n_models, self.size), np.nan, dtype=np.float32) if self.merge_type=="median" else (
+                    np.zeros(self.size, dtype=np.float32), np.zeros(self.size, dtype=np.float32)) # sum, count
+            if self.merge_type=="median":
+                self.stems[name][self.n] = audio
+            else:
+                total, count = self.stems[name]
+                valid = ~np.isnan(audio)
+                total += np.where(valid, audio, 0)
+                count += valid
+        self.n += 1
+
+    def merge(self, name):
+        if self.merge_type=="median": return np.nanmedian(self.stems[name][:self.n], axis=0), self.sr[name]
+        total, count = self.stems[name]
+        return total / np.maximum(count, 1), self.sr[name]
+
 class Separator:
     def __init__(self, model_path, use_cache=False, device="cpu", cache_dir=None, **kwargs):
         dereverb = "reverb" in model_path.lower()
@@ -26,7 +72,7 @@ class Separator:
             self.model = UVR5New(model_path=model_path,device=device,dereverb=dereverb,**kwargs) if denoise else UVR5Base(model_path=model_path,device=device,**kwargs)
             
         self.use_cache = use_cache
-        self.cache_dir = cache_dir
+        self.stem_cache = StemCache(CACHED_STEMS_DIR if cache_dir is None else cache_dir) if use_cache else None
         self.model_path = model_path
         self.args = kwargs
     
@@ -34,107 +80,209 @@ class Separator:
     def __del__(self):
         gc_collect()
 
-    def run_inference(self, audio_path, format="mp3"):
-        song_name = get_filename(os.path.basename(self.model_path).split(".")[0],**self.args) + f".{format}"
-        
-        # handles loading of previous processed data
-        music_dir = os.path.join(
-            os.path.dirname(audio_path) if self.cache_dir is None else self.cache_dir,
-            os.path.basename(audio_path).split(".")[0])
-        vocals_path = os.path.join(music_dir,".vocals")
-        instrumental_path = os.path.join(music_dir,".instrumental")
-        vocals_file = os.path.join(vocals_path,song_name)
-        instrumental_file = os.path.join(instrumental_path,song_name)
-        os.makedirs(vocals_path,exist_ok=True)
-        os.makedirs(instrumental_path,exist_ok=True)
-        # input_audio = load_input_audio(audio_path,mono=True)
-
-        if os.path.exists(instrumental_file) and os.path.exists(vocals_file):
-            vocals = load_input_audio(vocals_file,mono=True)
-            instrumental = load_input_audio(instrumental_file,mono=True)
-            input_audio = load_input_audio(audio_path,mono=True)
-            return vocals, instrumental, input_audio
+    def get_key(self, audio_path, preprocess_models=[]):
+        return get_stem_key(get_audio_hash(audio_path),self.model_path,preprocess_models,**self.args)
+
+    def run_inference(self, audio_path, key=None):
+        # key defaults to the content hash of audio_path + model + settings
+        if self.stem_cache is not None:
+            key = self.get_key(audio_path) if key is None else key
+            stems = self.stem_cache.get(key)
+            if stems is not None: # input audio isn't reloaded for cached stems
+                return stems["vocals"], stems["instrumentals"], None
         
         return_dict = self.model.run_inference(audio_path)
         instrumental = return_dict["instrumentals"]
         vocals = return_dict["vocals"]
         input_audio = return_dict["input_audio"]
 
-        if self.use_cache:
-            save_input_audio(vocals_file,vocals,to_int16=True)
-            save_input_audio(instrumental_file,instrumental,to_int16=True)
+        if self.stem_cache is not None:
+            self.stem_cache.put(key,{"vocals": vocals, "instrumentals": instrumental})
 
         return vocals, instrumental, input_audio
 
-def get_filename(*args,**kwargs):
-    name = "_".join([str(arg) for arg in args]+[f"{k}={v}" for k,v in kwargs.items()])
-    return name
+SharedArray = namedtuple("SharedArray", ["name", "shape", "dtype", "order"])
 
-def __run_inference_worker(arg):
-    (model_path,audio_path,agg,device,use_cache,cache_dir,num_threads) = arg
-    
-    model = Separator(
+def to_shared(obj, shms):
+    # swaps the numpy arrays in (nested tuples of) obj for shared memory blocks so every worker maps the same copy
+    if isinstance(obj, tuple): return tuple(to_shared(item, shms) for item in obj)
+    if not isinstance(obj, np.ndarray) or obj.nbytes == 0: return obj
+    order = "F" if obj.flags.f_contiguous and not obj.flags.c_contiguous else "C"
+    shm = shared_memory.SharedMemory(create=True, size=obj.nbytes)
+    np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf, order=order)[:] = obj
+    shms.append(shm)
+    return SharedArray(shm.name, obj.shape, obj.dtype.str, order)
+
+def from_shared(obj, shms):
+    # runs in a worker: maps the arrays to_shared put in shared memory (read only, they are shared by all the models)
+    if isinstance(obj, SharedArray):
+        shm = shared_memory.SharedMemory(name=obj.name)
+        shms.append(shm)
+        array = np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf, order=obj.order)
+        array.flags.writeable = False
+        return array
+    if isinstance(obj, tuple): return tuple(from_shared(item, shms) for item in obj)
+    return obj
+
+def __run_ensemble_worker(arg):
+    (model_path,mix,spectrogram,agg,device,num_threads,checkpoint_dir,model_args) = arg
+    start = ttime()
+    shms = []
+    try:
+        mix, spectrogram = from_shared(mix, shms), from_shared(spectrogram, shms)
+        model = Separator(
+                agg=agg,
+                model_path=model_path,
+                device=device,
+                is_half="cuda" in str(device),
+                num_threads = num_threads,
+                checkpoint_dir = checkpoint_dir,
+                **model_args
+                )
+        if spectrogram is None: return_dict = model.model.run_inference(mix)
+        else: return_dict = model.model.run_inference(mix,spectrogram=spectrogram)
+        vocals, instrumental = return_dict["vocals"], return_dict["instrumentals"]
+        del model, mix, spectrogram, return_dict # drops the views of the shared arrays before closing them
+        gc_collect()
+    finally:
+        for shm in shms:
+            try: shm.close()
+            except BufferError: pass # still referenced by a failed run, unmapped when the worker exits
+
+    return model_path, vocals, instrumental, ttime()-start
+
+def run_ensemble(model_paths,mix,agg=10,device="cpu",num_workers=None,checkpoint_dirs=None,model_args=None):
+    # mix is the song decoded once: (float32 audio [n] or [n, channels], sr)
+    # model_args are extra Separator settings (e.g. mdx_overlap, mdx_denoise)
+    # VR models with the same band params share one spectrogram and the models run concurrently in worker processes,
+    # yields (model_path, vocals, instrumental) as each model finishes
+    # checkpoint_dirs (one per model) keep the finished chunks of every model so a rerun resumes after them
+    if len(model_paths)==0: return
+    if checkpoint_dirs is None: checkpoint_dirs = [None]*len(model_paths)
+    if model_args is None: model_args = {}
+    # one model at a time on cuda by default, every worker would load its own cuda context and model into the same vram
+    num_workers = min(len(model_paths), num_workers or (1 if "cuda" in str(device) else os.cpu_count() or 1))
+    num_threads = max(int(get_optimal_threads(-1))//num_workers,1)
+    audio, sr = mix
+    audio = np.stack([audio,audio],axis=-1) if audio.ndim==1 else audio[:,:2]
+    mix = (np.ascontiguousarray(audio,dtype=np.float32), sr)
+
+    spectrograms = {}
+    model_params = []
+    for model_path in model_paths:
+        separator_class = get_separator_class(model_path)
+        params = separator_class.model_params if separator_class is not None and issubclass(separator_class, UVR5Base) else None
+        if params is not None and params not in spectrograms:
+            spectrograms[params] = get_vr_spectrogram(ModelParameters(params), mix)
+        model_params.append(params)
+
+    pool = None
+    shms = []
+    start = ttime()
+    try:
+        if num_workers==1:
+            args = [(model_path,mix,spectrograms.get(params),agg,device,num_threads,checkpoint_dir,model_args)
+                    for model_path, params, checkpoint_dir in zip(model_paths, model_params, checkpoint_dirs)]
+            results = map(__run_ensemble_worker, args)
+        else:
+            # the workers map the mix and spectrograms from shared memory instead of each unpickling a copy
+            shared_mix = to_shared(mix, shms)
+            shared_spectrograms = {params: to_shared(spectrogram, shms) for params, spectrogram in spectrograms.items()}
+            args = [(model_path,shared_mix,shared_spectrograms.get(params),agg,device,num_threads,checkpoint_dir,model_args)
+                    for model_path, params, checkpoint_dir in zip(model_paths, model_params, checkpoint_dirs)]
+            # spawn since the workers use torch (and maybe cuda)
+            pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"))
+            results = (future.result() for future in as_completed([pool.submit(__run_ensemble_worker, arg) for arg in args]))
+        del spectrograms
+        for model_path, vocals, instrumental, elapsed in results:
+            print(f"{os.path.basename(model_path)} done in {elapsed:.1f}s ({ttime()-start:.1f}s since start)")
+            yield model_path, vocals, instrumental
+    finally:
+        if pool is not None: pool.shutdown(cancel_futures=True)
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+def run_preprocess_chain(preprocess_models,audio_path,agg=10,device="cpu",stem_cache=None,checkpoint=False,checkpoint_dirs=None,model_args=None):
+    # dereverb/deecho models keep their "instrumental" output, stages hand float32 arrays to each other in memory.
+    # the final output (and with checkpoint=True every stage) goes to the stem cache, a rerun resumes after the last cached stage
+    # and checkpoint_dirs (one per model) resume a stage after its last finished chunk
+    # returns (float32 audio [n] or [n, channels], sr)
+    if checkpoint_dirs is None: checkpoint_dirs = [None]*len(preprocess_models)
+    if model_args is None: model_args = {}
+    num_threads = max(int(get_optimal_threads(-1)),1)
+    audio_hash = get_audio_hash(audio_path) if stem_cache is not None else None
+    key_args = dict(agg=agg,is_half="cuda" in str(device),**model_args)
+    keys = [get_stem_key(audio_hash,model_path,preprocess_models[:i],**key_args) for i,model_path in enumerate(preprocess_models)] if stem_cache is not None else []
+
+    mix, first_stage = None, 0
+    for i in reversed(range(len(keys))):
+        stems = stem_cache.get(keys[i],names=["instrumentals"])
+        if stems is not None:
+            audio, sr = stems["instrumentals"]
+            mix = (audio.astype(np.float32)/MAX_INT16 if audio.dtype==np.int16 else np.asarray(audio,dtype=np.float32), sr)
+            first_stage = i+1
+            for checkpoint_dir in checkpoint_dirs[:first_stage]: finish_stage(checkpoint_dir)
+            break
+    if mix is None:
+        audio, sr = load_input_audio(audio_path,sr=44100,mono=False)
+        mix = (audio.T, sr)
+
+    for i in range(first_stage,len(preprocess_models)):
+        start = ttime()
+        model = Separator(
             agg=agg,
-            model_path=model_path,
+            model_path=preprocess_models[i],
             device=device,
             is_half="cuda" in str(device),
-            use_cache=use_cache,
-            cache_dir=cache_dir,
-            num_threads = num_threads
-            )
-    vocals, instrumental, input_audio = model.run_inference(audio_path)
-    del model
-    gc_collect()
+            num_threads=num_threads,
+            checkpoint_dir=checkpoint_dirs[i],
+            **model_args
+        )
+        model.model.output_int16 = False
+        mix = model.model.run_inference(mix)["instrumentals"]
+        del model
+        gc_collect()
+        print(f"preprocess {i}: {os.path.basename(preprocess_models[i])} done in {ttime()-start:.1f}s")
 
-    return vocals, instrumental, input_audio
-    
-def split_audio(model_paths,audio_path,preprocess_models=[],device="cuda",agg=10,use_cache=False,merge_type="mean",**kwargs):
+        if stem_cache is not None and (checkpoint or i==len(preprocess_models)-1):
+            stem_cache.put(keys[i],{"instrumentals": mix})
+        finish_stage(checkpoint_dirs[i])
+    return mix
+
+def split_audio(model_paths,audio_path,preprocess_models=[],device="cuda",agg=10,use_cache=False,merge_type="mean",ensemble_workers=None,work_dir=None,mdx_overlap=None,mdx_denoise=False,**kwargs):
     print(f"unused kwargs={kwargs}")
-    merge_func = np.nanmedian if merge_type=="median" else np.nanmean
-    num_threads = max(get_optimal_threads(-1),1)
-    song_name = os.path.basename(audio_path).split(".")[0]
-    cache_dir = CACHED_SONGS_DIR
-
-    if len(preprocess_models):
-        output_name = get_filename(*[os.path.basename(name).split(".")[0] for name in preprocess_models],agg=agg) + ".mp3"
-        preprocessed_file = os.path.join(cache_dir,song_name,output_name)
-        
-        # read from cache
-        if os.path.isfile(preprocessed_file): input_audio = load_input_audio(preprocessed_file,mono=True)
-        else: # preprocess audio
-            for i,preprocess_model in enumerate(preprocess_models):
-                output_name = get_filename(i,os.path.basename(preprocess_model).split(".")[0],agg=agg) + ".mp3"
-                intermediary_file = os.path.join(cache_dir,song_name,output_name)
-                if os.path.isfile(intermediary_file):
-                    if i==len(preprocess_model)-1: #last model
-                        input_audio = load_input_audio(intermediary_file, mono=True)
-                else:
-                    args = (preprocess_model,audio_path,agg,device,use_cache,CACHED_SONGS_DIR if i==0 else None,num_threads)
-                    _, instrumental, input_audio = __run_inference_worker(args)
-                    output_name = get_filename(i,os.path.basename(preprocess_model).split(".")[0],agg=agg) + ".mp3"
-                    save_input_audio(intermediary_file,instrumental,to_int16=True)
-                audio_path = intermediary_file
-
-            save_input_audio(preprocessed_file,instrumental,to_int16=True)
-        audio_path = preprocessed_file
-        cache_dir = os.path.join(CACHED_SONGS_DIR,song_name)
-    else:
-        input_audio = load_input_audio(audio_path,mono=True)
-        cache_dir = CACHED_SONGS_DIR
-        
-    wav_instrument = []
-    wav_vocals = []
+    model_args = dict(mdx_overlap=mdx_overlap,mdx_denoise=mdx_denoise) # passed to every Separator (and part of the stem keys)
+    # stems are keyed by the original song's content, so cache hits skip loading the models (and the preprocess chain) entirely
+    stem_cache = StemCache() if use_cache else None
+    audio_hash = get_audio_hash(audio_path) if use_cache else None
+    key_args = dict(agg=agg,is_half="cuda" in str(device),**model_args)
+    # with a work_dir (see lib.separation_jobs) every model keeps its finished chunks there, a rerun resumes after them
+    checkpoint_dirs = [None]*(len(preprocess_models)+len(model_paths)) if work_dir is None else [
+        os.path.join(work_dir,stage) for stage in get_stage_names(model_paths,preprocess_models)]
+    preprocess_dirs, model_dirs = checkpoint_dirs[:len(preprocess_models)], checkpoint_dirs[len(preprocess_models):]
 
-    for model_path in model_paths:
-        args = (model_path,audio_path,agg,device,use_cache,cache_dir,num_threads)
-        vocals, instrumental, _ = __run_inference_worker(args)
-        wav_vocals.append(vocals[0])
-        wav_instrument.append(instrumental[0])
+    # decoded once, shared by every model in the ensemble
+    mix = run_preprocess_chain(preprocess_models,audio_path,agg=agg,device=device,stem_cache=stem_cache,checkpoint=use_cache,checkpoint_dirs=preprocess_dirs,model_args=model_args)
+    input_audio = (mix[0] if mix[0].ndim==1 else mix[0].mean(axis=-1), mix[1])
 
-    wav_instrument = merge_func(pad_audio(*wav_instrument),axis=0)
-    wav_vocals = merge_func(pad_audio(*wav_vocals),axis=0)
-    instrumental = remix_audio((wav_instrument,instrumental[1]),norm=True,to_int16=True,to_mono=True)
-    vocals = remix_audio((wav_vocals,vocals[1]),norm=True,to_int16=True,to_mono=True)
+    merger = StemMerger(len(model_paths),merge_type)
+    missing = {}
+    for model_path, checkpoint_dir in zip(model_paths,model_dirs):
+        stems = stem_cache.get(get_stem_key(audio_hash,model_path,preprocess_models,**key_args)) if stem_cache is not None else None
+        if stems is None: missing[model_path] = checkpoint_dir
+        else:
+            merger.add(stems["vocals"],stems["instrumentals"])
+            finish_stage(checkpoint_dir)
+
+    for model_path, vocals, instrumental in run_ensemble(list(missing),mix,agg=agg,device=device,num_workers=ensemble_workers,checkpoint_dirs=list(missing.values()),model_args=model_args):
+        if stem_cache is not None: stem_cache.put(get_stem_key(audio_hash,model_path,preprocess_models,**key_args),{"vocals": vocals, "instrumentals": instrumental})
+        merger.add(vocals,instrumental)
+        finish_stage(missing[model_path])
+    if stem_cache is not None: print(stem_cache)
+
+    instrumental = remix_audio(merger.merge("instrumentals"),norm=True,to_int16=True,to_mono=True)
+    vocals = remix_audio(merger.merge("vocals"),norm=True,to_int16=True,to_mono=True)
 
     return vocals, instrumental, input_audio
 
@@ -158,6 +306,15 @@ def main(): #uvr5_models,audio_path,device="cuda",agg=10,use_cache=False
     parser.add_argument(
         "-m", "--merge_type", type=str, default="median", choices=["mean","median"], help="how to combine processed audio"
     )
+    parser.add_argument(
+        "--mdx_overlap", type=float, default=None, help="overlap ratio (e.g. .25) for windowed overlap-add MDX demixing instead of margin chunking"
+    )
+    parser.add_argument(
+        "--mdx_denoise", action="store_true", default=False, help="run MDX models on the mix and its negation and average them (slower, less noise)"
+    )
+    parser.add_argument(
+        "-w", "--work_dir", type=str, default=None, help="keeps finished chunks here so an interrupted run resumes where it stopped"
+    )
     parser.add_argument(
         "-c", "--use_cache", type=bool, action="store_true", default=False, help="caches the results so next run is faster"
     )
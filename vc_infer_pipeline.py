@@ -1,3 +1,5 @@
+from functools import lru_cache
+import hashlib
 import numpy as np, torch, sys, os
 from time import time as ttime
 import torch.nn.functional as F
@@ -9,14 +11,26 @@ from tqdm import tqdm
 
 from pitch_extraction import FeatureExtractor
 
-from webui.audio import load_input_audio, remix_audio
+from webui.audio import find_cut_points, load_input_audio, remix_audio
 from webui import config
 
 CWD = os.getcwd()
 if CWD not in sys.path:
     sys.path.append(CWD)
 
-from webui.utils import gc_collect, get_filenames
+from webui.downloader import BASE_CACHE_DIR
+from webui.utils import gc_collect, get_filenames, save_npy
+from lib.model_registry import ModelRegistry, get_model_key
+from lib.resampler import resample
+from lib.stem_cache import evict_cache
+
+HUBERT_MODEL_PATH = "./models/hubert_base.pt"
+CACHED_INDEX_DIR = os.path.join(BASE_CACHE_DIR,"index")
+INDEX_CACHE_MAX_SIZE = 2*1024**3 # bytes, sidecars of the least recently loaded indexes are evicted past this
+CACHED_FEATURES_DIR = os.path.join(BASE_CACHE_DIR,"hubert")
+FEATURE_CACHE_MAX_SIZE = 2*1024**3 # bytes, least recently used slices are evicted past this
+HUBERT_CACHE_STATS = {"hits": 0, "misses": 0}
+MODEL_REGISTRY = ModelRegistry(max_memory=config.model_memory*1024**2 if config.model_memory else None)
 
 # torchcrepe = lazyload("torchcrepe")  # Fork Feature. Crepe algo for training and preprocess
 # torch = lazyload("torch")
@@ -47,6 +61,8 @@ def change_rms(data1, sr1, data2, sr2, rate):  # 1是输入音频，2是输出
 
 
 class VC(FeatureExtractor):
+    use_f0_cache = True # the same vocals get converted with many voices/settings
+    use_feature_cache = True
 
     def vc(
         self,
@@ -62,27 +78,10 @@ class VC(FeatureExtractor):
         index_rate,
         version,
         protect,
+        use_cache=None,
     ):  # ,file_index,file_big_npy
-        feats = torch.from_numpy(audio0)
-        if self.is_half:
-            feats = feats.half()
-        else:
-            feats = feats.float()
-        if feats.dim() == 2:  # double channels
-            feats = feats.mean(-1)
-        assert feats.dim() == 1, feats.dim()
-        feats = feats.view(1, -1)
-        padding_mask = torch.BoolTensor(feats.shape).to(self.device).fill_(False)
-
-        inputs = {
-            "source": feats.to(self.device),
-            "padding_mask": padding_mask,
-            "output_layer": 9 if version == "v1" else 12,
-        }
         t0 = ttime()
-        with torch.no_grad():
-            logits = model.extract_features(**inputs)
-            feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+        feats = self.extract_features(model, audio0, version, use_cache=use_cache)
         if protect < 0.5 and pitch != None and pitchf != None:
             feats0 = feats.clone()
         if (
@@ -142,7 +141,7 @@ class VC(FeatureExtractor):
                 audio1 = (
                     (net_g.infer(feats, p_len, sid)[0][0, 0]).data.cpu().float().numpy()
                 )
-        del feats, p_len, padding_mask
+        del feats, p_len
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         t2 = ttime()
@@ -150,6 +149,137 @@ class VC(FeatureExtractor):
         times[2] += t2 - t1
         return audio1
 
+    def extract_features(self, model, audio0, version, use_cache=None):
+        # hubert features only depend on the 16k audio and the output layer, not on the voice
+        cache_file = None
+        if self.use_feature_cache if use_cache is None else use_cache:
+            cache_file = get_feature_cache_file(audio0, version, self.is_half)
+            if os.path.isfile(cache_file):
+                HUBERT_CACHE_STATS["hits"] += 1
+                os.utime(os.path.dirname(cache_file)) # marks the slice as recently used
+                # copy-on-write map: on cpu the tensor reads straight from the page cache, .to() only copies for other devices
+                return torch.from_numpy(np.load(cache_file, mmap_mode="c")).unsqueeze(0).to(self.device)
+            HUBERT_CACHE_STATS["misses"] += 1
+
+        feats = torch.from_numpy(audio0)
+        if self.is_half:
+            feats = feats.half()
+        else:
+            feats = feats.float()
+        if feats.dim() == 2:  # double channels
+            feats = feats.mean(-1)
+        assert feats.dim() == 1, feats.dim()
+        feats = feats.view(1, -1)
+        padding_mask = torch.BoolTensor(feats.shape).to(self.device).fill_(False)
+
+        inputs = {
+            "source": feats.to(self.device),
+            "padding_mask": padding_mask,
+            "output_layer": 9 if version == "v1" else 12,
+        }
+        with torch.no_grad():
+            logits = model.extract_features(**inputs)
+            feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+        if cache_file: save_npy(cache_file, feats[0].cpu().numpy())
+        return feats
+
+    def vc_batch(
+        self,
+        model,
+        net_g,
+        sid,
+        audios,
+        pitches,
+        pitchfs,
+        times,
+        index,
+        big_npy,
+        index_rate,
+        version,
+        protect,
+    ):  # same as vc but runs net_g once over a zero-padded [B, T] batch of slices
+        batch_size = len(audios)
+        lengths = [audio0.shape[0] for audio0 in audios]
+        use_pitch = pitches is not None and pitchfs is not None
+        t0 = ttime()
+        feats, valid = self.extract_features_batch(model, audios, version)
+        if protect < 0.5 and use_pitch:
+            feats0 = feats.clone()
+        if (
+            isinstance(index, type(None)) == False
+            and isinstance(big_npy, type(None)) == False
+            and index_rate != 0
+        ):
+            npy = feats[valid].cpu().numpy()
+            if self.is_half:
+                npy = npy.astype("float32")
+
+            score, ix = index.search(npy, k=8)
+            weight = np.square(1 / score)
+            weight /= weight.sum(axis=1, keepdims=True)
+            npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
+
+            if self.is_half:
+                npy = npy.astype("float16")
+            retrieved = feats.clone()
+            retrieved[valid] = torch.from_numpy(npy).to(self.device)
+            feats = retrieved * index_rate + (1 - index_rate) * feats
+
+        feats = F.interpolate(feats.permute(0, 2, 1), scale_factor=2).permute(0, 2, 1)
+        if protect < 0.5 and use_pitch:
+            feats0 = F.interpolate(feats0.permute(0, 2, 1), scale_factor=2).permute(
+                0, 2, 1
+            )
+        t1 = ttime()
+        n_valid = (valid.sum(dim=1) * 2).tolist()
+        p_lens = [min(lengths[i] // self.window, n_valid[i]) for i in range(batch_size)]
+        max_p_len = max(p_lens)
+        feats = feats[:, :max_p_len]
+
+        if use_pitch:
+            pitch = torch.zeros(batch_size, max_p_len, dtype=pitches[0].dtype, device=self.device)
+            pitchf = torch.zeros(batch_size, max_p_len, dtype=pitchfs[0].dtype, device=self.device)
+            for i in range(batch_size):
+                pitch[i, : p_lens[i]] = pitches[i][0, : p_lens[i]]
+                pitchf[i, : p_lens[i]] = pitchfs[i][0, : p_lens[i]]
+
+        if protect < 0.5 and use_pitch:
+            feats0 = feats0[:, :max_p_len]
+            pitchff = pitchf.clone()
+            pitchff[pitchf > 0] = 1
+            pitchff[pitchf < 1] = protect
+            pitchff = pitchff.unsqueeze(-1)
+            feats = feats * pitchff + feats0 * (1 - pitchff)
+            feats = feats.to(feats0.dtype)
+        p_len = torch.tensor(p_lens, device=self.device).long()
+        sids = sid.expand(batch_size)
+        with torch.no_grad():
+            if use_pitch:
+                audio1 = net_g.infer(feats, p_len, pitch, pitchf, sids)[0][:, 0]
+            else:
+                audio1 = net_g.infer(feats, p_len, sids)[0][:, 0]
+            audio1 = audio1.data.cpu().float().numpy()
+        # every frame is upsampled by the same factor, so trim each row back to its own length
+        upp = audio1.shape[-1] // max_p_len
+        audio_opt = [audio1[i, : p_lens[i] * upp] for i in range(batch_size)]
+        del feats, p_len, audio1
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        t2 = ttime()
+        times[0] += t1 - t0
+        times[2] += t2 - t1
+        return audio_opt
+
+    def extract_features_batch(self, model, audios, version, use_cache=None):
+        # returns [B, T, C] features and a [B, T] mask of the frames that aren't padding.
+        # hubert's conv feature extractor normalizes over the whole time axis, zero padding included,
+        # so every slice goes through hubert on its own (same features and cache entries as vc) and only net_g is batched
+        feats = [self.extract_features(model, audio0, version, use_cache=use_cache)[0] for audio0 in audios]
+        lengths = torch.tensor([len(f) for f in feats], device=self.device)
+        feats = torch.nn.utils.rnn.pad_sequence(feats, batch_first=True)
+        valid = torch.arange(feats.shape[1], device=self.device)[None] < lengths[:, None]
+        return feats, valid
+
     def process_t(self, t, s, window, audio_pad, pitch, pitchf, times, index, big_npy, index_rate, version, protect, t_pad_tgt, if_f0, sid, model, net_g):
         t = t // window * window
         if if_f0 == 1:
@@ -185,7 +315,7 @@ class VC(FeatureExtractor):
 
     def pipeline(self, model, net_g, sid, audio, times, f0_up_key, f0_method, merge_type,
             file_index, index_rate, if_f0, filter_radius, tgt_sr, resample_sr, rms_mix_rate,
-            version, protect, crepe_hop_length, f0_autotune, rmvpe_onnx, f0_file=None, f0_min=50, f0_max=1100):
+            version, protect, crepe_hop_length, f0_autotune, rmvpe_onnx, f0_file=None, f0_min=50, f0_max=1100, batch_size=1):
         
         try:
             if file_index == "":
@@ -199,27 +329,18 @@ class VC(FeatureExtractor):
                 else:
                     sys.stdout.write(f"Attempting to load {file_index}.... (despite it not existing)\n")
                     sys.stdout.flush()
-                index = faiss.read_index(file_index)
+                index, big_npy = load_index(file_index)
                 sys.stdout.write(f"loaded index: {index}\n")
-                big_npy = index.reconstruct_n(0, index.ntotal)
         except Exception as e:
             print(f"Could not open Faiss index file for reading. {e}")
             index = None
             big_npy = None
 
         audio = signal.filtfilt(bh, ah, audio)
-        audio_pad = np.pad(audio, (self.window // 2, self.window // 2), mode="reflect")
         opt_ts = []
         
-        if audio_pad.shape[0] > self.t_max:
-            audio_sum = np.zeros_like(audio)
-            for i in range(self.window):
-                audio_sum += audio_pad[i : i - self.window]
-            
-            for t in range(self.t_center, audio.shape[0], self.t_center):
-                abs_audio_sum = np.abs(audio_sum[t - self.t_query : t + self.t_query])
-                min_abs_audio_sum = abs_audio_sum.min()
-                opt_ts.append(t - self.t_query + np.where(abs_audio_sum == min_abs_audio_sum)[0][0])
+        if audio.shape[0] + self.window > self.t_max:
+            opt_ts = find_cut_points(audio, self.window, self.t_center, self.t_query)
 
         s = 0
         audio_opt = []
@@ -252,7 +373,7 @@ class VC(FeatureExtractor):
         t2 = ttime()
         times[1] += t2 - t1
 
-        # with tqdm(total=len(opt_ts), desc="Processing", unit="window") as pbar:
+        slices = []
         for i, t in enumerate(opt_ts):
             t = t // self.window * self.window
             start = s
@@ -260,21 +381,37 @@ class VC(FeatureExtractor):
             audio_slice = audio_pad[start:end]
             pitch_slice = pitch[:, start // self.window:end // self.window] if if_f0 else None
             pitchf_slice = pitchf[:, start // self.window:end // self.window] if if_f0 else None
-            audio_opt.append(self.vc(model, net_g, sid, audio_slice, pitch_slice, pitchf_slice, times, index, big_npy, index_rate, version, protect)[self.t_pad_tgt : -self.t_pad_tgt])
+            slices.append((audio_slice, pitch_slice, pitchf_slice))
             s = t
-                # pbar.update(1)
-                # pbar.refresh()
 
         audio_slice = audio_pad[t:]
         pitch_slice = pitch[:, t // self.window:] if if_f0 and t is not None else pitch
         pitchf_slice = pitchf[:, t // self.window:] if if_f0 and t is not None else pitchf
-        audio_opt.append(self.vc(model, net_g, sid, audio_slice, pitch_slice, pitchf_slice, times, index, big_npy, index_rate, version, protect)[self.t_pad_tgt : -self.t_pad_tgt])
-        
+        slices.append((audio_slice, pitch_slice, pitchf_slice))
+
+        if batch_size > 1 and len(slices) > 1:
+            # group slices of similar length together to minimize padding
+            order = sorted(range(len(slices)), key=lambda i: slices[i][0].shape[0])
+            audio_opt = [None] * len(slices)
+            for b in range(0, len(order), batch_size):
+                batch = order[b : b + batch_size]
+                results = self.vc_batch(
+                    model, net_g, sid,
+                    [slices[i][0] for i in batch],
+                    [slices[i][1] for i in batch] if if_f0 else None,
+                    [slices[i][2] for i in batch] if if_f0 else None,
+                    times, index, big_npy, index_rate, version, protect)
+                for i, audio1 in zip(batch, results):
+                    audio_opt[i] = audio1[self.t_pad_tgt : -self.t_pad_tgt]
+        else:
+            for audio_slice, pitch_slice, pitchf_slice in slices:
+                audio_opt.append(self.vc(model, net_g, sid, audio_slice, pitch_slice, pitchf_slice, times, index, big_npy, index_rate, version, protect)[self.t_pad_tgt : -self.t_pad_tgt])
+
         audio_opt = np.concatenate(audio_opt)
         if rms_mix_rate != 1:
             audio_opt = change_rms(audio, 16000, audio_opt, tgt_sr, rms_mix_rate)
         if resample_sr >= 16000 and tgt_sr != resample_sr:
-            audio_opt = librosa.resample(audio_opt, orig_sr=tgt_sr, target_sr=resample_sr)
+            audio_opt = resample(audio_opt, tgt_sr, resample_sr)
 
         max_int16 = 32768
         audio_max = max(np.abs(audio_opt).max() / 0.99, 1)
@@ -282,15 +419,61 @@ class VC(FeatureExtractor):
 
         gc_collect()
 
+        if self.use_feature_cache: evict_cache(CACHED_FEATURES_DIR, FEATURE_CACHE_MAX_SIZE)
+        print(f"hubert feature cache: {HUBERT_CACHE_STATS}")
         print("Returning completed audio...")
         print("-------------------")
         
         return audio_opt
 
+def get_feature_cache_file(audio, version, is_half):
+    audio_hash = hashlib.md5(np.ascontiguousarray(audio).view(np.uint8)).hexdigest()
+    layer = "layer9_proj" if version == "v1" else "layer12"
+    return os.path.join(CACHED_FEATURES_DIR, audio_hash[:2], audio_hash, f"{layer}_{'fp16' if is_half else 'fp32'}.npy")
+
+def load_index(file_index, use_mmap=True):
+    # cached per file version so edits to the index are picked up
+    stat = os.stat(file_index)
+    return read_index(os.path.abspath(file_index), stat.st_mtime, stat.st_size, use_mmap)
+
+@lru_cache(maxsize=8)
+def read_index(file_index, mtime, size, use_mmap=True):
+    index = faiss.read_index(file_index)
+    if not use_mmap:
+        return index, index.reconstruct_n(0, index.ntotal)
+
+    # big_npy is saved next to the cache so other processes can share one memory-mapped copy,
+    # one entry per index path (models in different folders can have the same index name) holding its current version
+    name = os.path.basename(file_index).split(".")[0]
+    path_hash = hashlib.md5(file_index.encode()).hexdigest()
+    entry_dir = os.path.join(CACHED_INDEX_DIR, path_hash[:2], path_hash)
+    npy_file = os.path.join(entry_dir, f"{name}.{int(mtime)}.{size}.npy")
+    if os.path.isfile(npy_file):
+        os.utime(entry_dir) # marks the index as recently used
+    else:
+        evict_cache(CACHED_INDEX_DIR, INDEX_CACHE_MAX_SIZE) # before saving so the new sidecar is never the one evicted
+        save_npy(npy_file, index.reconstruct_n(0, index.ntotal))
+        for entry in os.scandir(entry_dir): # sidecars of older versions of this index
+            if entry.name.endswith(".npy") and entry.path != npy_file:
+                try: os.remove(entry.path)
+                except OSError: pass # still mapped by another process (windows)
+    return index, np.load(npy_file, mmap_mode="r")
+
 def get_vc(model_path,config,device=None):
-    
+    device = device if device else config.device
+    synthesizer = MODEL_REGISTRY.get(
+        get_model_key(model_path,device,config.is_half),
+        lambda: load_synthesizer(model_path,config,device))
+    cpt, net_g = synthesizer["cpt"], synthesizer["net_g"]
+    vc = VC(cpt["config"][-1], config)
+    hubert_model = load_hubert(config)
+    model_name = os.path.basename(model_path).split(".")[0]
+    index_file = get_filenames(root="./models/RVC",folder=".index",exts=["index"],name_filters=[model_name])
+    return {"vc": vc, "cpt": cpt, "net_g": net_g, "hubert_model": hubert_model,"model_name": model_name,
+            "file_index": index_file[0] if len(index_file) else ""}
+
+def load_synthesizer(model_path,config,device):
     cpt = torch.load(model_path, map_location="cpu")
-    tgt_sr = cpt["config"][-1]
     cpt["config"][-3] = cpt["weight"]["emb_g.weight"].shape[0]  # n_spk
     if_f0 = cpt.get("f0", 1)
     version = cpt.get("version", "v1")
@@ -311,38 +494,40 @@ def get_vc(model_path,config,device=None):
             net_g = SynthesizerTrnMs768NSFsid_nono(*cpt["config"])
     del net_g.enc_q
     
-    net_g.load_state_dict(cpt["weight"], strict=False)
-    net_g.eval().to(device if device else config.device)
+    net_g.load_state_dict(cpt.pop("weight"), strict=False) # weights live in net_g, no need to keep a second copy
+    net_g.eval().to(device)
     if config.is_half:
         net_g = net_g.half()
     else:
         net_g = net_g.float()
-    vc = VC(tgt_sr, config)
-    hubert_model = load_hubert(config)
-    model_name = os.path.basename(model_path).split(".")[0]
-    index_file = get_filenames(root="./models/RVC",folder=".index",exts=["index"],name_filters=[model_name])
-    return {"vc": vc, "cpt": cpt, "net_g": net_g, "hubert_model": hubert_model,"model_name": model_name,
-            "file_index": index_file[0] if len(index_file) else ""}
+    return {"cpt": cpt, "net_g": net_g}
 
 def load_hubert(config):
     try:
-        from fairseq import checkpoint_utils
-        models, _, _ = checkpoint_utils.load_model_ensemble_and_task(
-            ["./models/hubert_base.pt"],
-            suffix="",
-        )
-        hubert_model = models[0]
-        hubert_model = hubert_model.to(config.device)
-        if config.is_half:
-            hubert_model = hubert_model.half()
-        else:
-            hubert_model = hubert_model.float()
-        hubert_model.eval()
-        return hubert_model
+        # hubert is the same for every voice so it stays loaded
+        return MODEL_REGISTRY.get(
+            get_model_key(HUBERT_MODEL_PATH,config.device,config.is_half),
+            lambda: load_hubert_model(config),
+            pinned=True)
     except Exception as e:
         print(e)
         return None
 
+def load_hubert_model(config):
+    from fairseq import checkpoint_utils
+    models, _, _ = checkpoint_utils.load_model_ensemble_and_task(
+        [HUBERT_MODEL_PATH],
+        suffix="",
+    )
+    hubert_model = models[0]
+    hubert_model = hubert_model.to(config.device)
+    if config.is_half:
+        hubert_model = hubert_model.half()
+    else:
+        hubert_model = hubert_model.float()
+    hubert_model.eval()
+    return hubert_model
+
 def vc_single(
         cpt=None,
         net_g=None,
@@ -364,6 +549,7 @@ def vc_single(
     crepe_hop_length=160,
     f0_autotune=False,
     is_onnx=False,
+    batch_size=1,
     config=config,
     **kwargs #prevents function from breaking
 ):
@@ -414,6 +600,7 @@ def vc_single(
             protect,
             crepe_hop_length, f0_autotune, is_onnx,
             f0_file=f0_file,
+            batch_size=batch_size,
         )
         
         index_info = (
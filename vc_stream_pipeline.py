@@ -0,0 +1,205 @@
+import os, sys
+from time import time as ttime
+import numpy as np
+import librosa
+import torch
+from scipy import signal
+
+CWD = os.getcwd()
+if CWD not in sys.path:
+    sys.path.append(CWD)
+
+from lib.resampler import resample
+from vc_infer_pipeline import bh, ah, load_index
+
+class StreamingVC:
+    """
+    Converts audio block by block (e.g. from a sounddevice callback) instead of whole clips.
+
+    Every block is appended to a rolling 16k buffer that gives hubert and the pitch extractor
+    `context_time` seconds of history. The tail of each conversion is aligned to the previous
+    output with SOLA (synchronized overlap-add) and crossfaded, so the algorithmic latency is
+    block_time + crossfade_time + sola_search_time.
+    """
+
+    def __init__(
+        self,
+        vc=None,
+        cpt=None,
+        net_g=None,
+        hubert_model=None,
+        file_index="",
+        sid=0,
+        f0_up_key=0,
+        f0_method="rmvpe",
+        merge_type="median",
+        index_rate=.75,
+        protect=0.33,
+        filter_radius=3,
+        crepe_hop_length=160,
+        f0_autotune=False,
+        input_sr=16000,
+        block_time=0.25,
+        context_time=1.0,
+        crossfade_time=0.05,
+        sola_search_time=0.01,
+        latency=None, # if set, picks the largest block_time that fits the target
+        **kwargs #prevents function from breaking
+    ):
+        print(f"StreamingVC unused args: {kwargs}")
+        self.vc = vc
+        self.net_g = net_g
+        self.hubert_model = hubert_model
+        self.tgt_sr = cpt["config"][-1]
+        self.if_f0 = cpt.get("f0", 1)
+        self.version = cpt.get("version", "v1")
+        self.f0_up_key = int(f0_up_key)
+        self.f0_method = f0_method if type(f0_method)==str or len(f0_method)>1 else f0_method[0]
+        self.merge_type = merge_type
+        self.index_rate = index_rate
+        self.protect = protect
+        self.filter_radius = filter_radius
+        self.crepe_hop_length = crepe_hop_length
+        self.f0_autotune = f0_autotune
+        self.input_sr = input_sr
+        self.sid = torch.tensor(sid, device=vc.device).unsqueeze(0).long()
+        self.index, self.big_npy = None, None
+        if file_index and os.path.isfile(file_index) and index_rate:
+            self.index, self.big_npy = load_index(file_index)
+
+        window = vc.window # 160 samples at 16k == 1 output frame
+        self.zc = self.tgt_sr // 100 # output samples per frame
+        if latency is not None:
+            block_time = max(latency - crossfade_time - sola_search_time, window / vc.sr)
+        to_frames = lambda t: max(int(round(t * vc.sr / window)), 1)
+        self.block_frames = to_frames(block_time)
+        self.crossfade_frames = to_frames(crossfade_time)
+        self.sola_search_frames = to_frames(sola_search_time)
+        self.context_frames = to_frames(context_time)
+        extra_frames = self.crossfade_frames + self.sola_search_frames
+
+        # sizes at 16k
+        self.block_size = self.block_frames * window
+        self.input_size = (self.context_frames + extra_frames + self.block_frames) * window
+        self.input_buffer = np.zeros(self.input_size, dtype=np.float32)
+        # sizes at tgt_sr
+        self.output_block_size = self.block_frames * self.zc
+        self.crossfade_size = self.crossfade_frames * self.zc
+        self.sola_search_size = self.sola_search_frames * self.zc
+        self.sola_buffer = np.zeros(self.crossfade_size, dtype=np.float32)
+        self.fade_in = np.sin(0.5 * np.pi * np.linspace(0., 1., self.crossfade_size, dtype=np.float32)) ** 2
+        self.fade_out = 1 - self.fade_in
+
+        self.times = [0, 0, 0] # hubert, f0, net_g (same as vc_single)
+        self.block_times = []
+        self.pending = np.zeros(0, dtype=np.float32) # input that doesn't fill a whole block yet
+
+    def __repr__(self):
+        return f"StreamingVC(tgt_sr={self.tgt_sr}, block={self.block_time*1000:.0f}ms, latency={self.latency*1000:.0f}ms)"
+
+    @property
+    def block_time(self):
+        return self.block_size / self.vc.sr
+
+    @property
+    def latency(self):
+        # algorithmic latency, processing time comes on top of this
+        return (self.block_frames + self.crossfade_frames + self.sola_search_frames) * self.vc.window / self.vc.sr
+
+    @property
+    def input_block_size(self):
+        # how many samples at input_sr make up one block
+        return int(round(self.block_size * self.input_sr / self.vc.sr))
+
+    def reset(self):
+        self.input_buffer[:] = 0
+        self.sola_buffer[:] = 0
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.times = [0, 0, 0]
+        self.block_times = []
+
+    def infer(self, audio):
+        # converts the whole rolling buffer and returns the part needed for SOLA + the new block
+        vc = self.vc
+        audio = signal.filtfilt(bh, ah, audio)
+        p_len = audio.shape[0] // vc.window
+        pitch, pitchf = None, None
+        if self.if_f0:
+            t0 = ttime()
+            pitch, pitchf = vc.get_f0(
+                audio, p_len, self.f0_up_key, self.f0_method, self.merge_type,
+                self.filter_radius, self.crepe_hop_length, self.f0_autotune, use_cache=False)
+            pitch = pitch[:p_len].astype(np.int64 if vc.device != 'mps' else np.float32)
+            pitchf = pitchf[:p_len].astype(np.float32)
+            pitch = torch.from_numpy(pitch).to(vc.device).unsqueeze(0)
+            pitchf = torch.from_numpy(pitchf).to(vc.device).unsqueeze(0)
+            self.times[1] += ttime() - t0
+
+        audio1 = vc.vc(self.hubert_model, self.net_g, self.sid, audio, pitch, pitchf, self.times,
+                       self.index, self.big_npy, self.index_rate, self.version, self.protect, use_cache=False)
+        return audio1[-(self.output_block_size + self.crossfade_size + self.sola_search_size):]
+
+    def process_block(self, block):
+        # block must be exactly input_block_size samples at input_sr
+        start = ttime()
+        block = np.asarray(block, dtype=np.float32)
+        if block.ndim > 1: block = block.mean(axis=-1)
+        if self.input_sr != self.vc.sr:
+            block = resample(block, self.input_sr, self.vc.sr)
+        block = librosa.util.fix_length(block, size=self.block_size)
+
+        self.input_buffer[:-self.block_size] = self.input_buffer[self.block_size:]
+        self.input_buffer[-self.block_size:] = block
+
+        infer_wav = self.infer(self.input_buffer)
+
+        # SOLA: find the offset where the new audio best lines up with the previous tail
+        conv_input = infer_wav[: self.crossfade_size + self.sola_search_size]
+        cor_nom = np.convolve(conv_input, np.flip(self.sola_buffer), "valid")
+        cor_den = np.sqrt(np.convolve(conv_input ** 2, np.ones(self.crossfade_size), "valid") + 1e-8)
+        sola_offset = int(np.argmax(cor_nom / cor_den))
+
+        infer_wav = infer_wav[sola_offset:]
+        infer_wav[: self.crossfade_size] = infer_wav[: self.crossfade_size] * self.fade_in + self.sola_buffer * self.fade_out
+        self.sola_buffer[:] = infer_wav[self.output_block_size : self.output_block_size + self.crossfade_size]
+        output = infer_wav[: self.output_block_size].copy()
+
+        self.block_times.append(ttime() - start)
+        return output
+
+    def process(self, audio):
+        # accepts any amount of input and returns the converted blocks that are ready
+        self.pending = np.concatenate([self.pending, np.asarray(audio, dtype=np.float32).reshape(-1)])
+        n_blocks = len(self.pending) // self.input_block_size
+        outputs = [self.process_block(self.pending[i*self.input_block_size:(i+1)*self.input_block_size]) for i in range(n_blocks)]
+        self.pending = self.pending[n_blocks*self.input_block_size:]
+        return np.concatenate(outputs) if len(outputs) else np.zeros(0, dtype=np.float32)
+
+    def stream(self, blocks):
+        # generator version for iterables of input blocks
+        for block in blocks:
+            output = self.process(block)
+            if len(output): yield output
+
+    def callback(self, indata, outdata, frames, time, status):
+        # sounddevice.Stream callback, open the stream with blocksize=self.input_block_size
+        if status: print(status)
+        output = self.process_block(indata[:, 0] if indata.ndim > 1 else indata)
+        output = librosa.util.fix_length(output, size=len(outdata))
+        if outdata.ndim > 1: outdata[:] = output[:, None]
+        else: outdata[:] = output
+
+    def get_stats(self):
+        block_times = np.array(self.block_times) if len(self.block_times) else np.zeros(1)
+        return {
+            "blocks": len(self.block_times),
+            "block_time": self.block_time,
+            "latency": self.latency,
+            "mean_process_time": block_times.mean(),
+            "p95_process_time": np.percentile(block_times, 95),
+            "max_process_time": block_times.max(),
+            "real_time_factor": block_times.mean() / self.block_time,
+            "hubert_time": self.times[0],
+            "f0_time": self.times[1],
+            "net_g_time": self.times[2],
+        }
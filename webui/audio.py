@@ -4,8 +4,13 @@ import os
 import numpy as np
 import librosa
 import soundfile as sf
+from scipy import signal
+
+from lib.audio import AudioWriter, get_audio_info, stream_audio
+from lib.resampler import resample as resample_audio
 
 MAX_INT16 = 32768
+DEBUG_AUDIO_STATS = False # print max/min/mean of every remixed array
 SUPPORTED_AUDIO = ["wav","mp3","flac","ogg"]
 AUTOTUNE_NOTES = np.array([
     65.41, 69.30, 73.42, 77.78, 82.41, 87.31,
@@ -21,24 +26,63 @@ AUTOTUNE_NOTES = np.array([
     2093.00, 2217.46, 2349.32, 2489.02, 2637.02, 2793.83,
     2959.96, 3135.96, 3322.44, 3520.00, 3729.31, 3951.07
 ])
+AUTOTUNE_KEYS = ["C","C#","D","D#","E","F","F#","G","G#","A","A#","B"]
+AUTOTUNE_SCALES = {
+    "chromatic": list(range(12)),
+    "major": [0, 2, 4, 5, 7, 9, 11],
+    "minor": [0, 2, 3, 5, 7, 8, 10],
+    "harmonic_minor": [0, 2, 3, 5, 7, 8, 11],
+    "major_pentatonic": [0, 2, 4, 7, 9],
+    "minor_pentatonic": [0, 3, 5, 7, 10],
+    "blues": [0, 3, 5, 6, 7, 10],
+}
+
+def get_peak(audio):
+    # max(|audio|) without allocating np.abs(audio)
+    return max(float(audio.max()),-float(audio.min())) if audio.size else 0.
+
+def log_audio_stats(label,audio,sr):
+    # full-array stats cost a pass over the audio each, so they're only computed when DEBUG_AUDIO_STATS is set
+    if DEBUG_AUDIO_STATS: print(f"{label}: shape={audio.shape}, max={audio.max()}, min={audio.min()}, mean={audio.mean()}, sr={sr}")
+    else: print(f"{label}: shape={audio.shape}, dtype={audio.dtype}, sr={sr}")
 
-def remix_audio(input_audio,target_sr=None,norm=False,to_int16=False,resample=False,to_mono=False,axis=0,**kwargs):
-    audio = np.array(input_audio[0],dtype="float32")
+def remix_audio(input_audio,target_sr=None,norm=False,to_int16=False,resample=False,to_mono=False,axis=0,out=None,inplace=False,**kwargs):
+    # makes at most one float32 copy of the input (none if it is already float32 and inplace=True),
+    # resampling/downmixing replace that copy and everything after works in place.
+    # to_int16 adds one int16 array unless an int16 `out` buffer is given.
+    audio = np.asarray(input_audio[0],dtype="float32")
+    owned = inplace or not isinstance(input_audio[0],np.ndarray) or not np.may_share_memory(audio,input_audio[0]) # free to modify
     if target_sr is None: target_sr=input_audio[1]
 
-    print(f"before remix: shape={audio.shape}, max={audio.max()}, min={audio.min()}, mean={audio.mean()} sr={input_audio[1]}")
+    log_audio_stats("before remix",audio,input_audio[1])
     if resample or input_audio[1]!=target_sr:
-        audio = librosa.core.resample(np.array(input_audio[0],dtype="float32"),orig_sr=input_audio[1],target_sr=target_sr,**kwargs)
+        audio = resample_audio(audio,input_audio[1],target_sr,**kwargs)
+        owned = owned or not np.may_share_memory(audio,input_audio[0]) # equal rates return the input as is
     
-    if to_mono and audio.ndim>1: audio=np.nanmedian(audio,axis)
+    if to_mono and audio.ndim>1:
+        # median of 2 channels is their mean, which is much cheaper than nanmedian
+        audio = np.nanmean(audio,axis,dtype="float32") if audio.shape[axis]<=2 else np.nanmedian(audio,axis).astype("float32")
+        owned = True
 
-    if norm: audio = librosa.util.normalize(audio)
+    # normalize to peak 1 and then cap at .95 folded into a single multiply
+    peak = get_peak(audio)
+    scale = 1./peak if norm and peak>0 else 1.
+    if peak*scale/.95 > 1: scale *= .95/(peak*scale)
+    if to_int16: scale *= MAX_INT16
 
-    audio_max = np.abs(audio).max() / 0.95
-    if audio_max > 1: audio /= audio_max
-    
-    if to_int16: audio = np.clip(audio * MAX_INT16, a_min=-MAX_INT16+1, a_max=MAX_INT16-1).astype("int16")
-    print(f"after remix: shape={audio.shape}, max={audio.max()}, min={audio.min()}, mean={audio.mean()}, sr={target_sr}")
+    if scale!=1.:
+        if not owned: audio = audio*np.float32(scale)
+        else: audio *= np.float32(scale)
+        owned = True
+
+    if to_int16:
+        if not owned: audio = audio.copy()
+        np.clip(audio,-MAX_INT16+1,MAX_INT16-1,out=audio)
+        if out is None: audio = audio.astype("int16")
+    if out is not None:
+        np.copyto(out,audio,casting="unsafe")
+        audio = out
+    log_audio_stats("after remix",audio,target_sr)
 
     return audio, target_sr
 
@@ -62,6 +106,25 @@ def save_input_audio(fname,input_audio,sr=None,to_int16=False):
     except:
         return False
     
+def stream_input_audio(fname,sr=None,chunk_time=30.,mono=True):
+    # generator version of load_input_audio for long inputs, yields (chunk, sr) with float32 chunks
+    file_sr,channels,frames = get_audio_info(fname)
+    sr = sr or file_sr
+    print(f"streaming sound {fname} {frames/file_sr:.1f}s {channels}ch {file_sr}->{sr} in {chunk_time}s chunks")
+    for chunk in stream_audio(fname,sr=sr,mono=mono,chunk_size=int(chunk_time*sr)):
+        yield chunk, sr
+
+def save_input_audio_stream(fname,chunks,sr,channels=1,to_int16=False):
+    # writes an iterable of chunks ([n] or [channels, n]) as they arrive
+    print(f"streaming sound to {fname}")
+    try:
+        with AudioWriter(fname,sr,channels,subtype="PCM_16" if to_int16 else None) as writer:
+            for chunk in chunks: writer.write(chunk)
+        return True
+    except Exception as e:
+        print(f"failed to save {fname}: {e}")
+        return False
+
 def audio_to_bytes(audio,sr,format='WAV'):
     bytes_io = io.BytesIO()
     sf.write(bytes_io, audio, sr, format=format)
@@ -81,39 +144,64 @@ def pad_audio(*audios,axis=0):
     stack = librosa.util.stack([librosa.util.pad_center(a,maxlen) for a in audios if a is not None],axis=axis)
     return stack
 
+def find_cut_points(audio,window=160,t_center=16000*38,t_query=16000*6):
+    # quietest point (smallest |sum| over `window` samples) within +-t_query of every t_center step
+    audio_pad = np.pad(audio,(window//2,window//2),mode="reflect")
+    cumsum = np.concatenate([[0.],np.cumsum(audio_pad,dtype=np.float64)])
+    audio_sum = np.abs(cumsum[window:window+len(audio)]-cumsum[:len(audio)]) # box filter
+    starts = np.arange(t_center,len(audio),t_center)-t_query
+    if len(starts)==0: return []
+    audio_sum = np.pad(audio_sum,(0,2*t_query),constant_values=np.inf) # windows past the end never win
+    windows = np.lib.stride_tricks.sliding_window_view(audio_sum,2*t_query)[starts]
+    return (starts+windows.argmin(axis=1)).tolist()
+
 def merge_audio(audio1,audio2,sr=40000):
+    # at most 2 full-length float32 arrays are alive at once: the mix buffer and the input being added to it
+    # (remix_audio's one conversion/resample copy). The final remix is in place and adds the int16 output.
     print(f"merging audio audio1={audio1[0].shape,audio1[1]} audio2={audio2[0].shape,audio2[1]} sr={sr}")
-    m1,_=remix_audio(audio1,target_sr=sr)
-    m2,_=remix_audio(audio2,target_sr=sr)
+    lengths = [int(np.ceil(a[0].shape[-1]*sr/a[1])) for a in (audio1,audio2)]
+    maxlen = max(lengths)
     
-    mixed = pad_audio(m1,m2)
-
-    return remix_audio((mixed,sr),to_int16=True,norm=True,to_mono=True,axis=0)
-
-def autotune_f0(f0, threshold=0.):
-    # autotuned_f0 = []
-    # for freq in f0:
-        # closest_notes = [x for x in self.note_dict if abs(x - freq) == min(abs(n - freq) for n in self.note_dict)]
-        # autotuned_f0.append(random.choice(closest_notes))
-    # for note in self.note_dict:
-    #     closest_notes = np.where((f0 - note)/note<.05,f0,note)
-    print("autotuning f0 using note_dict...")
-
-    autotuned_f0 = []
-    # Loop through each value in array1
-    for freq in f0:
-        # Find the absolute difference between x and each value in array2
-        diff = np.abs(AUTOTUNE_NOTES - freq)
-        # Find the index of the minimum difference
-        idx = np.argmin(diff)
-        # Find the corresponding value in array2
-        y = AUTOTUNE_NOTES[idx]
-        # Check if the difference is less than threshold
-        if diff[idx] < threshold:
-            # Keep the value in array1
-            autotuned_f0.append(freq)
-        else:
-            # Use the nearest value in array2
-            autotuned_f0.append(y)
-    # Return the result as a numpy array
-    return np.array(autotuned_f0, dtype="float32")
\ No newline at end of file
+    # same as the median of the centre padded stack (the mean of 2), without building the stack
+    mixed = None
+    for a in (audio1,audio2):
+        m,_ = remix_audio(a,target_sr=sr)
+        if mixed is None: mixed = np.zeros(m.shape[:-1]+(maxlen,),dtype="float32")
+        offset = (maxlen-m.shape[-1])//2
+        mixed[...,offset:offset+m.shape[-1]] += m[...,:maxlen]
+        del m
+    mixed *= .5
+
+    return remix_audio((mixed,sr),to_int16=True,norm=True,inplace=True)
+
+def autotune_f0(f0, threshold=0., key=None, scale="chromatic", retune_speed=0., frame_period=.01):
+    # snaps voiced frames to the nearest note of the scale on a log-frequency grid,
+    # retune_speed (seconds) glides towards the note instead of jumping to it
+    print(f"autotuning f0 to {key if key else ''} {scale} scale...")
+    f0 = np.asarray(f0, dtype="float32")
+    notes = get_scale_notes(key, scale)
+    voiced = f0 > 0
+
+    log_notes = np.log2(notes)
+    log_f0 = np.log2(np.where(voiced, f0, notes[0]))
+    idx = np.clip(np.searchsorted(log_notes, log_f0), 1, len(notes) - 1)
+    # pick whichever neighbour is closer in cents
+    idx -= (log_f0 - log_notes[idx - 1]) < (log_notes[idx] - log_f0)
+    target = notes[idx]
+
+    keep = ~voiced | (np.abs(target - f0) < threshold)
+    correction = np.where(keep, 0., 1200 * (np.log2(target) - log_f0)) # cents
+    if retune_speed > 0:
+        alpha = np.exp(-frame_period / retune_speed)
+        correction = signal.lfilter([1 - alpha], [1, -alpha], correction)
+
+    autotuned_f0 = f0 * np.power(2, correction / 1200)
+    autotuned_f0[~voiced] = f0[~voiced]
+    return autotuned_f0.astype("float32")
+
+def get_scale_notes(key=None, scale="chromatic"):
+    # AUTOTUNE_NOTES starts at C so the index mod 12 is the pitch class
+    if key is None or scale not in AUTOTUNE_SCALES: return AUTOTUNE_NOTES
+    root = AUTOTUNE_KEYS.index(key)
+    pitch_classes = [(root + interval) % 12 for interval in AUTOTUNE_SCALES[scale]]
+    return AUTOTUNE_NOTES[np.isin(np.arange(len(AUTOTUNE_NOTES)) % 12, pitch_classes)]
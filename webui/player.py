@@ -2,12 +2,14 @@ import os
 import queue
 import random
 import threading
-from typing import Iterable
+from typing import Iterable, Iterator
 
 import numpy as np
 from uvr5_cli import split_audio
 import asyncio
 from vc_infer_pipeline import get_vc, vc_single
+from cover_stream_pipeline import CoverStreamPipeline
+from lib.audio import AudioWriter
 from webui.audio import load_input_audio, save_input_audio, merge_audio
 from webui.downloader import BASE_CACHE_DIR
 import pyaudio
@@ -35,6 +37,7 @@ def convert_song(
     vc_single_params,
 
     use_cache=True,
+    stream=False, # returns a generator of (chunk, sr) that separates/converts while it plays
 
     **kwargs
 ):
@@ -45,6 +48,11 @@ def convert_song(
         return load_input_audio(song_path)
     
     print(f"unused args: {kwargs}")
+    if stream:
+        pipeline = CoverStreamPipeline(rvc_models,vc_single_params=vc_single_params,**split_audio_params)
+        chunks = pipeline.stream(audio_path)
+        return cache_chunks(chunks,song_path) if use_cache else chunks
+
     input_vocals, input_instrumental, input_audio = split_audio(
         audio_path=audio_path,
         **split_audio_params
@@ -62,8 +70,26 @@ def convert_song(
 
     return mixed_audio
 
+def cache_chunks(chunks,song_path):
+    # passes the chunks through while writing them, the cache file only appears once the song is complete
+    temp_path = os.path.join(os.path.dirname(song_path),"."+os.path.basename(song_path))
+    writer = None
+    try:
+        for chunk, sr in chunks:
+            if writer is None: writer = AudioWriter(temp_path,sr)
+            writer.write(chunk)
+            yield chunk, sr
+        if writer is not None:
+            writer.close()
+            os.replace(temp_path,song_path)
+    finally:
+        if hasattr(chunks,"close"): chunks.close()
+        if writer is not None and os.path.isfile(temp_path):
+            writer.close()
+            os.remove(temp_path)
+
 class PlaylistPlayer:
-    def __init__(self, playlist: Iterable[str], model_name, config, volume=1.0, shuffle=False, loop=False, use_cache=True, **args):
+    def __init__(self, playlist: Iterable[str], model_name, config, volume=1.0, shuffle=False, loop=False, use_cache=True, stream=False, **args):
 
         # playlist is a list of song filenames
         self.playlist = playlist
@@ -82,6 +108,7 @@ class PlaylistPlayer:
         self.stream = None
         self.rvc_model = None
         self.use_cache = use_cache
+        self.stream_songs = stream # start playing while the song is still being converted
         self.shuffled = False
         
         if shuffle: self.shuffle()
@@ -136,28 +163,36 @@ class PlaylistPlayer:
                         self.stop()
                 elif not (self.stopped or self.paused):
                     self.current_song, input_audio = item
-                    audio, sr = input_audio
-                    format = pyaudio.paInt16 if np.abs(audio).max()>1 else pyaudio.paFloat32
-                    dtype = "int16" if np.abs(audio).max()>1 else "float32" 
+                    # streamed songs arrive as a generator of (chunk, sr) that is still being converted
+                    chunks = input_audio if isinstance(input_audio,Iterator) else [input_audio]
                     try:
-                        self.stream = p.open(format=format, channels=1, rate=sr, output=True)
-                        self.stream.start_stream()
-                    
-                        for i in range(0,len(audio),self.CHUNKSIZE):
-                            if not (self.paused or self.stopped):
-                                data = (audio[i:i+self.CHUNKSIZE]*self.volume).astype(dtype)
-                                if self.stream.is_stopped(): break
-                                self.stream.write(data.tostring())
-                            else:
-                                if self.stopped:
-                                    break
-                                while self.paused and not self.stopped:
-                                    await asyncio.sleep(self.CHUNKSIZE/sr)
-                        self.stream.stop_stream()
-                        self.stream.close()
+                        for audio, sr in chunks:
+                            if self.stream is None:
+                                format = pyaudio.paInt16 if audio.dtype==np.int16 or np.abs(audio).max()>1 else pyaudio.paFloat32
+                                dtype = "int16" if format==pyaudio.paInt16 else "float32"
+                                self.stream = p.open(format=format, channels=1, rate=sr, output=True)
+                                self.stream.start_stream()
+                        
+                            for i in range(0,len(audio),self.CHUNKSIZE):
+                                if not (self.paused or self.stopped):
+                                    data = (audio[i:i+self.CHUNKSIZE]*self.volume).astype(dtype)
+                                    if self.stream.is_stopped(): break
+                                    self.stream.write(data.tostring())
+                                else:
+                                    if self.stopped:
+                                        break
+                                    while self.paused and not self.stopped:
+                                        await asyncio.sleep(self.CHUNKSIZE/sr)
+                            if self.stopped or self.stream.is_stopped(): break
+                        if self.stream is not None:
+                            self.stream.stop_stream()
+                            self.stream.close()
                     except Exception as e:
                         print(f"failed to stream {self.current_song}: {e}")
-                    finally: item=None
+                    finally:
+                        if hasattr(chunks,"close"): chunks.close() # stops the conversion of a skipped song
+                        self.stream = None
+                        item=None
 
         p.terminate()
 
@@ -174,7 +209,7 @@ class PlaylistPlayer:
 
                     try:
                         # call the convert_song function on it (replace with your own function)
-                        input_audio = convert_song(song,rvc_models,use_cache=self.use_cache,**self.args)
+                        input_audio = convert_song(song,rvc_models,use_cache=self.use_cache,stream=self.stream_songs,**self.args)
                         # put the song data and sample rate in the queue
                         self.queue.put((song, input_audio))
                     except Exception as e:
@@ -43,6 +43,14 @@ def get_filenames(root=".",folder="**",exts=["*"],name_filters=[""]):
         fnames.extend(glob.glob(os.path.join(root,folder,f"*.{ext}"),recursive=True))
     return sorted([ele for ele in fnames if any([nf.lower() in ele.lower() for nf in name_filters])])
 
+def save_npy(fname,data):
+    # write to a temp file first so readers never see a partial array
+    os.makedirs(os.path.dirname(fname),exist_ok=True)
+    tmp_file = f"{fname}.{os.getpid()}.tmp"
+    with open(tmp_file,"wb") as f:
+        np.save(f,data,allow_pickle=False)
+    os.replace(tmp_file,fname)
+
 def get_index(arr,value): return arr.index(value) if value in arr else 0
 
 def gc_collect():